@@ -1,102 +1,194 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
-
-class AddGroupByIndicator(QgsProcessingAlgorithm):
-    SOURCE_LYR = 'SOURCE_LYR'
-    ORDER_FIELD = 'ORDER_FIELD'
-    TRIGGER_FIELD = 'TRIGGER_FIELD'
-    GROUP_IDFIELD = 'GROUP_IDFIELD'
-    INDICATOR_VALUE = 'INDICATOR_VALUE'
-    OUTPUT = 'OUTPUT'
-
-    def initAlgorithm(self, config=None):
-        
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.SOURCE_LYR, self.tr('Source'))) # Take any source layer
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.ORDER_FIELD, self.tr('Field the layer should be ordered by'),'Date','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.TRIGGER_FIELD, self.tr('Trigger Field indicating a new Group'),'Trigger','SOURCE_LYR')) # Choose the Trigger field of the source layer, default if exists is 'Trigger'
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.GROUP_IDFIELD, self.tr('Name of new generated GroupID Field'),'groupid')) # String of the new added fieldname, default is 'groupid'
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.INDICATOR_VALUE, self.tr('Number indicating a new Group'),0,1)) # Indicator as number. 0=Int, 1 would be double; 1=default number
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT, self.tr('SourceWithGroupID'))) # Output
-
-    def processAlgorithm(self, parameters, context, feedback):
-        # Get Parameters and assign to variable to work with
-        source_layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
-        orderbyfield = self.parameterAsString(parameters, self.ORDER_FIELD, context)
-        triggerfield = self.parameterAsString(parameters, self.TRIGGER_FIELD, context)
-        groupfieldname = self.parameterAsString(parameters, self.GROUP_IDFIELD, context)
-        newlineindicator = self.parameterAsInt(parameters, self.INDICATOR_VALUE, context)
-        
-        groupid = 0 # initialize groupid counter
-        
-        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
-        
-        fields = source_layer.fields() # get all fields of the sourcelayer
-        fields.append(QgsField(groupfieldname, QVariant.Int, len=20)) # add a new field to this list
-        
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               fields, source_layer.wkbType(),
-                                               source_layer.sourceCrs())
-        
-        # order the layer
-        order_by_clause = QgsFeatureRequest.OrderBy([QgsFeatureRequest.OrderByClause(orderbyfield, ascending=True)])
-        request = QgsFeatureRequest().setOrderBy(order_by_clause)
-        
-        for current, feat in enumerate(source_layer.getFeatures(request)): # iterate over source 
-            if feat[triggerfield] == newlineindicator: # if trigger appears increase groupcounter
-                groupid += 1
-            new_feat = QgsFeature(fields) # copy source fields + appended
-            idx = 0 # reset attribute fieldindex
-            for attr in feat.attributes(): # iterate over attributes of source layer for the current feature
-                new_feat[idx] = attr # copy attribute values over to the new layer
-                idx += 1 # increase fieldindex counter
-            new_feat[groupfieldname] = groupid # assign the groupid
-            new_feat.setGeometry(feat.geometry()) # copy over the geometry of the source feature
-            
-            sink.addFeature(new_feat, QgsFeatureSink.FastInsert) # add feature to the output
-            
-            if feedback.isCanceled(): # Cancel algorithm if button is pressed
-                break
-            
-            feedback.setProgress(int(current * total)) # Set Progress in Progressbar
-
-        return {self.OUTPUT: dest_id} # Return result of algorithm
-
-
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return AddGroupByIndicator()
-
-    def name(self):
-        return 'AddGroupByIndicator'
-
-    def displayName(self):
-        return self.tr('Add group by indicator field')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+import itertools, sys, time
+
+class RowBuilder:
+    # Output layout computed once: the attributes of an output feature are the concatenation of lists of values
+    # (e.g. source attributes + joined attributes + computed values) set at once, missing values at the end stay NULL.
+    def __init__(self, fields):
+        self.fields = fields
+        self.n_fields = fields.count()
+
+    def feature(self, geometry, *parts):
+        row = list(itertools.chain.from_iterable(parts))
+        if len(row) < self.n_fields:
+            row.extend([None] * (self.n_fields - len(row)))
+        feature = QgsFeature(self.fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes(row)
+        return feature
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class AddGroupByIndicator(QgsProcessingAlgorithm):
+    SOURCE_LYR = 'SOURCE_LYR'
+    ORDER_FIELD = 'ORDER_FIELD'
+    TRIGGER_FIELD = 'TRIGGER_FIELD'
+    GROUP_IDFIELD = 'GROUP_IDFIELD'
+    INDICATOR_VALUE = 'INDICATOR_VALUE'
+    OUTPUT = 'OUTPUT'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.SOURCE_LYR, self.tr('Source'))) # Take any source layer
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.ORDER_FIELD, self.tr('Field the layer should be ordered by'),'Date','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.TRIGGER_FIELD, self.tr('Trigger Field indicating a new Group'),'Trigger','SOURCE_LYR')) # Choose the Trigger field of the source layer, default if exists is 'Trigger'
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.GROUP_IDFIELD, self.tr('Name of new generated GroupID Field'),'groupid')) # String of the new added fieldname, default is 'groupid'
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INDICATOR_VALUE, self.tr('Number indicating a new Group'),0,1)) # Indicator as number. 0=Int, 1 would be double; 1=default number
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('SourceWithGroupID'))) # Output
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Get Parameters and assign to variable to work with
+        source_layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
+        orderbyfield = self.parameterAsString(parameters, self.ORDER_FIELD, context)
+        triggerfield = self.parameterAsString(parameters, self.TRIGGER_FIELD, context)
+        groupfieldname = self.parameterAsString(parameters, self.GROUP_IDFIELD, context)
+        newlineindicator = self.parameterAsInt(parameters, self.INDICATOR_VALUE, context)
+        
+        groupid = 0 # initialize groupid counter
+        
+        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
+        
+        fields = source_layer.fields() # get all fields of the sourcelayer
+        fields.append(QgsField(groupfieldname, QVariant.Int, len=20)) # add a new field to this list
+        
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               fields, source_layer.wkbType(),
+                                               source_layer.sourceCrs())
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+        
+            rows = RowBuilder(fields)
+        
+            # order the layer
+            order_by_clause = QgsFeatureRequest.OrderBy([QgsFeatureRequest.OrderByClause(orderbyfield, ascending=True)])
+            request = QgsFeatureRequest().setOrderBy(order_by_clause)
+        
+            for current, feat in enumerate(source_layer.getFeatures(request)): # iterate over source 
+                if feat[triggerfield] == newlineindicator: # if trigger appears increase groupcounter
+                    groupid += 1
+                writer.addFeature(rows.feature(feat.geometry(), feat.attributes(), [groupid])) # source attributes + groupid
+            
+                if feedback.isCanceled(): # Cancel algorithm if button is pressed
+                    break
+            
+                feedback.setProgress(int(current * total)) # Set Progress in Progressbar
+        finally:
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+
+        return {self.OUTPUT: dest_id} # Return result of algorithm
+
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return AddGroupByIndicator()
+
+    def name(self):
+        return 'AddGroupByIndicator'
+
+    def displayName(self):
+        return self.tr('Add group by indicator field')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
         return self.tr('This Algorithm adds a new group id found by a trigger')
\ No newline at end of file
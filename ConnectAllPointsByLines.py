@@ -1,84 +1,166 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum)
-
-class ConnectAllPointsByLines(QgsProcessingAlgorithm):
-    POSSIBILITY_LYR = 'POSSIBILITY_LYR'
-    POSSIBILITY_IDFIELD = 'POSSIBILITY_IDFIELD'
-    STOP_LYR = 'STOP_LYR'
-    STOP_IDFIELD = 'STOP_IDFIELD'
-    OUTPUT = 'OUTPUT'
-
-    def initAlgorithm(self, config=None):
-        
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.STOP_LYR, self.tr('Source Points'), [QgsProcessing.TypeVectorPoint]))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.STOP_IDFIELD, self.tr('Unique ID Field of Source Layer (Any Datatype)'),'ANY','STOP_LYR'))        
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.POSSIBILITY_LYR, self.tr('Target Points'), [QgsProcessing.TypeVectorPoint]))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.POSSIBILITY_IDFIELD, self.tr('Unique Target ID Field (Any Datatype, should have a different name than Source ID field)'),'ANY','POSSIBILITY_LYR'))
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT, self.tr('Line Connections'), QgsProcessing.TypeVectorLine))
-
-    def processAlgorithm(self, parameters, context, feedback):
-        # Get Parameters
-        possibility_layer = self.parameterAsSource(parameters, self.POSSIBILITY_LYR, context)
-        possibility_idfield = self.parameterAsFields(parameters, self.POSSIBILITY_IDFIELD, context)
-        stop_layer = self.parameterAsSource(parameters, self.STOP_LYR, context)
-        stop_idfield = self.parameterAsFields(parameters, self.STOP_IDFIELD, context)
-
-        fields = QgsFields()
-        fields.append(QgsField(stop_idfield[0]))        
-        fields.append(QgsField(possibility_idfield[0]))
-        fields.append(QgsField("line_length", QVariant.Double, len=20, prec=5))
-
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               fields, QgsWkbTypes.LineString,
-                                               possibility_layer.sourceCrs())
-
-        # iterate over stop features
-        for stop_feat in stop_layer.getFeatures():
-            point1 = QgsPoint(stop_feat.geometry().asPoint())
-            for source_feat in possibility_layer.getFeatures():
-                point2 = QgsPoint(source_feat.geometry().asPoint())
-                new_feat = QgsFeature(fields)
-                new_feat.setGeometry(QgsGeometry.fromPolyline([point1, point2])) 
-                new_feat[stop_idfield[0]] = stop_feat[stop_idfield[0]]                
-                new_feat[possibility_idfield[0]] = source_feat[possibility_idfield[0]]
-                new_feat["line_length"] = new_feat.geometry().length()                
-                sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-            
-        return {self.OUTPUT: dest_id}
-
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return ConnectAllPointsByLines()
-
-    def name(self):
-        return 'ConnectAllPointsByLines'
-
-    def displayName(self):
-        return self.tr('Connect All Points By Lines')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition, QgsProcessingParameterNumber,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum)
+import sys, time
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class ConnectAllPointsByLines(QgsProcessingAlgorithm):
+    POSSIBILITY_LYR = 'POSSIBILITY_LYR'
+    POSSIBILITY_IDFIELD = 'POSSIBILITY_IDFIELD'
+    STOP_LYR = 'STOP_LYR'
+    STOP_IDFIELD = 'STOP_IDFIELD'
+    OUTPUT = 'OUTPUT'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.STOP_LYR, self.tr('Source Points'), [QgsProcessing.TypeVectorPoint]))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.STOP_IDFIELD, self.tr('Unique ID Field of Source Layer (Any Datatype)'),'ANY','STOP_LYR'))        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.POSSIBILITY_LYR, self.tr('Target Points'), [QgsProcessing.TypeVectorPoint]))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.POSSIBILITY_IDFIELD, self.tr('Unique Target ID Field (Any Datatype, should have a different name than Source ID field)'),'ANY','POSSIBILITY_LYR'))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('Line Connections'), QgsProcessing.TypeVectorLine))
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Get Parameters
+        possibility_layer = self.parameterAsSource(parameters, self.POSSIBILITY_LYR, context)
+        possibility_idfield = self.parameterAsFields(parameters, self.POSSIBILITY_IDFIELD, context)
+        stop_layer = self.parameterAsSource(parameters, self.STOP_LYR, context)
+        stop_idfield = self.parameterAsFields(parameters, self.STOP_IDFIELD, context)
+
+        fields = QgsFields()
+        fields.append(QgsField(stop_idfield[0]))        
+        fields.append(QgsField(possibility_idfield[0]))
+        fields.append(QgsField("line_length", QVariant.Double, len=20, prec=5))
+
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               fields, QgsWkbTypes.LineString,
+                                               possibility_layer.sourceCrs())
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+
+            # iterate over stop features
+            for stop_feat in stop_layer.getFeatures():
+                point1 = QgsPoint(stop_feat.geometry().asPoint())
+                for source_feat in possibility_layer.getFeatures():
+                    point2 = QgsPoint(source_feat.geometry().asPoint())
+                    new_feat = QgsFeature(fields)
+                    new_feat.setGeometry(QgsGeometry.fromPolyline([point1, point2])) 
+                    new_feat[stop_idfield[0]] = stop_feat[stop_idfield[0]]                
+                    new_feat[possibility_idfield[0]] = source_feat[possibility_idfield[0]]
+                    new_feat["line_length"] = new_feat.geometry().length()                
+                    writer.addFeature(new_feat)
+        finally:
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+            
+        return {self.OUTPUT: dest_id}
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return ConnectAllPointsByLines()
+
+    def name(self):
+        return 'ConnectAllPointsByLines'
+
+    def displayName(self):
+        return self.tr('Connect All Points By Lines')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
         return self.tr('This Algorithm connects all points of the Source layer with all points of the Target layer with lines and adds the lines length')
\ No newline at end of file
@@ -1,125 +1,334 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsSpatialIndex,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterDateTime, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
-import processing
-from datetime import *
-import math
-
-class CountPointsInPolygonByTime(QgsProcessingAlgorithm):
-    POLYGON_LYR = 'POLYGON_LYR'
-    POINT_LYR = 'POINT_LYR'
-    DATETIME_FIELD = 'DATETIME_FIELD'
-    START_DATETIME = 'START_DATETIME'
-    END_DATETIME = 'END_DATETIME'
-    INTERVALSEC = 'INTERVALSEC'
-    OUTPUT = 'OUTPUT'
-
-    def initAlgorithm(self, config=None):
-        
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.POLYGON_LYR, self.tr('Polygon'), [QgsProcessing.TypeVectorPolygon], 'polygons'))
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.POINT_LYR, self.tr('Point'), [QgsProcessing.TypeVectorPoint], 'points'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.DATETIME_FIELD, self.tr('Datetime Field'),'datetime','POINT_LYR'))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.START_DATETIME, self.tr('Start Datetime in YYYY-MM-DD HH:MM:SS format'),'2020-01-01 00:00:00'))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.END_DATETIME, self.tr('End Datetime in YYYY-MM-DD HH:MM:SS format'),'2020-01-10 23:59:59'))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.INTERVALSEC, self.tr('Interval in Seconds'),0,86400)) # Indicator as number. 0=Int, 1 would be double; 1=default number
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT, self.tr('TimePolygons with Pointcount'))) # Output
-
-    def processAlgorithm(self, parameters, context, feedback):
-        lyr_polygons = self.parameterAsLayer(parameters, self.POLYGON_LYR, context)
-        lyr_points = self.parameterAsLayer(parameters, self.POINT_LYR, context)
-        fld_time = self.parameterAsString(parameters, self.DATETIME_FIELD, context)
-        start_date_string = self.parameterAsString(parameters, self.START_DATETIME, context)
-        end_date_string = self.parameterAsString(parameters, self.END_DATETIME, context)
-        intervalsec = self.parameterAsInt(parameters, self.INTERVALSEC, context)
-        
-        if lyr_polygons.sourceCrs() != lyr_points.sourceCrs():
-            reproj = processing.run('native:reprojectlayer', {'INPUT': lyr_points, 'TARGET_CRS': lyr_polygons.sourceCrs(), 'OUTPUT': 'memory:Reprojected'})
-            lyr_points = reproj['OUTPUT']
-        
-        fields = lyr_polygons.fields()
-        fields.append(QgsField('from_datetime', QVariant.DateTime))
-        fields.append(QgsField('to_datetime', QVariant.DateTime))
-        fields.append(QgsField('pointcount', QVariant.Int, len=0))
-        
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               fields, lyr_polygons.wkbType(),
-                                               lyr_polygons.sourceCrs())
-        
-        start_date = datetime.strptime(start_date_string, '%Y-%m-%d %H:%M:%S')
-        end_date = datetime.strptime(end_date_string, '%Y-%m-%d %H:%M:%S')
-        total_seconds = int((end_date - start_date).total_seconds())
-        idx_points = QgsSpatialIndex(lyr_points.getFeatures())
-        
-        required_iterations = math.ceil(total_seconds / intervalsec) 
-        total = 100.0 / (lyr_polygons.featureCount() * required_iterations) if lyr_polygons.featureCount() else 0
-        current = 0
-        
-        for current_interval in range(0,total_seconds,intervalsec): 
-            current_start_datetime = start_date + timedelta(seconds = current_interval)
-            current_end_datetime = (start_date + timedelta(seconds = current_interval+intervalsec) - timedelta(seconds = 1))
-            for polygon in lyr_polygons.getFeatures():
-                current += 1
-                new_feat = QgsFeature(fields)
-                new_feat.setGeometry(polygon.geometry())
-                idx = 0
-                for attr in polygon.attributes():
-                    new_feat[idx] = attr
-                    idx += 1
-                new_feat['from_datetime'] = current_start_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                new_feat['to_datetime'] = current_end_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                new_feat['pointcount'] = 0
-                for pointid in idx_points.intersects(polygon.geometry().boundingBox()):
-                    point = lyr_points.getFeature(pointid)
-                    if feedback.isCanceled():
-                        break
-                    if point[fld_time] >= current_start_datetime and point[fld_time] <= current_end_datetime:
-                        if point.geometry().intersects(polygon.geometry()):
-                            new_feat['pointcount'] += 1
-                            idx_points.deleteFeature(point) # dont count a point twice, removing it from the index speeds up the code around 25%
-                        
-                if feedback.isCanceled():
-                    break
-                    
-                sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-                feedback.setProgress(int(current * total))
-                
-        return {self.OUTPUT: dest_id} # Return result of algorithm
-        
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return CountPointsInPolygonByTime()
-
-    def name(self):
-        return 'CountPointsInPolygonByTime'
-
-    def displayName(self):
-        return self.tr('Count Points in Polygon by Datetime')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (NULL, QgsApplication, QgsProviderRegistry, QgsMemoryProviderUtils, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition, QgsSpatialIndex,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterBoolean, QgsProcessingParameterDateTime, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+from datetime import *
+import glob, hashlib, itertools, math, os, pickle, sys, time, zlib
+
+class RowBuilder:
+    # Output layout computed once: the attributes of an output feature are the concatenation of lists of values
+    # (e.g. source attributes + joined attributes + computed values) set at once, missing values at the end stay NULL.
+    def __init__(self, fields):
+        self.fields = fields
+        self.n_fields = fields.count()
+
+    def feature(self, geometry, *parts):
+        row = list(itertools.chain.from_iterable(parts))
+        if len(row) < self.n_fields:
+            row.extend([None] * (self.n_fields - len(row)))
+        feature = QgsFeature(self.fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes(row)
+        return feature
+
+INDEX_CACHE_MAX_BYTES = 2 * 1024 ** 3 # the least recently used cached indexes are removed when all of them together get larger
+
+def index_cache_key(layer, *identity):
+    # Key of the cached index of a layer: data source, subset string, modification stamps of the files behind the source and whatever else
+    # changes the content of the index (fields, filter, crs...). Returns None if the source is no local file or the layer has unsaved edits,
+    # their changes could not be detected.
+    if layer.isEditable() and layer.isModified():
+        return None
+    path = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source()).get('path')
+    if not path or not os.path.isfile(path):
+        return None
+    stamps = []
+    for file_path in sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + '*')): # sidecar files too, e.g. the .dbf of a shapefile or the -wal of a geopackage
+        stat = os.stat(file_path)
+        stamps.append('{}:{}:{}'.format(os.path.basename(file_path), stat.st_mtime_ns, stat.st_size))
+    key = [layer.source(), layer.subsetString()] + stamps + [str(value) for value in identity]
+    return hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()
+
+def index_cache_path(key):
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'cache', 'spatial_index', key + '.pickle')
+
+def load_index_cache(key):
+    # Returns the cached records [(fid, geometry, [values])] of the key or None if there are none
+    path = index_cache_path(key)
+    try:
+        with open(path, 'rb') as cache_file:
+            records = pickle.loads(zlib.decompress(cache_file.read()))
+        os.utime(path) # the modification time tells which entry has been used least recently
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError, zlib.error):
+        return None
+    result = []
+    for fid, wkb, values in records:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        result.append((fid, geometry, [NULL if value is None else value for value in values]))
+    return result
+
+def store_index_cache(key, records):
+    # Stores the records [(fid, geometry, [values])] under the key and removes the least recently used entries if the cache got too large.
+    # Returns False if the values can not be stored (attribute types pickle does not know).
+    records = [(fid, bytes(geometry.asWkb()), [None if isinstance(value, QVariant) and value.isNull() else value for value in values]) for fid, geometry, values in records]
+    try:
+        data = zlib.compress(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return False
+    path = index_cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as cache_file:
+        cache_file.write(data)
+    os.replace(path + '.tmp', path) # never leave a half written entry behind
+    entries = []
+    for entry in glob.glob(os.path.join(os.path.dirname(path), '*.pickle')):
+        try:
+            stat = os.stat(entry)
+        except OSError: # removed by another run in the meantime
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry in sorted(entries):
+        if size <= INDEX_CACHE_MAX_BYTES:
+            break
+        if entry != path:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            size -= entry_size
+    return True
+
+def bulk_loaded_index(records, wkb_type, crs, feedback):
+    # Bulk loads a spatial index over the geometries of the records [(fid, geometry, values)], which is much faster and gives a better packed tree
+    # than adding the features one by one. QgsSpatialIndex only bulk loads from a feature iterator, so the geometries are put into a memory layer,
+    # whose provider numbers the features itself: returns the index and the records by their number in the index, or None if canceled.
+    index_layer = QgsMemoryProviderUtils.createMemoryLayer('index', QgsFields(), wkb_type, crs)
+    features = []
+    kept_records = []
+    for record in records:
+        feature = QgsFeature()
+        feature.setGeometry(record[1])
+        features.append(feature)
+        kept_records.append(record)
+        if feedback.isCanceled():
+            return None
+    ok, features = index_layer.dataProvider().addFeatures(features, QgsFeatureSink.FastInsert)
+    if not ok:
+        raise QgsProcessingException('The geometries could not be indexed: {}'.format(index_layer.dataProvider().lastError()))
+    idx = QgsSpatialIndex(index_layer.getFeatures(QgsFeatureRequest().setNoAttributes()), feedback)
+    if feedback.isCanceled():
+        return None
+    return idx, {feature.id(): record for feature, record in zip(features, kept_records)}
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class CountPointsInPolygonByTime(QgsProcessingAlgorithm):
+    POLYGON_LYR = 'POLYGON_LYR'
+    POINT_LYR = 'POINT_LYR'
+    DATETIME_FIELD = 'DATETIME_FIELD'
+    START_DATETIME = 'START_DATETIME'
+    END_DATETIME = 'END_DATETIME'
+    INTERVALSEC = 'INTERVALSEC'
+    USE_INDEX_CACHE = 'USE_INDEX_CACHE'
+    OUTPUT = 'OUTPUT'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.POLYGON_LYR, self.tr('Polygon'), [QgsProcessing.TypeVectorPolygon], 'polygons'))
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.POINT_LYR, self.tr('Point'), [QgsProcessing.TypeVectorPoint], 'points'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.DATETIME_FIELD, self.tr('Datetime Field'),'datetime','POINT_LYR'))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.START_DATETIME, self.tr('Start Datetime in YYYY-MM-DD HH:MM:SS format'),'2020-01-01 00:00:00'))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.END_DATETIME, self.tr('End Datetime in YYYY-MM-DD HH:MM:SS format'),'2020-01-10 23:59:59'))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INTERVALSEC, self.tr('Interval in Seconds'),0,86400)) # Indicator as number. 0=Int, 1 would be double; 1=default number
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_INDEX_CACHE, self.tr('Keep the index of the points in a cache in the QGIS profile and reuse it as long as the file of the point layer is unchanged (may use up to 2 GB of disk space)'),False))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('TimePolygons with Pointcount'))) # Output
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        lyr_polygons = self.parameterAsLayer(parameters, self.POLYGON_LYR, context)
+        lyr_points = self.parameterAsLayer(parameters, self.POINT_LYR, context)
+        fld_time = self.parameterAsString(parameters, self.DATETIME_FIELD, context)
+        start_date_string = self.parameterAsString(parameters, self.START_DATETIME, context)
+        end_date_string = self.parameterAsString(parameters, self.END_DATETIME, context)
+        intervalsec = self.parameterAsInt(parameters, self.INTERVALSEC, context)
+        use_index_cache = self.parameterAsBool(parameters, self.USE_INDEX_CACHE, context)
+        
+        fields = lyr_polygons.fields()
+        fields.append(QgsField('from_datetime', QVariant.DateTime))
+        fields.append(QgsField('to_datetime', QVariant.DateTime))
+        fields.append(QgsField('pointcount', QVariant.Int, len=0))
+        
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               fields, lyr_polygons.wkbType(),
+                                               lyr_polygons.sourceCrs())
+        start_date = datetime.strptime(start_date_string, '%Y-%m-%d %H:%M:%S')
+        end_date = datetime.strptime(end_date_string, '%Y-%m-%d %H:%M:%S')
+        total_seconds = int((end_date - start_date).total_seconds())
+        
+        # index the points in the crs of the polygons, keeping geometry and time of every point so they do not need to be requested again
+        cache_key = None
+        records = None
+        if use_index_cache:
+            cache_key = index_cache_key(lyr_points, fld_time, lyr_polygons.sourceCrs().toWkt())
+            if cache_key is not None:
+                records = load_index_cache(cache_key)
+            else:
+                feedback.pushInfo(self.tr('The index of the point layer is not cached, the point layer has unsaved edits or is not read from a local file.'))
+        read_from_cache = records is not None
+        if read_from_cache:
+            feedback.pushInfo(self.tr('Index of the points read from the cache.'))
+        else:
+            request = QgsFeatureRequest().setSubsetOfAttributes([fld_time], lyr_points.fields())
+            if lyr_polygons.sourceCrs() != lyr_points.sourceCrs():
+                request.setDestinationCrs(lyr_polygons.sourceCrs(), context.transformContext())
+            records = ((point.id(), point.geometry(), [point[fld_time]]) for point in lyr_points.getFeatures(request))
+        indexed = bulk_loaded_index(records, lyr_points.wkbType(), lyr_polygons.sourceCrs(), feedback)
+        if indexed is None: # canceled
+            return {}
+        idx_points, indexed = indexed
+        # geometry and time by the number of the point in the index
+        point_geoms = {pointid: point_geom for pointid, (fid, point_geom, values) in indexed.items()}
+        point_times = {pointid: values[0] for pointid, (fid, point_geom, values) in indexed.items()}
+        if cache_key is not None and not read_from_cache:
+            if not store_index_cache(cache_key, [(fid, point_geom, list(values)) for fid, point_geom, values in indexed.values()]):
+                feedback.pushInfo(self.tr('The index of the points can not be cached, the datetime field has a type that can not be stored.'))
+        
+        required_iterations = math.ceil(total_seconds / intervalsec) 
+        total = 100.0 / (lyr_polygons.featureCount() * required_iterations) if lyr_polygons.featureCount() else 0
+        current = 0
+        
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+            rows = RowBuilder(fields)
+            for current_interval in range(0,total_seconds,intervalsec): 
+                current_start_datetime = start_date + timedelta(seconds = current_interval)
+                current_end_datetime = (start_date + timedelta(seconds = current_interval+intervalsec) - timedelta(seconds = 1))
+                for polygon in lyr_polygons.getFeatures():
+                    current += 1
+                    pointcount = 0
+                    for pointid in idx_points.intersects(polygon.geometry().boundingBox()):
+                        if feedback.isCanceled():
+                            break
+                        if point_times[pointid] >= current_start_datetime and point_times[pointid] <= current_end_datetime:
+                            if point_geoms[pointid].intersects(polygon.geometry()):
+                                pointcount += 1
+                                point = QgsFeature(pointid)
+                                point.setGeometry(point_geoms[pointid])
+                                idx_points.deleteFeature(point) # dont count a point twice, removing it from the index speeds up the code around 25%
+                        
+                    if feedback.isCanceled():
+                        break
+                    
+                    writer.addFeature(rows.feature(polygon.geometry(), polygon.attributes(),
+                                                   [current_start_datetime.strftime('%Y-%m-%d %H:%M:%S'), current_end_datetime.strftime('%Y-%m-%d %H:%M:%S'), pointcount]))
+                    feedback.setProgress(int(current * total))
+        finally:
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+                
+        return {self.OUTPUT: dest_id} # Return result of algorithm
+        
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return CountPointsInPolygonByTime()
+
+    def name(self):
+        return 'CountPointsInPolygonByTime'
+
+    def displayName(self):
+        return self.tr('Count Points in Polygon by Datetime')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
         return self.tr('This Algorithm counts points in polygons by a given datetime condition')
\ No newline at end of file
@@ -1,94 +1,176 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsJsonUtils, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterGeometry, QgsProcessingParameterCrs, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
-
-class GeometryLayerFromGeojsonStringField(QgsProcessingAlgorithm):
-    SOURCE_LYR = 'SOURCE_LYR'
-    GEOJSON_FIELD = 'GEOJSON_FIELD'
-    #GEOMETRYTYPE_STRING = 'GEOMETRYTYPE_STRING'
-    GEOMETRYTYPE_ENUM = 'GEOMETRYTYPE_ENUM'
-    CRS = 'CRS'
-    OUTPUT = 'OUTPUT'
-    
-
-    def initAlgorithm(self, config=None):  
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.SOURCE_LYR, self.tr('Source'), [QgsProcessing.TypeMapLayer])) # Take any source layer, unfortunately no-geometry layers will not be available...
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.GEOJSON_FIELD, self.tr('Field containing the GeoJSON as string'),'GeoJSON','SOURCE_LYR', 1)) # Choose the field containing the GeoJSON as string
-        #self.addParameter(
-        #    QgsProcessingParameterNumber(
-        #        self.GEOMETRYTYPE_STRING, self.tr('Geometry type of the target layer / of the GeoJSON content as number (lookup at https://qgis.org/pyqgis/3.0/core/Wkb/QgsWkbTypes.html)'),0,5)) # Unfortunately there is no WKB-Type-Input available...
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.GEOMETRYTYPE_ENUM, self.tr('Geometry type of the target layer / of the GeoJSON content'),
-                ['Unknown','Point','LineString','Polygon','MultiPoint','MultiLineString','MultiPolygon','GeometryCollection','CircularString','CompoundCurve','CurvePolygon'],defaultValue=5)) # Only Works because these are ascending numerated in QGIS... NOT A GOOD SOLUTION!! But better than typing in a number by hand... see https://qgis.org/api/classQgsWkbTypes.html
-        self.addParameter(
-            QgsProcessingParameterCrs(
-                self.CRS, self.tr('CRS of the target layer / of the GeoJSON content'),'EPSG:4326')) # CRS of the targetlayer
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT, self.tr('new_geojson_layer'))) # Output
-
-    def processAlgorithm(self, parameters, context, feedback):
-        # Get Parameters and assign to variable to work with
-        source_layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
-        source_geojsonfield = self.parameterAsString(parameters, self.GEOJSON_FIELD, context)
-        #wkbgeometrytype = self.parameterAsInt(parameters, self.GEOMETRYTYPE_STRING, context)
-        wkbgeometrytype_fromenum = self.parameterAsInt(parameters, self.GEOMETRYTYPE_ENUM, context)
-        wkbgeometrytype = wkbgeometrytype_fromenum # testing assignment        
-        crsgeometry = self.parameterAsCrs(parameters, self.CRS, context)
-        
-        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
-        
-        source_fields = source_layer.fields() # get all fields of the sourcelayer
-        
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, source_fields, wkbgeometrytype, crsgeometry)
-                                               
-        for current, feature in enumerate(source_layer.getFeatures()): # iterate over source 
-            # geoj is the string object that contains the GeoJSON
-            geoj = feature.attributes()[source_fields.indexFromName(source_geojsonfield)]
-            # PyQGIS has a parser class for JSON and GeoJSON
-            geojfeats = QgsJsonUtils.stringToFeatureList(geoj, QgsFields(), None)
-            # if there are features in the list
-            if len(geojfeats) > 0:
-                new_geom = geojfeats[0].geometry()
-                new_feat = QgsFeature(feature)
-                new_feat.setGeometry(new_geom)
-                sink.addFeature(new_feat, QgsFeatureSink.FastInsert) # add feature to the output
-            
-            if feedback.isCanceled(): # Cancel algorithm if button is pressed
-                break
-            
-            feedback.setProgress(int(current * total)) # Set Progress in Progressbar
-
-        return {self.OUTPUT: dest_id} # Return result of algorithm
-
-
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return GeometryLayerFromGeojsonStringField()
-
-    def name(self):
-        return 'GeometryLayerFromGeojsonStringField'
-
-    def displayName(self):
-        return self.tr('New Layer from GeoJSON String')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (QgsJsonUtils, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterGeometry, QgsProcessingParameterCrs, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+import sys, time
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class GeometryLayerFromGeojsonStringField(QgsProcessingAlgorithm):
+    SOURCE_LYR = 'SOURCE_LYR'
+    GEOJSON_FIELD = 'GEOJSON_FIELD'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+    #GEOMETRYTYPE_STRING = 'GEOMETRYTYPE_STRING'
+    GEOMETRYTYPE_ENUM = 'GEOMETRYTYPE_ENUM'
+    CRS = 'CRS'
+    OUTPUT = 'OUTPUT'
+    
+
+    def initAlgorithm(self, config=None):  
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.SOURCE_LYR, self.tr('Source'), [QgsProcessing.TypeMapLayer])) # Take any source layer, unfortunately no-geometry layers will not be available...
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.GEOJSON_FIELD, self.tr('Field containing the GeoJSON as string'),'GeoJSON','SOURCE_LYR', 1)) # Choose the field containing the GeoJSON as string
+        #self.addParameter(
+        #    QgsProcessingParameterNumber(
+        #        self.GEOMETRYTYPE_STRING, self.tr('Geometry type of the target layer / of the GeoJSON content as number (lookup at https://qgis.org/pyqgis/3.0/core/Wkb/QgsWkbTypes.html)'),0,5)) # Unfortunately there is no WKB-Type-Input available...
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.GEOMETRYTYPE_ENUM, self.tr('Geometry type of the target layer / of the GeoJSON content'),
+                ['Unknown','Point','LineString','Polygon','MultiPoint','MultiLineString','MultiPolygon','GeometryCollection','CircularString','CompoundCurve','CurvePolygon'],defaultValue=5)) # Only Works because these are ascending numerated in QGIS... NOT A GOOD SOLUTION!! But better than typing in a number by hand... see https://qgis.org/api/classQgsWkbTypes.html
+        self.addParameter(
+            QgsProcessingParameterCrs(
+                self.CRS, self.tr('CRS of the target layer / of the GeoJSON content'),'EPSG:4326')) # CRS of the targetlayer
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('new_geojson_layer'))) # Output
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Get Parameters and assign to variable to work with
+        source_layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
+        source_geojsonfield = self.parameterAsString(parameters, self.GEOJSON_FIELD, context)
+        #wkbgeometrytype = self.parameterAsInt(parameters, self.GEOMETRYTYPE_STRING, context)
+        wkbgeometrytype_fromenum = self.parameterAsInt(parameters, self.GEOMETRYTYPE_ENUM, context)
+        wkbgeometrytype = wkbgeometrytype_fromenum # testing assignment        
+        crsgeometry = self.parameterAsCrs(parameters, self.CRS, context)
+        
+        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
+        
+        source_fields = source_layer.fields() # get all fields of the sourcelayer
+        
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, source_fields, wkbgeometrytype, crsgeometry)
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+                                               
+            for current, feature in enumerate(source_layer.getFeatures()): # iterate over source 
+                # geoj is the string object that contains the GeoJSON
+                geoj = feature.attributes()[source_fields.indexFromName(source_geojsonfield)]
+                # PyQGIS has a parser class for JSON and GeoJSON
+                geojfeats = QgsJsonUtils.stringToFeatureList(geoj, QgsFields(), None)
+                # if there are features in the list
+                if len(geojfeats) > 0:
+                    new_geom = geojfeats[0].geometry()
+                    new_feat = QgsFeature(feature)
+                    new_feat.setGeometry(new_geom)
+                    writer.addFeature(new_feat) # add feature to the output
+            
+                if feedback.isCanceled(): # Cancel algorithm if button is pressed
+                    break
+            
+                feedback.setProgress(int(current * total)) # Set Progress in Progressbar
+        finally:
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+
+        return {self.OUTPUT: dest_id} # Return result of algorithm
+
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return GeometryLayerFromGeojsonStringField()
+
+    def name(self):
+        return 'GeometryLayerFromGeojsonStringField'
+
+    def displayName(self):
+        return self.tr('New Layer from GeoJSON String')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
         return self.tr('This Algorithm takes a source layer containing a GeoJSON as a String in a field and creates a copy of this layer with the geometry of this GeoJSON field')
\ No newline at end of file
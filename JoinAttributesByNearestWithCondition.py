@@ -1,234 +1,781 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-
-import operator, processing
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterString)
-
-class JoinAttributesByNearestWithCondition(QgsProcessingAlgorithm):
-    METHOD = 'METHOD'
-    SOURCE_LYR = 'SOURCE_LYR'
-    SOURCE_FIELD = 'SOURCE_FIELD'
-    SOURCE_EXPRESSION = 'SOURCE_EXPRESSION'
-    JOIN_LYR = 'JOIN_LYR'
-    JOIN_FIELDS = 'JOIN_FIELDS'
-    JOIN_FIELD = 'JOIN_FIELD'
-    JOIN_EXPRESSION = 'JOIN_EXPRESSION'
-    OPERATION = 'OPERATION'
-    JOIN_N = 'JOIN_N'
-    JOIN_DIST = 'JOIN_DIST'
-    JOIN_PREFIX = 'JOIN_PREFIX'
-    OUTPUT = 'OUTPUT'
-
-    def initAlgorithm(self, config=None):
-        
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.METHOD, self.tr('Choose method for calculation'), ['Source layer geometry to join layer geometry','Source layer centroid to join layer centroid'], defaultValue = 0, allowMultiple = False))
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.SOURCE_LYR, self.tr('Source Layer')))
-        self.addParameter(
-            QgsProcessingParameterExpression(
-                self.SOURCE_EXPRESSION, self.tr('Filter-Expression for Source-Layer'), parentLayerParameterName = 'SOURCE_LYR', optional = True))
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.JOIN_LYR, self.tr('Join Layer')))
-        self.addParameter(
-            QgsProcessingParameterExpression(
-                self.JOIN_EXPRESSION, self.tr('Filter-Expression for Join-Layer'), parentLayerParameterName = 'JOIN_LYR', optional = True))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.JOIN_FIELDS, self.tr('Add the following fields of join layer to result (if none are chosen, all fields will be added)'),parentLayerParameterName='JOIN_LYR', allowMultiple = True, optional = True))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.JOIN_N, self.tr('Join x nearest neighbors (0 means unlimited)'), type = 0, defaultValue = 3, minValue = 0, maxValue = 2147483647))
-        self.addParameter(
-            QgsProcessingParameterDistance(
-                self.JOIN_DIST, self.tr('Maximum join distance (0 means unlimited)'), parentParameterName = 'SOURCE_LYR', defaultValue = 0, minValue = 0, maxValue = 2147483647))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.JOIN_PREFIX, self.tr('Join Prefix'), defaultValue = 'join_', optional = True))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.SOURCE_FIELD, self.tr('Source Layer compare Field'),parentLayerParameterName='SOURCE_LYR', optional = True))
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.OPERATION, self.tr('Comparison operator (if no operator is set, the comparison fields remain unused) [optional]'), [None,'!=','=','<','>','<=','>=','is','not','is not','contains (join in source)'], defaultValue = 0, allowMultiple = False))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.JOIN_FIELD, self.tr('Join Layer compare Field'),parentLayerParameterName='JOIN_LYR', optional = True))
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT, self.tr('Joined Layer')))
-
-    def processAlgorithm(self, parameters, context, feedback):
-        method = self.parameterAsInt(parameters, self.METHOD, context)
-        source_layer = self.parameterAsSource(parameters, self.SOURCE_LYR, context)
-        source_field = self.parameterAsFields(parameters, self.SOURCE_FIELD, context)
-        if source_field:
-            source_field = source_field[0]
-        join_layer = self.parameterAsLayer(parameters, self.JOIN_LYR, context)
-        join_field = self.parameterAsFields(parameters, self.SOURCE_FIELD, context)
-        if join_field:
-            join_field = join_field[0]
-        join_fields = self.parameterAsFields(parameters, self.JOIN_FIELDS, context)
-        operation = self.parameterAsInt(parameters, self.OPERATION, context)
-        ops = { # get the operator by this index
-            0: None,
-            1: operator.ne,
-            2: operator.eq,
-            3: operator.lt,
-            4: operator.gt,
-            5: operator.le,
-            6: operator.ge,
-            7: operator.is_,
-            8: operator.not_,
-            9: operator.is_not,
-            10: operator.contains,
-            
-            }
-        op = ops[operation]
-        source_expression = self.parameterAsExpression(parameters, self.SOURCE_EXPRESSION, context)
-        source_expression = QgsExpression(source_expression)
-        join_expression = self.parameterAsExpression(parameters, self.JOIN_EXPRESSION, context)
-        join_expression = QgsExpression(join_expression)
-        join_n = self.parameterAsInt(parameters, self.JOIN_N, context)
-        join_dist = self.parameterAsDouble(parameters, self.JOIN_DIST, context)
-        join_prefix = self.parameterAsString(parameters, self.JOIN_PREFIX, context)
-        
-        sourcejoinlayerequal = False
-        if join_n == 0:
-            join_n =  2147483647 # float('inf') produces OverflowError: argument 'neighbors' overflowed: value must be in the range -2147483648 to 2147483647
-        if self.parameterAsLayer(parameters, self.SOURCE_LYR, context) == self.parameterAsLayer(parameters, self.JOIN_LYR, context):
-            join_n += 1
-            sourcejoinlayerequal = True
-        
-        source_layer_fields = source_layer.fields()
-        if join_fields:
-            join_layer = join_layer.materialize(QgsFeatureRequest().setSubsetOfAttributes(join_fields, join_layer.fields()))
-        join_layer_fields = join_layer.fields()
-        output_layer_fields = source_layer_fields
-        for join_layer_field in join_layer.fields():
-            join_layer_field_copy = join_layer_field
-            if join_prefix:
-                join_layer_field_copy.setName(join_prefix + join_layer_field_copy.name())
-            if join_layer_field_copy.name() in source_layer_fields.names():
-                join_layer_field_copy.setName(join_layer_field_copy.name() + '_2')
-            output_layer_fields.append(join_layer_field_copy)
-        join_dist_field_name = 'dist'
-        if join_prefix:
-            join_dist_field_name = join_prefix + join_dist_field_name
-        if join_dist_field_name in output_layer_fields.names():
-            join_dist_field_name = join_dist_field_name + '_2'
-        output_layer_fields.append(QgsField(join_dist_field_name, QVariant.Double, len=20, prec=5))
-        
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               output_layer_fields, source_layer.wkbType(),
-                                               source_layer.sourceCrs())
-        
-        if source_expression not in (QgsExpression(''),QgsExpression(None)):
-            source_layer = source_layer.materialize(QgsFeatureRequest(source_expression))
-        if join_expression not in (QgsExpression(''),QgsExpression(None)):
-            join_layer = join_layer.materialize(QgsFeatureRequest(join_expression))
-        
-        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0
-        
-        if source_layer.sourceCrs() != join_layer.sourceCrs():
-            reproject_params = {'INPUT': join_layer, 'TARGET_CRS': source_layer.sourceCrs(), 'OUTPUT': 'memory:Reprojected'}
-            reproject_result = processing.run('native:reprojectlayer', reproject_params)
-            join_layer = reproject_result['OUTPUT']
-        if method == 1:
-            centroid_params = { 'ALL_PARTS' : False, 'INPUT' : join_layer, 'OUTPUT' : 'memory:Centroids' }
-            centroid_result = processing.run("native:centroids", centroid_params)
-            join_layer = centroid_result['OUTPUT']
-        
-        join_layer_idx = QgsSpatialIndex(join_layer.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
-        
-        for current, source_feat in enumerate(source_layer.getFeatures()):
-            if feedback.isCanceled():
-                break
-            matches_found_counter = 0
-            
-            if method == 0:
-                source_feat_geom = source_feat.geometry()
-            elif method == 1:
-                source_feat_geom = source_feat.geometry().centroid()
-                
-            if op is None:
-                nearest_neighbors = join_layer_idx.nearestNeighbor(source_feat_geom, neighbors = join_n, maxDistance = join_dist)
-            else:
-                nearest_neighbors = join_layer_idx.nearestNeighbor(source_feat_geom, neighbors = -1, maxDistance = join_dist)
-                
-            for i, join_feat_id in enumerate(nearest_neighbors):
-                if feedback.isCanceled():
-                    break
-                if matches_found_counter >= join_n:
-                    break
-                if sourcejoinlayerequal == True and i == 0:
-                    continue
-                join_feat = join_layer.getFeature(join_feat_id)
-                if op is None:
-                    matches_found_counter += 1
-                    new_feat = QgsFeature(output_layer_fields)
-                    new_feat.setGeometry(source_feat.geometry())
-                    attridx = 0
-                    for attr in source_feat.attributes():
-                        new_feat[attridx] = attr
-                        attridx += 1
-                    for attr in join_feat.attributes():
-                        new_feat[attridx] = attr
-                        attridx += 1
-                    new_feat[join_dist_field_name] = source_feat_geom.distance(join_feat.geometry())
-                    sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-                elif op(source_feat[source_field], join_feat[join_field]):
-                    matches_found_counter += 1
-                    new_feat = QgsFeature(output_layer_fields)
-                    new_feat.setGeometry(source_feat.geometry())
-                    attridx = 0
-                    for attr in source_feat.attributes():
-                        new_feat[attridx] = attr
-                        attridx += 1
-                    for attr in join_feat.attributes():
-                        new_feat[attridx] = attr
-                        attridx += 1
-                    new_feat[join_dist_field_name] = source_feat_geom.distance(join_feat.geometry())
-                    sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-                
-            if matches_found_counter == 0:
-                new_feat = QgsFeature(output_layer_fields)
-                new_feat.setGeometry(source_feat.geometry())
-                attridx = 0
-                for attr in source_feat.attributes():
-                    new_feat[attridx] = attr
-                    attridx += 1
-                sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-                    
-            feedback.setProgress(int(current * total))
-            
-
-        return {self.OUTPUT: dest_id}
-
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return JoinAttributesByNearestWithCondition()
-
-    def name(self):
-        return 'JoinAttributesByNearestWithCondition'
-
-    def displayName(self):
-        return self.tr('Join attributes by nearest with condition')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
-        return self.tr('This Algorithm finds the x nearest neighbors by a given condition and joins them.')
\ No newline at end of file
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+import collections, glob, hashlib, itertools, math, multiprocessing, operator, os, pickle, queue, sys, time, traceback, zlib
+import numpy as np
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (NULL, QgsApplication, QgsDistanceArea, QgsField, QgsFeature, QgsGeometry, QgsPointXY, QgsProcessing, QgsExpression, QgsProviderRegistry, QgsSpatialIndex,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterBoolean, QgsProcessingParameterField, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterString)
+
+def run_blocks_in_workers(search_block, blocks, n_workers, feedback):
+    # Yields search_block(block) for every block in the order of blocks, computed by n_workers forked processes.
+    # Forking shares everything search_block refers to (spatial index, attribute columns) read-only with the workers, nothing is pickled except the block numbers and the results.
+    # The workers take the next block from a shared queue, so a slow block only holds up one worker, and at most 2 * n_workers blocks are handed
+    # out ahead of the block yielded next, which limits the results waiting in memory. Ends early on cancel and raises if a worker fails or dies
+    # (e.g. killed by the system). Closing the generator early terminates all workers.
+    ctx = multiprocessing.get_context('fork')
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    def work():
+        try:
+            for block_nr in iter(tasks.get, None):
+                results.put((block_nr, search_block(blocks[block_nr]), None))
+        except Exception:
+            results.put((-1, None, traceback.format_exc())) # hand the error over to the main process instead of leaving it waiting
+    workers = [ctx.Process(target=work, daemon=True) for worker_nr in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    n_handed_out = 0
+    finished = {} # results arriving before their turn
+    try:
+        for block_nr in range(len(blocks)):
+            while n_handed_out < min(len(blocks), block_nr + 2 * n_workers):
+                tasks.put(n_handed_out)
+                n_handed_out += 1
+            while block_nr not in finished:
+                try:
+                    finished_nr, result, error = results.get(timeout=0.1)
+                except queue.Empty:
+                    if feedback.isCanceled():
+                        return
+                    for worker in workers:
+                        if worker.exitcode is not None: # workers only end when they are terminated
+                            raise QgsProcessingException('Worker process ended unexpectedly (exit code {}).'.format(worker.exitcode))
+                    continue
+                if error is not None:
+                    raise QgsProcessingException('Worker process failed:\n' + error)
+                finished[finished_nr] = result
+            yield finished.pop(block_nr)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+def nearest_neighbors_lazy(index, geometry, max_distance, first_n):
+    # Yields the feature ids of the index ordered by their distance to geometry.
+    # Starts with the first_n nearest and only asks the index for more (four times as many each time) when the caller keeps on iterating.
+    n = max(first_n, 1)
+    returned = set()
+    while True:
+        neighbors = index.nearestNeighbor(geometry, neighbors = n, maxDistance = max_distance)
+        for fid in neighbors:
+            if fid not in returned:
+                returned.add(fid)
+                yield fid
+        if len(neighbors) < n or n >= 2147483647: # the index has no more features within max_distance
+            break
+        n = min(n * 4, 2147483647)
+
+def partition_key(value):
+    # Key of a join field value in the partitioned index, NULL values are all grouped together
+    if value is None or value == NULL:
+        return None
+    return value
+
+def ellipsoid_distances(lon1, lat1, lon2, lat2, a, b):
+    # Vincenty's inverse formula for arrays of coordinates in degrees on the ellipsoid with the semi-axes a and b, distances in the unit of a (meters).
+    # Returns nan where the iteration does not converge (nearly antipodal points).
+    f = (a - b) / a
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sinU1, cosU1, sinU2, cosU2 = np.sin(U1), np.cos(U1), np.sin(U2), np.cos(U2)
+    lam = L
+    with np.errstate(invalid='ignore', divide='ignore'): # coincident points divide 0 by 0, their results are replaced below
+        for _ in range(200):
+            sinLam, cosLam = np.sin(lam), np.cos(lam)
+            sinSigma = np.sqrt((cosU2 * sinLam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * cosLam) ** 2)
+            cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+            sigma = np.arctan2(sinSigma, cosSigma)
+            sinAlpha = np.where(sinSigma == 0, 0.0, cosU1 * cosU2 * sinLam / sinSigma)
+            cos2Alpha = 1 - sinAlpha ** 2
+            cos2SigmaM = np.where(cos2Alpha == 0, 0.0, cosSigma - 2 * sinU1 * sinU2 / cos2Alpha) # points on the equator
+            C = f / 16 * cos2Alpha * (4 + f * (4 - 3 * cos2Alpha))
+            lam_before = lam
+            lam = L + (1 - C) * f * sinAlpha * (sigma + C * sinSigma * (cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM ** 2)))
+            converged = np.abs(lam - lam_before) < 1e-12
+            if converged.all():
+                break
+    uSq = cos2Alpha * (a * a - b * b) / (b * b)
+    A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+    B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+    deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (cosSigma * (-1 + 2 * cos2SigmaM ** 2) - B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+    return np.where(converged, b * A * (sigma - deltaSigma), np.nan)
+
+def geodesic_lower_bound(degrees, max_lon, max_lat, a, b):
+    # Lower bound (meters) of the ellipsoidal distance to every point that is at least `degrees` away in planar lon/lat coordinates
+    # from a geometry whose coordinates are within +-max_lon and +-max_lat. A point that far away differs by at least half of it
+    # in latitude or by at least sin(60 deg) of it in longitude. The first is bounded by the smallest meridional radius of curvature,
+    # the second by the chord between both points projected onto the equatorial plane, taken at the latitude that minimizes the bound.
+    meridional_radius = b * b / a
+    if degrees <= 0:
+        return 0.0
+    by_latitude = meridional_radius * math.radians(degrees / 2)
+    lon_difference = min(degrees * math.sqrt(3) / 2, 180 - max_lon) # longitudes wrap around at the antimeridian
+    if lon_difference <= 0 or max_lat >= 90:
+        return 0.0
+    chord = 2 * a * math.sin(math.radians(lon_difference) / 2)
+    low, high = 0.0, 90 - max_lat # latitude difference where the meridional arc reaches the chord, which shrinks towards the poles
+    for _ in range(40):
+        middle = (low + high) / 2
+        if meridional_radius * math.radians(middle) < chord * math.cos(math.radians(max_lat + middle)):
+            low = middle
+        else:
+            high = middle
+    return min(by_latitude, meridional_radius * math.radians(low))
+
+PAIR_DISTANCE_CACHE_SIZE = 100000 # ellipsoidal distances of self join pairs kept for the reverse pair
+
+class PairDistanceCache:
+    # Ellipsoidal distances of self join pairs by (lower id, higher id). With a symmetric condition the distance computed for the first
+    # feature of a pair is taken by the second one, an entry is removed when it is taken and the oldest ones are dropped beyond max_size.
+    def __init__(self, max_size=PAIR_DISTANCE_CACHE_SIZE):
+        self.distances = collections.OrderedDict()
+        self.max_size = max_size
+
+    def take(self, fid1, fid2):
+        return self.distances.pop((min(fid1, fid2), max(fid1, fid2)), None) # each pair is needed at most twice
+
+    def put(self, fid1, fid2, distance):
+        self.distances[(min(fid1, fid2), max(fid1, fid2))] = distance
+        if len(self.distances) > self.max_size:
+            self.distances.popitem(last=False)
+
+def nearest_geodesic(neighbors, source_geom, join_geoms, is_match, index_distance, n, max_distance, ellipsoid, distance_area, source_id=None, pair_distances=None):
+    # Returns up to n (id, ellipsoidal distance) of the matching join features within max_distance (0 = unlimited) meters, nearest first.
+    # neighbors yields the ids ordered by their planar distance in degrees (index_distance), they are taken in growing batches
+    # until no feature further away in degrees can be nearer on the ellipsoid than the n-th match found so far.
+    # The distance of two geometries is measured between their nearest points in lon/lat. In a self join the distances are taken from
+    # and added to pair_distances (PairDistanceCache) under the ids of source_id and the join feature.
+    a, b = ellipsoid
+    bbox = source_geom.boundingBox()
+    max_lon = max(abs(bbox.xMinimum()), abs(bbox.xMaximum()))
+    max_lat = max(abs(bbox.yMinimum()), abs(bbox.yMaximum()))
+    neighbors = iter(neighbors)
+    results = []
+    batch_size = max(min(n, 2147483647), 1)
+    while True:
+        batch = list(itertools.islice(neighbors, batch_size))
+        if not batch:
+            break
+        ids = []
+        points = []
+        for fid in batch:
+            if is_match(fid):
+                if pair_distances is not None:
+                    distance = pair_distances.take(source_id, fid)
+                    if distance is not None:
+                        results.append((fid, distance))
+                        continue
+                line = source_geom.shortestLine(join_geoms[fid])
+                start, end = line.vertexAt(0), line.vertexAt(1)
+                ids.append(fid)
+                points.append((start.x(), start.y(), end.x(), end.y()))
+        if ids:
+            points = np.array(points, dtype=float)
+            distances = ellipsoid_distances(points[:, 0], points[:, 1], points[:, 2], points[:, 3], a, b)
+            for i in np.flatnonzero(np.isnan(distances)): # Vincenty did not converge
+                distances[i] = distance_area.measureLine(QgsPointXY(points[i, 0], points[i, 1]), QgsPointXY(points[i, 2], points[i, 3]))
+            results.extend(zip(ids, distances.tolist()))
+            if pair_distances is not None:
+                for fid, distance in zip(ids, distances.tolist()):
+                    pair_distances.put(source_id, fid, distance)
+        results.sort(key=lambda result: result[1])
+        if len(batch) < batch_size: # no more neighbors
+            break
+        bound = geodesic_lower_bound(index_distance(batch[-1]), max_lon, max_lat, a, b)
+        if max_distance and bound > max_distance:
+            break
+        if len(results) >= n and results[n - 1][1] <= bound:
+            break
+        batch_size = min(batch_size * 4, 2147483647)
+    return [(fid, distance) for fid, distance in results if not max_distance or distance <= max_distance][:n]
+
+def read_join_features(layer, attribute_names, compare_field, expression, destination_crs, transform_context, centroids):
+    # Reads the join layer in one pass instead of materializing copies for each step: only the needed attributes,
+    # filtered by the expression, transformed to destination_crs and reduced to centroids if requested.
+    # Yields (feature id, geometry, attributes to join, value of compare_field), features without geometry can never be a neighbor and are skipped.
+    fields = layer.fields()
+    attribute_indices = [fields.indexOf(name) for name in attribute_names]
+    request = QgsFeatureRequest()
+    columns = set(attribute_names)
+    if compare_field:
+        columns.add(compare_field)
+    if expression is not None:
+        request.setFilterExpression(expression.expression())
+        columns.update(expression.referencedColumns())
+    if QgsFeatureRequest.ALL_ATTRIBUTES not in columns:
+        request.setSubsetOfAttributes(list(columns), fields)
+    if destination_crs is not None:
+        request.setDestinationCrs(destination_crs, transform_context)
+    for feat in layer.getFeatures(request):
+        geom = feat.geometry()
+        if geom.isNull() or geom.isEmpty():
+            continue
+        if centroids:
+            geom = geom.centroid()
+        attrs = feat.attributes()
+        yield feat.id(), geom, [attrs[i] for i in attribute_indices], feat[compare_field] if compare_field else None
+
+def delimited_text(values, delimiter):
+    # Joins the values to one text for the aggregated output, NULL values stay empty
+    return delimiter.join('' if value is None or value == NULL else str(value) for value in values)
+
+def array_values(values):
+    # List of the values for an array field of the aggregated output
+    return [None if value is None or value == NULL else value for value in values]
+
+class RowBuilder:
+    # Output layout computed once: the attributes of an output feature are the concatenation of lists of values
+    # (e.g. source attributes + joined attributes + computed values) set at once, missing values at the end stay NULL.
+    def __init__(self, fields):
+        self.fields = fields
+        self.n_fields = fields.count()
+
+    def feature(self, geometry, *parts):
+        row = list(itertools.chain.from_iterable(parts))
+        if len(row) < self.n_fields:
+            row.extend([None] * (self.n_fields - len(row)))
+        feature = QgsFeature(self.fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes(row)
+        return feature
+
+INDEX_CACHE_MAX_BYTES = 2 * 1024 ** 3 # the least recently used cached indexes are removed when all of them together get larger
+
+def index_cache_key(layer, *identity):
+    # Key of the cached index of a layer: data source, subset string, modification stamps of the files behind the source and whatever else
+    # changes the content of the index (fields, filter, crs...). Returns None if the source is no local file or the layer has unsaved edits,
+    # their changes could not be detected.
+    if layer.isEditable() and layer.isModified():
+        return None
+    path = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source()).get('path')
+    if not path or not os.path.isfile(path):
+        return None
+    stamps = []
+    for file_path in sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + '*')): # sidecar files too, e.g. the .dbf of a shapefile or the -wal of a geopackage
+        stat = os.stat(file_path)
+        stamps.append('{}:{}:{}'.format(os.path.basename(file_path), stat.st_mtime_ns, stat.st_size))
+    key = [layer.source(), layer.subsetString()] + stamps + [str(value) for value in identity]
+    return hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()
+
+def index_cache_path(key):
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'cache', 'spatial_index', key + '.pickle')
+
+def load_index_cache(key):
+    # Returns the cached records [(fid, geometry, [values])] of the key or None if there are none
+    path = index_cache_path(key)
+    try:
+        with open(path, 'rb') as cache_file:
+            records = pickle.loads(zlib.decompress(cache_file.read()))
+        os.utime(path) # the modification time tells which entry has been used least recently
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError, zlib.error):
+        return None
+    result = []
+    for fid, wkb, values in records:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        result.append((fid, geometry, [NULL if value is None else value for value in values]))
+    return result
+
+def store_index_cache(key, records):
+    # Stores the records [(fid, geometry, [values])] under the key and removes the least recently used entries if the cache got too large.
+    # Returns False if the values can not be stored (attribute types pickle does not know).
+    records = [(fid, bytes(geometry.asWkb()), [None if isinstance(value, QVariant) and value.isNull() else value for value in values]) for fid, geometry, values in records]
+    try:
+        data = zlib.compress(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return False
+    path = index_cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as cache_file:
+        cache_file.write(data)
+    os.replace(path + '.tmp', path) # never leave a half written entry behind
+    entries = []
+    for entry in glob.glob(os.path.join(os.path.dirname(path), '*.pickle')):
+        try:
+            stat = os.stat(entry)
+        except OSError: # removed by another run in the meantime
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry in sorted(entries):
+        if size <= INDEX_CACHE_MAX_BYTES:
+            break
+        if entry != path:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            size -= entry_size
+    return True
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class JoinAttributesByNearestWithCondition(QgsProcessingAlgorithm):
+    METHOD = 'METHOD'
+    SOURCE_LYR = 'SOURCE_LYR'
+    SOURCE_FIELD = 'SOURCE_FIELD'
+    SOURCE_EXPRESSION = 'SOURCE_EXPRESSION'
+    JOIN_LYR = 'JOIN_LYR'
+    JOIN_FIELDS = 'JOIN_FIELDS'
+    JOIN_FIELD = 'JOIN_FIELD'
+    JOIN_EXPRESSION = 'JOIN_EXPRESSION'
+    OPERATION = 'OPERATION'
+    JOIN_N = 'JOIN_N'
+    JOIN_DIST = 'JOIN_DIST'
+    DISTANCE_MODE = 'DISTANCE_MODE'
+    JOIN_PREFIX = 'JOIN_PREFIX'
+    OUTPUT_MODE = 'OUTPUT_MODE'
+    DELIMITER = 'DELIMITER'
+    ADD_STATISTICS = 'ADD_STATISTICS'
+    USE_INDEX_CACHE = 'USE_INDEX_CACHE'
+    WORKERS = 'WORKERS'
+    OUTPUT = 'OUTPUT'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.METHOD, self.tr('Choose method for calculation'), ['Source layer geometry to join layer geometry','Source layer centroid to join layer centroid'], defaultValue = 0, allowMultiple = False))
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.SOURCE_LYR, self.tr('Source Layer')))
+        self.addParameter(
+            QgsProcessingParameterExpression(
+                self.SOURCE_EXPRESSION, self.tr('Filter-Expression for Source-Layer'), parentLayerParameterName = 'SOURCE_LYR', optional = True))
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.JOIN_LYR, self.tr('Join Layer')))
+        self.addParameter(
+            QgsProcessingParameterExpression(
+                self.JOIN_EXPRESSION, self.tr('Filter-Expression for Join-Layer'), parentLayerParameterName = 'JOIN_LYR', optional = True))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.JOIN_FIELDS, self.tr('Add the following fields of join layer to result (if none are chosen, all fields will be added)'),parentLayerParameterName='JOIN_LYR', allowMultiple = True, optional = True))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.JOIN_N, self.tr('Join x nearest neighbors (0 means unlimited)'), type = 0, defaultValue = 3, minValue = 0, maxValue = 2147483647))
+        self.addParameter(
+            QgsProcessingParameterDistance(
+                self.JOIN_DIST, self.tr('Maximum join distance (0 means unlimited), in meters for ellipsoidal distances, otherwise in units of the source layer CRS'), parentParameterName = 'SOURCE_LYR', defaultValue = 0, minValue = 0, maxValue = 2147483647))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.DISTANCE_MODE, self.tr('Distances'), ['Planar (units of the source layer CRS)','Ellipsoidal in meters (only for a source layer in a geographic CRS like EPSG:4326)'], defaultValue = 0, allowMultiple = False))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.JOIN_PREFIX, self.tr('Join Prefix'), defaultValue = 'join_', optional = True))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.SOURCE_FIELD, self.tr('Source Layer compare Field'),parentLayerParameterName='SOURCE_LYR', optional = True))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OPERATION, self.tr('Comparison operator (if no operator is set, the comparison fields remain unused) [optional]'), [None,'!=','=','<','>','<=','>=','is','not','is not','contains (join in source)'], defaultValue = 0, allowMultiple = False))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.JOIN_FIELD, self.tr('Join Layer compare Field'),parentLayerParameterName='JOIN_LYR', optional = True))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUT_MODE, self.tr('Output'), ['One feature per match','One feature per source feature, values of the matches as delimited text','One feature per source feature, values of the matches as arrays'], defaultValue = 0, allowMultiple = False))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.DELIMITER, self.tr('Delimiter of the values as delimited text'), defaultValue = ';', optional = True))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.ADD_STATISTICS, self.tr('Add number of matches, minimum and mean distance'), defaultValue = False))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_INDEX_CACHE, self.tr('Keep the index of the join layer in a cache in the QGIS profile and reuse it as long as the file of the join layer is unchanged (may use up to 2 GB of disk space)'), defaultValue = False))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of parallel worker processes (1 = no parallelization, 0 = use all CPU cores)'), type = 0, defaultValue = 1, minValue = 0))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('Joined Layer')))
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        method = self.parameterAsInt(parameters, self.METHOD, context)
+        source_layer = self.parameterAsSource(parameters, self.SOURCE_LYR, context)
+        source_field = self.parameterAsFields(parameters, self.SOURCE_FIELD, context)
+        if source_field:
+            source_field = source_field[0]
+        join_layer = self.parameterAsLayer(parameters, self.JOIN_LYR, context)
+        join_field = self.parameterAsFields(parameters, self.JOIN_FIELD, context)
+        if join_field:
+            join_field = join_field[0]
+        join_fields = self.parameterAsFields(parameters, self.JOIN_FIELDS, context)
+        operation = self.parameterAsInt(parameters, self.OPERATION, context)
+        ops = { # get the operator by this index
+            0: None,
+            1: operator.ne,
+            2: operator.eq,
+            3: operator.lt,
+            4: operator.gt,
+            5: operator.le,
+            6: operator.ge,
+            7: operator.is_,
+            8: operator.not_,
+            9: operator.is_not,
+            10: operator.contains,
+            
+            }
+        op = ops[operation]
+        source_expression = self.parameterAsExpression(parameters, self.SOURCE_EXPRESSION, context)
+        source_expression = QgsExpression(source_expression)
+        join_expression = self.parameterAsExpression(parameters, self.JOIN_EXPRESSION, context)
+        join_expression = QgsExpression(join_expression)
+        join_n = self.parameterAsInt(parameters, self.JOIN_N, context)
+        join_dist = self.parameterAsDouble(parameters, self.JOIN_DIST, context)
+        distance_mode = self.parameterAsInt(parameters, self.DISTANCE_MODE, context)
+        join_prefix = self.parameterAsString(parameters, self.JOIN_PREFIX, context)
+        output_mode = self.parameterAsInt(parameters, self.OUTPUT_MODE, context)
+        delimiter = self.parameterAsString(parameters, self.DELIMITER, context)
+        add_statistics = self.parameterAsBool(parameters, self.ADD_STATISTICS, context)
+        use_index_cache = self.parameterAsBool(parameters, self.USE_INDEX_CACHE, context)
+        n_workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        if n_workers == 0:
+            n_workers = os.cpu_count() or 1
+        if n_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            feedback.pushInfo(self.tr('Parallel processing needs the fork start method, which is not available on this platform. Continuing with one process.'))
+            n_workers = 1
+        blocksize = 1000 # number of source features handed to a worker at once
+        
+        if join_n == 0:
+            join_n =  2147483647 # float('inf') produces OverflowError: argument 'neighbors' overflowed: value must be in the range -2147483648 to 2147483647
+        query_n = join_n
+        self_join = False
+        if self.parameterAsLayer(parameters, self.SOURCE_LYR, context) == self.parameterAsLayer(parameters, self.JOIN_LYR, context):
+            self_join = True # a feature is never joined to itself, it is excluded by its id (not by its position, features may share their coordinates)
+            query_n = min(join_n + 1, 2147483647) # one more neighbor as the feature itself is among them
+        
+        source_layer_fields = source_layer.fields()
+        if not join_fields:
+            join_fields = join_layer.fields().names()
+        output_layer_fields = source_layer_fields
+        for join_field_name in join_fields:
+            join_layer_field_copy = QgsField(join_layer.fields().field(join_field_name))
+            if output_mode == 1: # the values of all matches as text
+                join_layer_field_copy = QgsField(join_layer_field_copy.name(), QVariant.String)
+            elif output_mode == 2 and join_layer_field_copy.type() == QVariant.String:
+                join_layer_field_copy = QgsField(join_layer_field_copy.name(), QVariant.StringList, subType = QVariant.String)
+            elif output_mode == 2:
+                join_layer_field_copy = QgsField(join_layer_field_copy.name(), QVariant.List, subType = join_layer_field_copy.type())
+            if join_prefix:
+                join_layer_field_copy.setName(join_prefix + join_layer_field_copy.name())
+            if join_layer_field_copy.name() in source_layer_fields.names():
+                join_layer_field_copy.setName(join_layer_field_copy.name() + '_2')
+            output_layer_fields.append(join_layer_field_copy)
+        join_dist_field_name = 'dist'
+        if join_prefix:
+            join_dist_field_name = join_prefix + join_dist_field_name
+        if join_dist_field_name in output_layer_fields.names():
+            join_dist_field_name = join_dist_field_name + '_2'
+        if output_mode == 0:
+            output_layer_fields.append(QgsField(join_dist_field_name, QVariant.Double, len=20, prec=5))
+        elif output_mode == 1:
+            output_layer_fields.append(QgsField(join_dist_field_name, QVariant.String))
+        elif output_mode == 2:
+            output_layer_fields.append(QgsField(join_dist_field_name, QVariant.List, subType = QVariant.Double))
+        if add_statistics:
+            for statistics_field_name, statistics_field_type in (('n', QVariant.Int), ('dist_min', QVariant.Double), ('dist_mean', QVariant.Double)):
+                if join_prefix:
+                    statistics_field_name = join_prefix + statistics_field_name
+                if statistics_field_name in output_layer_fields.names():
+                    statistics_field_name = statistics_field_name + '_2'
+                output_layer_fields.append(QgsField(statistics_field_name, statistics_field_type))
+        
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               output_layer_fields, source_layer.wkbType(),
+                                               source_layer.sourceCrs())
+        source_request = QgsFeatureRequest()
+        if source_expression not in (QgsExpression(''),QgsExpression(None)): # filtered while reading, a materialized copy would have other feature ids
+            source_request = QgsFeatureRequest(source_expression)
+        if join_expression in (QgsExpression(''),QgsExpression(None)):
+            join_expression = None
+        
+        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0
+        
+        geodesic = False
+        pair_distances = None
+        if distance_mode == 1 and source_layer.sourceCrs().isGeographic():
+            geodesic = True # distances in meters on the ellipsoid, the maximum join distance is in meters too
+            distance_area = QgsDistanceArea()
+            distance_area.setSourceCrs(source_layer.sourceCrs(), context.transformContext())
+            if not distance_area.setEllipsoid(context.ellipsoid()) or not distance_area.willUseEllipsoid():
+                distance_area.setEllipsoid('EPSG:7030') # WGS 84
+            ellipsoid = (distance_area.ellipsoidSemiMajor(), distance_area.ellipsoidSemiMinor())
+            if self_join and op in (None, operator.eq, operator.ne, operator.is_, operator.is_not): # a matches b if b matches a, so most pairs are measured twice
+                pair_distances = PairDistanceCache()
+        elif distance_mode == 1:
+            feedback.pushInfo(self.tr('The source layer is not in a geographic CRS, the distances are measured in its units.'))
+        
+        join_crs = None
+        if source_layer.sourceCrs() != join_layer.sourceCrs():
+            join_crs = source_layer.sourceCrs()
+        
+        # Read the join layer once: subset, filter, reprojection and centroids are applied while the index is built
+        join_geoms = {}
+        join_attrs = {}
+        join_values = {}
+        join_layer_idx = None
+        partition_idx = None
+        if op is operator.eq: # one index per value of the join field: the nearest features of the index with the source value are matches already
+            partition_idx = {}
+        else:
+            join_layer_idx = QgsSpatialIndex(flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+        compare_field = join_field if op is not None else None
+        cache_key = None
+        join_records = None
+        if use_index_cache:
+            cache_key = index_cache_key(join_layer, join_fields, compare_field, join_expression.expression() if join_expression is not None else '',
+                                        source_layer.sourceCrs().toWkt(), method == 1)
+            if cache_key is not None:
+                join_records = load_index_cache(cache_key)
+            else:
+                feedback.pushInfo(self.tr('The index of the join layer is not cached, the join layer has unsaved edits or is not read from a local file.'))
+        read_from_cache = join_records is not None
+        if read_from_cache:
+            feedback.pushInfo(self.tr('Index of the join layer read from the cache.'))
+            join_records = ((fid, geom, values[:-1], values[-1]) for fid, geom, values in join_records)
+        else:
+            join_records = read_join_features(join_layer, join_fields, compare_field, join_expression, join_crs, context.transformContext(), method == 1)
+        for join_feat_id, join_geom, attrs, value in join_records:
+            if feedback.isCanceled():
+                break
+            join_geoms[join_feat_id] = join_geom
+            join_attrs[join_feat_id] = attrs
+            join_values[join_feat_id] = value
+            index_feat = QgsFeature(join_feat_id)
+            index_feat.setGeometry(join_geom)
+            if partition_idx is not None:
+                try:
+                    key = partition_key(value)
+                    if key not in partition_idx:
+                        partition_idx[key] = QgsSpatialIndex(flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+                    partition_idx[key].addFeature(index_feat)
+                    continue
+                except TypeError: # values that can not be used as a key, use a single index and compare
+                    partition_idx = None
+                    join_layer_idx = QgsSpatialIndex(flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+                    for read_id, read_geom in join_geoms.items():
+                        if read_id != join_feat_id:
+                            read_feat = QgsFeature(read_id)
+                            read_feat.setGeometry(read_geom)
+                            join_layer_idx.addFeature(read_feat)
+            join_layer_idx.addFeature(index_feat)
+        
+        if cache_key is not None and not read_from_cache and not feedback.isCanceled():
+            if not store_index_cache(cache_key, [(fid, join_geoms[fid], join_attrs[fid] + [join_values[fid]]) for fid in join_geoms]):
+                feedback.pushInfo(self.tr('The index of the join layer can not be cached, the join layer has attribute types that can not be stored.'))
+        
+        def find_matches(source_feat_id, source_feat_geom, source_value): # returns (id, distance) of the matching join features, nearest first
+            if partition_idx is not None:
+                try:
+                    index = partition_idx.get(partition_key(source_value))
+                except TypeError:
+                    index = None
+            else:
+                index = join_layer_idx
+            
+            if index is None: # no join feature with this value
+                nearest_neighbors = []
+            elif geodesic: # the index is in degrees, it only delivers the candidates ordered by their planar distance
+                nearest_neighbors = nearest_neighbors_lazy(index, source_feat_geom, 0, query_n)
+            elif op is None or partition_idx is not None:
+                nearest_neighbors = index.nearestNeighbor(source_feat_geom, neighbors = query_n, maxDistance = join_dist)
+            else: # walk through the neighbors by distance until enough matches are found
+                nearest_neighbors = nearest_neighbors_lazy(index, source_feat_geom, join_dist, query_n)
+            
+            if geodesic:
+                def is_match(join_feat_id):
+                    if self_join and join_feat_id == source_feat_id:
+                        return False
+                    return op is None or op(source_value, join_values[join_feat_id])
+                return nearest_geodesic(nearest_neighbors, source_feat_geom, join_geoms, is_match, lambda join_feat_id: source_feat_geom.distance(join_geoms[join_feat_id]),
+                                        join_n, join_dist, ellipsoid, distance_area, source_feat_id, pair_distances)
+            matches = []
+            for join_feat_id in nearest_neighbors:
+                if len(matches) >= join_n:
+                    break
+                if self_join and join_feat_id == source_feat_id:
+                    continue
+                if op is None or op(source_value, join_values[join_feat_id]):
+                    matches.append((join_feat_id, source_feat_geom.distance(join_geoms[join_feat_id])))
+            return matches
+        
+        if n_workers > 1:
+            # read the source features once: the worker processes find them in memory, the features are only requested again for writing
+            source_geoms = {}
+            source_values = {}
+            blocks = [[]]
+            for source_feat in source_layer.getFeatures(source_request):
+                if method == 0:
+                    source_geoms[source_feat.id()] = source_feat.geometry()
+                elif method == 1:
+                    source_geoms[source_feat.id()] = source_feat.geometry().centroid()
+                source_values[source_feat.id()] = source_feat[source_field] if op is not None else None
+                if len(blocks[-1]) >= blocksize:
+                    blocks.append([])
+                blocks[-1].append(source_feat.id())
+                if feedback.isCanceled():
+                    return {}
+            
+            def search_block(block): # returns (id, matches) for every source feature of the block
+                return [(source_feat_id, find_matches(source_feat_id, source_geoms[source_feat_id], source_values[source_feat_id])) for source_feat_id in block]
+            
+            block_results = run_blocks_in_workers(search_block, blocks, n_workers, feedback)
+        
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+            rows = RowBuilder(output_layer_fields) # source attributes + join attributes + distance + statistics
+            no_match = [None] * (len(join_fields) + 1) # join attributes and distance of a source feature without a match
+            results = {}
+            for current, source_feat in enumerate(source_layer.getFeatures(source_request)): # write in the order of the source layer
+                if feedback.isCanceled():
+                    break
+                if n_workers > 1:
+                    while source_feat.id() not in results:
+                        try:
+                            block = next(block_results) # get the results of the next block
+                        except StopIteration: # the workers have been stopped on cancel or the layer returned a feature that has not been read before, it has been changed meanwhile
+                            if feedback.isCanceled():
+                                break
+                            raise QgsProcessingException(self.tr('Feature {} has not been read before, the source layer has been changed while the algorithm was running.').format(source_feat.id()))
+                        for source_feat_id, matches in block:
+                            results[source_feat_id] = matches
+                    if source_feat.id() not in results: # canceled
+                        break
+                    matches = results.pop(source_feat.id())
+                else: # search while streaming the source features, nothing is kept in memory
+                    matches = find_matches(source_feat.id(), source_feat.geometry() if method == 0 else source_feat.geometry().centroid(), source_feat[source_field] if op is not None else None)
+            
+                statistics = []
+                if add_statistics:
+                    distances = [distance for join_feat_id, distance in matches]
+                    statistics = [len(matches), min(distances) if distances else NULL, sum(distances) / len(distances) if distances else NULL]
+            
+                if output_mode == 0: # one feature per match
+                    for join_feat_id, distance in matches:
+                        writer.addFeature(rows.feature(source_feat.geometry(), source_feat.attributes(), join_attrs[join_feat_id], [distance], statistics))
+                    if not matches:
+                        writer.addFeature(rows.feature(source_feat.geometry(), source_feat.attributes(), no_match, statistics))
+                elif matches: # one feature per source feature with the values of all matches
+                    aggregated = []
+                    for join_attr_nr in range(len(join_fields)):
+                        values = [join_attrs[join_feat_id][join_attr_nr] for join_feat_id, distance in matches]
+                        aggregated.append(delimited_text(values, delimiter) if output_mode == 1 else array_values(values))
+                    distances = [round(distance, 5) for join_feat_id, distance in matches]
+                    aggregated.append(delimited_text(distances, delimiter) if output_mode == 1 else distances)
+                    writer.addFeature(rows.feature(source_feat.geometry(), source_feat.attributes(), aggregated, statistics))
+                else:
+                    writer.addFeature(rows.feature(source_feat.geometry(), source_feat.attributes(), no_match, statistics))
+                    
+                feedback.setProgress(int(current * total))
+        finally:
+            if n_workers > 1:
+                block_results.close() # stops the worker processes if the algorithm has been canceled
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+
+        return {self.OUTPUT: dest_id}
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return JoinAttributesByNearestWithCondition()
+
+    def name(self):
+        return 'JoinAttributesByNearestWithCondition'
+
+    def displayName(self):
+        return self.tr('Join attributes by nearest with condition')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
+        return self.tr('This Algorithm finds the x nearest neighbors by a given condition and joins them. '
+            'Every match can be written as a feature of its own, or all matches of a source feature are aggregated to one feature with their values and distances as delimited text or as arrays (not supported by every file format, e.g. shapefiles). '
+            'For a source layer in a geographic CRS the distances can be measured on the ellipsoid in meters (the maximum join distance is in meters then), without reprojecting the layers. '
+            'The search can be split up on several worker processes (not available on Windows), the result is written in the order of the source layer.')
\ No newline at end of file
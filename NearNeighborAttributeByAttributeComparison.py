@@ -1,151 +1,450 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-# V1.3
-
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsSpatialIndex, QgsProcessingParameterFeatureSink, QgsFeatureSink, QgsField, QgsFields, QgsFeature, QgsGeometry, QgsPoint, QgsWkbTypes, 
-                       QgsProcessingAlgorithm, QgsProcessingParameterField, QgsProcessingParameterBoolean, QgsProcessingParameterVectorLayer, QgsProcessingOutputVectorLayer, QgsProcessingParameterEnum, QgsProcessingParameterNumber)
-import operator
-
-class NearNeighborAttributeByAttributeComparison(QgsProcessingAlgorithm):
-    SOURCE_LYR = 'SOURCE_LYR'
-    SOURCE_FIELD = 'ID_FIELD'
-    ATTRIBUTE_FIELD = 'ATTRIBUTE_FIELD'
-    MAX_NEIGHBORS = 'MAX_NEIGHBORS'
-    MAX_DISTANCE = 'MAX_DISTANCE'
-    DONOT_COMPARE_VALUE = 'DONOT_COMPARE_VALUE'
-    DONOT_COMPARE_BOOL = 'DONOT_COMPARE_BOOL'
-    OPERATOR = 'OPERATOR'
-    OUTPUT = 'OUTPUT'
-
-    def initAlgorithm(self, config=None):
-        
-        self.addParameter(
-            QgsProcessingParameterVectorLayer(
-                self.SOURCE_LYR, self.tr('Source Layer'))) # Take any source layer
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.SOURCE_FIELD, self.tr('Attribute field containing unique IDs'),'id','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.ATTRIBUTE_FIELD, self.tr('Attribute field for comparison'),'year','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.MAX_NEIGHBORS, self.tr('Maximum number of nearest neighbors to compare (use -1 to compare all features of the layer)'),defaultValue=1000,minValue=-1))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.MAX_DISTANCE, self.tr('Only take nearest neighbors within this maximum distance into account for comparison'),defaultValue=10000,minValue=0))
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.OPERATOR, self.tr('Operator to compare the attribute value (If attribute is of type string, only == and != do work)'),
-                    ['<','<=','==','!=','>=','>'],defaultValue=0))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.DONOT_COMPARE_VALUE, self.tr('Do not search for matches on features having a value (insert chosen operator here) x \n Only works for numerical values and dependent on the chosen operator. \n Typically this should be the max or min value available in the attributes and therefore there cant be a match.'),defaultValue=0))
-        self.addParameter(
-            QgsProcessingParameterBoolean(
-                self.DONOT_COMPARE_BOOL,self.tr('Check this Box to actually use the previous option ("Do not search for matches on ....")'),defaultValue=0))
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT, self.tr('Near Neighbor Attributes'))) # Output
-
-    def processAlgorithm(self, parameters, context, feedback):
-        # Get Parameters and assign to variable to work with
-        layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
-        idfield = self.parameterAsString(parameters, self.SOURCE_FIELD, context)
-        idfield_index = layer.fields().indexFromName(idfield) # get the fieldindex of the id field
-        idfield_type = layer.fields()[idfield_index].type() # get the fieldtype of this field
-        attrfield = self.parameterAsString(parameters, self.ATTRIBUTE_FIELD, context)
-        attrfield_index = layer.fields().indexFromName(attrfield) # get the fieldindex of the attribute field
-        attrfield_type = layer.fields()[attrfield_index].type() # get the fieldtype of this field
-        maxneighbors = self.parameterAsDouble(parameters, self.MAX_NEIGHBORS, context)
-        maxdistance = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
-        donotcomparevalue = self.parameterAsDouble(parameters, self.DONOT_COMPARE_VALUE, context)
-        donotcomparebool = self.parameterAsBool(parameters, self.DONOT_COMPARE_BOOL, context)
-        op = self.parameterAsString(parameters, self.OPERATOR, context)
-        op = int(op[0]) # get the index of the chosen operator
-        #import operator
-        ops = { # get the operator by this index
-            0: operator.lt,
-            1: operator.le,
-            2: operator.eq,
-            3: operator.ne,
-            4: operator.ge,
-            5: operator.gt
-            }
-        op_func = ops[op] # create the operator function
-        
-        total = 100.0 / layer.featureCount() if layer.featureCount() else 0 # Initialize progress for progressbar
-        
-        # if -1 has been chosen for maximum features to compare, use the amount of features of the layer, else use the given input
-        if maxneighbors == -1:
-            maxneighbors = layer.featureCount()
-        
-        fields = layer.fields() # get all fields of the inputlayer
-        fields.append(QgsField("near_id", idfield_type)) # create new field with same type as the inputfield
-        fields.append(QgsField("near_attr", attrfield_type)) # same here for the attribute field
-        fields.append(QgsField("near_dist", QVariant.Double, len=20, prec=5)) # add a new field of type double
-        
-        idx = QgsSpatialIndex(layer.getFeatures()) # create a spatial index
-
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               fields, layer.wkbType(),
-                                               layer.sourceCrs())
-                                               
-        for current, feat in enumerate(layer.getFeatures()): # iterate over source 
-            new_feat = QgsFeature(fields) # copy source fields + appended
-            attridx = 0 # reset attribute fieldindex
-            for attr in feat.attributes(): # iterate over attributes of source layer for the current feature
-                new_feat[attridx] = attr # copy attribute values over to the new layer
-                attridx += 1 # go to the next field
-            new_feat.setGeometry(feat.geometry()) # copy over the geometry of the source feature
-            if ((not(op_func(feat[attrfield], donotcomparevalue))) or (not donotcomparebool)): # only search for matches if not beeing told to not do to so
-                nearestneighbors = idx.nearestNeighbor(feat.geometry(), neighbors=maxneighbors, maxDistance=maxdistance) # get the featureids of the maximum specified number of near neighbors within a maximum distance
-                try:
-                    nearestneighbors.remove(feat.id()) # remove the current feature from this list (otherwise the nearest feature by == operator would always be itself...)
-                except:
-                    pass # ignore on error
-                for near in nearestneighbors: # for each feature iterate over the nearest ones (the index is already sorted by distance, so the first match will be the nearest match)
-                    if op_func(layer.getFeature(near)[attrfield], feat[attrfield]): # if the current nearest attribute is (chosen operator here) than the current feature ones, then
-                        new_feat['near_id'] = layer.getFeature(near)[idfield] # get the near matchs's id value and fill the current feature with its value
-                        new_feat['near_attr'] = layer.getFeature(near)[attrfield] # also get the attribute value of this near feature
-                        new_feat['near_dist'] = feat.geometry().distance(layer.getFeature(near).geometry()) # and finally calculate the distance between the current feature and the nearest matching feature
-                        break # break the for loop of near features and continue with the next feat
-            else: # do not search for near neighbor matches if given value is (operator here) than x
-                pass # do nothing and continue adding the feature
-                    
-            sink.addFeature(new_feat, QgsFeatureSink.FastInsert) # add feature to the output
-            feedback.setProgress(int(current * total)) # Set Progress in Progressbar
-            
-            if feedback.isCanceled(): # Cancel algorithm if button is pressed
-                break
-
-        return {self.OUTPUT: dest_id} # Return result of algorithm
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return NearNeighborAttributeByAttributeComparison()
-
-    def name(self):
-        return 'NearNeighborAttributeByAttributeComparison'
-
-    def displayName(self):
-        return self.tr('Add near neighbor attribute by comparing attribute values')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
-        return self.tr(
-        'This Algorithm searches the \n'
-        '- x nearest neighbors \n'
-        '- within a given maximum distance \n'
-        'of the current feature and compares a given attribute. \n'
-        'If this comparison returns true, it adds the id, and the attribute of this neighbor to the current feature as well as the distance to this neighbor. \n \n '
-        'Further explanations available on https://gis.stackexchange.com/a/396856/107424'
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+# V1.4
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (NULL, QgsApplication, QgsProviderRegistry, QgsMemoryProviderUtils, QgsSpatialIndex, QgsProcessingParameterFeatureSink, QgsFeatureSink, QgsFeatureRequest, QgsField, QgsFields, QgsFeature, QgsGeometry, QgsPoint, QgsWkbTypes, 
+                       QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition, QgsProcessingParameterField, QgsProcessingParameterBoolean, QgsProcessingParameterVectorLayer, QgsProcessingOutputVectorLayer, QgsProcessingParameterEnum, QgsProcessingParameterNumber)
+import glob, hashlib, itertools, multiprocessing, operator, os, pickle, queue, sys, time, traceback, zlib
+
+def run_blocks_in_workers(search_block, blocks, n_workers, feedback):
+    # Yields search_block(block) for every block in the order of blocks, computed by n_workers forked processes.
+    # Forking shares everything search_block refers to (spatial index, attribute columns) read-only with the workers, nothing is pickled except the block numbers and the results.
+    # The workers take the next block from a shared queue, so a slow block only holds up one worker, and at most 2 * n_workers blocks are handed
+    # out ahead of the block yielded next, which limits the results waiting in memory. Ends early on cancel and raises if a worker fails or dies
+    # (e.g. killed by the system). Closing the generator early terminates all workers.
+    ctx = multiprocessing.get_context('fork')
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    def work():
+        try:
+            for block_nr in iter(tasks.get, None):
+                results.put((block_nr, search_block(blocks[block_nr]), None))
+        except Exception:
+            results.put((-1, None, traceback.format_exc())) # hand the error over to the main process instead of leaving it waiting
+    workers = [ctx.Process(target=work, daemon=True) for worker_nr in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    n_handed_out = 0
+    finished = {} # results arriving before their turn
+    try:
+        for block_nr in range(len(blocks)):
+            while n_handed_out < min(len(blocks), block_nr + 2 * n_workers):
+                tasks.put(n_handed_out)
+                n_handed_out += 1
+            while block_nr not in finished:
+                try:
+                    finished_nr, result, error = results.get(timeout=0.1)
+                except queue.Empty:
+                    if feedback.isCanceled():
+                        return
+                    for worker in workers:
+                        if worker.exitcode is not None: # workers only end when they are terminated
+                            raise QgsProcessingException('Worker process ended unexpectedly (exit code {}).'.format(worker.exitcode))
+                    continue
+                if error is not None:
+                    raise QgsProcessingException('Worker process failed:\n' + error)
+                finished[finished_nr] = result
+            yield finished.pop(block_nr)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+INDEX_CACHE_MAX_BYTES = 2 * 1024 ** 3 # the least recently used cached indexes are removed when all of them together get larger
+
+def index_cache_key(layer, *identity):
+    # Key of the cached index of a layer: data source, subset string, modification stamps of the files behind the source and whatever else
+    # changes the content of the index (fields, filter, crs...). Returns None if the source is no local file or the layer has unsaved edits,
+    # their changes could not be detected.
+    if layer.isEditable() and layer.isModified():
+        return None
+    path = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source()).get('path')
+    if not path or not os.path.isfile(path):
+        return None
+    stamps = []
+    for file_path in sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + '*')): # sidecar files too, e.g. the .dbf of a shapefile or the -wal of a geopackage
+        stat = os.stat(file_path)
+        stamps.append('{}:{}:{}'.format(os.path.basename(file_path), stat.st_mtime_ns, stat.st_size))
+    key = [layer.source(), layer.subsetString()] + stamps + [str(value) for value in identity]
+    return hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()
+
+def index_cache_path(key):
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'cache', 'spatial_index', key + '.pickle')
+
+def load_index_cache(key):
+    # Returns the cached records [(fid, geometry, [values])] of the key or None if there are none
+    path = index_cache_path(key)
+    try:
+        with open(path, 'rb') as cache_file:
+            records = pickle.loads(zlib.decompress(cache_file.read()))
+        os.utime(path) # the modification time tells which entry has been used least recently
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError, zlib.error):
+        return None
+    result = []
+    for fid, wkb, values in records:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        result.append((fid, geometry, [NULL if value is None else value for value in values]))
+    return result
+
+def store_index_cache(key, records):
+    # Stores the records [(fid, geometry, [values])] under the key and removes the least recently used entries if the cache got too large.
+    # Returns False if the values can not be stored (attribute types pickle does not know).
+    records = [(fid, bytes(geometry.asWkb()), [None if isinstance(value, QVariant) and value.isNull() else value for value in values]) for fid, geometry, values in records]
+    try:
+        data = zlib.compress(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return False
+    path = index_cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as cache_file:
+        cache_file.write(data)
+    os.replace(path + '.tmp', path) # never leave a half written entry behind
+    entries = []
+    for entry in glob.glob(os.path.join(os.path.dirname(path), '*.pickle')):
+        try:
+            stat = os.stat(entry)
+        except OSError: # removed by another run in the meantime
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry in sorted(entries):
+        if size <= INDEX_CACHE_MAX_BYTES:
+            break
+        if entry != path:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            size -= entry_size
+    return True
+
+class RowBuilder:
+    # Output layout computed once: the attributes of an output feature are the concatenation of lists of values
+    # (e.g. source attributes + joined attributes + computed values) set at once, missing values at the end stay NULL.
+    def __init__(self, fields):
+        self.fields = fields
+        self.n_fields = fields.count()
+
+    def feature(self, geometry, *parts):
+        row = list(itertools.chain.from_iterable(parts))
+        if len(row) < self.n_fields:
+            row.extend([None] * (self.n_fields - len(row)))
+        feature = QgsFeature(self.fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes(row)
+        return feature
+
+def bulk_loaded_index(records, wkb_type, crs, feedback):
+    # Bulk loads a spatial index over the geometries of the records [(fid, geometry, values)], which is much faster and gives a better packed tree
+    # than adding the features one by one. QgsSpatialIndex only bulk loads from a feature iterator, so the geometries are put into a memory layer,
+    # whose provider numbers the features itself: returns the index and the records by their number in the index, or None if canceled.
+    index_layer = QgsMemoryProviderUtils.createMemoryLayer('index', QgsFields(), wkb_type, crs)
+    features = []
+    kept_records = []
+    for record in records:
+        feature = QgsFeature()
+        feature.setGeometry(record[1])
+        features.append(feature)
+        kept_records.append(record)
+        if feedback.isCanceled():
+            return None
+    ok, features = index_layer.dataProvider().addFeatures(features, QgsFeatureSink.FastInsert)
+    if not ok:
+        raise QgsProcessingException('The geometries could not be indexed: {}'.format(index_layer.dataProvider().lastError()))
+    idx = QgsSpatialIndex(index_layer.getFeatures(QgsFeatureRequest().setNoAttributes()), feedback)
+    if feedback.isCanceled():
+        return None
+    return idx, {feature.id(): record for feature, record in zip(features, kept_records)}
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class NearNeighborAttributeByAttributeComparison(QgsProcessingAlgorithm):
+    SOURCE_LYR = 'SOURCE_LYR'
+    SOURCE_FIELD = 'ID_FIELD'
+    ATTRIBUTE_FIELD = 'ATTRIBUTE_FIELD'
+    MAX_NEIGHBORS = 'MAX_NEIGHBORS'
+    MAX_DISTANCE = 'MAX_DISTANCE'
+    DONOT_COMPARE_VALUE = 'DONOT_COMPARE_VALUE'
+    DONOT_COMPARE_BOOL = 'DONOT_COMPARE_BOOL'
+    OPERATOR = 'OPERATOR'
+    WORKERS = 'WORKERS'
+    USE_INDEX_CACHE = 'USE_INDEX_CACHE'
+    OUTPUT = 'OUTPUT'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+        
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.SOURCE_LYR, self.tr('Source Layer'))) # Take any source layer
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.SOURCE_FIELD, self.tr('Attribute field containing unique IDs'),'id','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.ATTRIBUTE_FIELD, self.tr('Attribute field for comparison'),'year','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MAX_NEIGHBORS, self.tr('Maximum number of nearest neighbors to compare (use -1 to compare all features of the layer)'),defaultValue=1000,minValue=-1))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MAX_DISTANCE, self.tr('Only take nearest neighbors within this maximum distance into account for comparison'),defaultValue=10000,minValue=0))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OPERATOR, self.tr('Operator to compare the attribute value (If attribute is of type string, only == and != do work)'),
+                    ['<','<=','==','!=','>=','>'],defaultValue=0))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.DONOT_COMPARE_VALUE, self.tr('Do not search for matches on features having a value (insert chosen operator here) x \n Only works for numerical values and dependent on the chosen operator. \n Typically this should be the max or min value available in the attributes and therefore there cant be a match.'),defaultValue=0))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.DONOT_COMPARE_BOOL,self.tr('Check this Box to actually use the previous option ("Do not search for matches on ....")'),defaultValue=0))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of parallel worker processes (1 = no parallelization, 0 = use all CPU cores)'),defaultValue=1,minValue=0))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_INDEX_CACHE,self.tr('Keep the index of the layer in a cache in the QGIS profile and reuse it as long as the file of the layer is unchanged (may use up to 2 GB of disk space)'),defaultValue=0))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('Near Neighbor Attributes'))) # Output
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Get Parameters and assign to variable to work with
+        layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
+        idfield = self.parameterAsString(parameters, self.SOURCE_FIELD, context)
+        idfield_index = layer.fields().indexFromName(idfield) # get the fieldindex of the id field
+        idfield_type = layer.fields()[idfield_index].type() # get the fieldtype of this field
+        attrfield = self.parameterAsString(parameters, self.ATTRIBUTE_FIELD, context)
+        attrfield_index = layer.fields().indexFromName(attrfield) # get the fieldindex of the attribute field
+        attrfield_type = layer.fields()[attrfield_index].type() # get the fieldtype of this field
+        maxneighbors = self.parameterAsDouble(parameters, self.MAX_NEIGHBORS, context)
+        maxdistance = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
+        donotcomparevalue = self.parameterAsDouble(parameters, self.DONOT_COMPARE_VALUE, context)
+        donotcomparebool = self.parameterAsBool(parameters, self.DONOT_COMPARE_BOOL, context)
+        op = self.parameterAsString(parameters, self.OPERATOR, context)
+        op = int(op[0]) # get the index of the chosen operator
+        #import operator
+        ops = { # get the operator by this index
+            0: operator.lt,
+            1: operator.le,
+            2: operator.eq,
+            3: operator.ne,
+            4: operator.ge,
+            5: operator.gt
+            }
+        op_func = ops[op] # create the operator function
+        
+        n_workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        if n_workers == 0:
+            n_workers = os.cpu_count() or 1
+        if n_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            feedback.pushInfo(self.tr('Parallel processing needs the fork start method, which is not available on this platform. Continuing with one process.'))
+            n_workers = 1
+        blocksize = 1000 # number of features handed to a worker at once
+        use_index_cache = self.parameterAsBool(parameters, self.USE_INDEX_CACHE, context)
+        
+        total = 100.0 / layer.featureCount() if layer.featureCount() else 0 # Initialize progress for progressbar
+        
+        # if -1 has been chosen for maximum features to compare, use the amount of features of the layer, else use the given input
+        if maxneighbors == -1:
+            maxneighbors = layer.featureCount()
+        maxneighbors = int(maxneighbors)
+        
+        fields = layer.fields() # get all fields of the inputlayer
+        fields.append(QgsField("near_id", idfield_type)) # create new field with same type as the inputfield
+        fields.append(QgsField("near_attr", attrfield_type)) # same here for the attribute field
+        fields.append(QgsField("near_dist", QVariant.Double, len=20, prec=5)) # add a new field of type double
+        
+        # read the layer only once: build the spatial index and keep geometry, id and attribute of every feature, so the neighbor search does not need to request features from the provider
+        cache_key = None
+        records = None
+        if use_index_cache: # the index is rebuilt from the cached geometries, ids and attributes instead of reading the layer
+            cache_key = index_cache_key(layer, idfield, attrfield)
+            if cache_key is not None:
+                records = load_index_cache(cache_key)
+            else:
+                feedback.pushInfo(self.tr('The index of the layer is not cached, the layer has unsaved edits or is not read from a local file.'))
+        read_from_cache = records is not None
+        if read_from_cache:
+            feedback.pushInfo(self.tr('Index of the layer read from the cache.'))
+        else:
+            request = QgsFeatureRequest().setSubsetOfAttributes([idfield_index, attrfield_index])
+            records = ((feat.id(), feat.geometry(), (feat[idfield_index], feat[attrfield_index])) for feat in layer.getFeatures(request))
+        indexed = bulk_loaded_index(records, layer.wkbType(), layer.sourceCrs(), feedback) # create a spatial index
+        if indexed is None: # canceled
+            return {}
+        idx, indexed = indexed
+        # geometry, id and attribute by the number of the feature in the index
+        fids = {key: fid for key, (fid, geom, values) in indexed.items()}
+        geoms = {key: geom for key, (fid, geom, values) in indexed.items()}
+        ids = {key: values[0] for key, (fid, geom, values) in indexed.items()}
+        attrs = {key: values[1] for key, (fid, geom, values) in indexed.items()}
+        keys = list(indexed)
+        blocks = [keys[start:start + blocksize] for start in range(0, len(keys), blocksize)]
+        if cache_key is not None and not read_from_cache:
+            if not store_index_cache(cache_key, [(fid, geom, list(values)) for fid, geom, values in indexed.values()]):
+                feedback.pushInfo(self.tr('The index of the layer can not be cached, the id or attribute field has a type that can not be stored.'))
+        
+        def search_block(block): # returns (fid, near_id, near_attr, near_dist) for every feature of the block
+            results = []
+            for key in block:
+                fid = fids[key]
+                result = (fid, None, None, None)
+                if ((not(op_func(attrs[key], donotcomparevalue))) or (not donotcomparebool)): # only search for matches if not beeing told to not do to so
+                    nearestneighbors = idx.nearestNeighbor(geoms[key], neighbors=maxneighbors, maxDistance=maxdistance) # get the featureids of the maximum specified number of near neighbors within a maximum distance
+                    for near in nearestneighbors: # for each feature iterate over the nearest ones (the index is already sorted by distance, so the first match will be the nearest match)
+                        if near == key: # skip the current feature itself (otherwise the nearest feature by == operator would always be itself...)
+                            continue
+                        if op_func(attrs[near], attrs[key]): # if the current nearest attribute is (chosen operator here) than the current feature ones, then
+                            result = (fid, ids[near], attrs[near], geoms[key].distance(geoms[near])) # take id, attribute and distance of the nearest matching feature
+                            break # break the for loop of near features and continue with the next feat
+                results.append(result)
+            return results
+        
+        if n_workers > 1:
+            block_results = run_blocks_in_workers(search_block, blocks, n_workers, feedback)
+        else:
+            block_results = (search_block(block) for block in blocks)
+
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               fields, layer.wkbType(),
+                                               layer.sourceCrs())
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+        
+            rows = RowBuilder(fields)
+            results = {}
+            for current, feat in enumerate(layer.getFeatures()): # iterate over source in the same order the blocks have been created
+                while feat.id() not in results: # the cached index may list the features in another order than the layer
+                    try:
+                        block = next(block_results) # get the results of the next block
+                    except StopIteration: # the workers have been stopped on cancel or the layer returned a feature that has not been read before, it has been changed meanwhile
+                        if feedback.isCanceled():
+                            break
+                        raise QgsProcessingException(self.tr('Feature {} has not been read before, the layer has been changed while the algorithm was running.').format(feat.id()))
+                    for fid, near_id, near_attr, near_dist in block:
+                        results[fid] = (near_id, near_attr, near_dist)
+                if feat.id() not in results: # canceled
+                    break
+                near_id, near_attr, near_dist = results.pop(feat.id())
+                if near_dist is not None: # a match has been found: source attributes + near_id, near_attr, near_dist
+                    writer.addFeature(rows.feature(feat.geometry(), feat.attributes(), [near_id, near_attr, near_dist]))
+                else:
+                    writer.addFeature(rows.feature(feat.geometry(), feat.attributes()))
+                feedback.setProgress(int(current * total)) # Set Progress in Progressbar
+            
+                if feedback.isCanceled(): # Cancel algorithm if button is pressed
+                    break
+        finally:
+            block_results.close() # stops the worker processes if the algorithm has been canceled
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+
+        return {self.OUTPUT: dest_id} # Return result of algorithm
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return NearNeighborAttributeByAttributeComparison()
+
+    def name(self):
+        return 'NearNeighborAttributeByAttributeComparison'
+
+    def displayName(self):
+        return self.tr('Add near neighbor attribute by comparing attribute values')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
+        return self.tr(
+        'This Algorithm searches the \n'
+        '- x nearest neighbors \n'
+        '- within a given maximum distance \n'
+        'of the current feature and compares a given attribute. \n'
+        'If this comparison returns true, it adds the id, and the attribute of this neighbor to the current feature as well as the distance to this neighbor. \n \n '
+        'The neighbor search can be split up on several worker processes (not available on Windows). The spatial index is built only once and shared with all workers. \n \n '
+        'On request, the spatial index of a layer stored in a local file is cached in the QGIS profile and reused in the next runs as long as the file has not been changed and the layer has no unsaved edits. \n \n '
+        'Further explanations available on https://gis.stackexchange.com/a/396856/107424'
         )
\ No newline at end of file
@@ -1,315 +1,492 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (Qgis, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsVectorLayer, QgsProject,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterNumber, QgsProcessingParameterString, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum)
-
-
-class NumberOfIntersectionsBetweenPoints(QgsProcessingAlgorithm):
-    POSSIBILITY_LYR = 'POSSIBILITY_LYR'
-    POSSIBILITY_IDFIELD = 'POSSIBILITY_IDFIELD'
-    POSSIBILITY_TYPFIELD = 'POSSIBILITY_TYPFIELD'
-    POSSIBILITY_POLYGONIDFIELD = 'POSSIBILITY_POLYGONIDFIELD'
-    STOP_LYR = 'STOP_LYR'
-    STOP_IDFIELD = 'STOP_IDFIELD'
-    STOP_TYPFIELD = 'STOP_TYPFIELD'
-    STOP_POLYGONIDFIELD = 'STOP_POLYGONIDFIELD'
-    LINES_LYR = 'LINES_LYR'
-    MAXDISTANCE = 'MAXDISTANCE'
-    EXCLUDETYPA = 'EXCLUDETYPA'
-    EXCLUDETYPB = 'EXCLUDETYPB'
-    PRIOA = 'PRIOA'
-    PRIOB = 'PRIOB'
-    PRIOC = 'PRIOC'
-    PRIOD = 'PRIOD'
-    PRIOE = 'PRIOE'
-    PRIOF = 'PRIOF'
-    PRIOG = 'PRIOG'
-    OPERATION = 'OPERATION'
-    OUTPUTLINES = 'OUTPUTLINES'
-
-    def initAlgorithm(self, config=None):
-        
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.STOP_LYR, self.tr('Source'), [QgsProcessing.TypeVectorPoint],'Stops'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.STOP_IDFIELD, self.tr('Unique ID Field of Source Layer (Number)'),'stopid','STOP_LYR',0))      
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.STOP_TYPFIELD, self.tr('VHT Typ Field of Source Layer (String)'),'stoptyp','STOP_LYR',1))  
-        #self.addParameter(
-        #    QgsProcessingParameterField(
-        #        self.STOP_POLYGONIDFIELD, self.tr('Polygon ID Field of Source Layer (Any, but same as Matching Polygon ID Field)'),'polygonid','STOP_LYR'))  
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.POSSIBILITY_LYR, self.tr('Possibilities'), [QgsProcessing.TypeVectorPoint],'possibilities'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.POSSIBILITY_IDFIELD, self.tr('Unique Possibility ID Field (Number, should have a different name than Source ID field)'),'possibilityid','POSSIBILITY_LYR',0))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.POSSIBILITY_TYPFIELD, self.tr('VHT Typ Field of Possibilities (String, should have a different name than Source Typ field'),'posstyp','POSSIBILITY_LYR',1))
-        #self.addParameter(
-        #    QgsProcessingParameterField(
-        #        self.POSSIBILITY_POLYGONIDFIELD, self.tr('Polygon ID Field of Possibilities Layer (Any, but same as Source Polygon ID Field)'),'polygonid','POSSIBILITY_LYR'))  
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.LINES_LYR, self.tr('Intersection Lines'), [QgsProcessing.TypeVectorLine],'LinesTest'))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.MAXDISTANCE, self.tr('Maxium Distance'), defaultValue = 125))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.PRIOA, self.tr('Prio 1 Typ'), defaultValue = 'Einfahrt', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.PRIOB, self.tr('Prio 2 Typ'), defaultValue = 'Kreuzung', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.PRIOC, self.tr('Prio 3 Typ'), defaultValue = '', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.PRIOD, self.tr('Prio 4 Typ'), defaultValue = '', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.PRIOE, self.tr('Prio 5 Typ'), defaultValue = '', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.PRIOF, self.tr('Prio 6 Typ'), defaultValue = '', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.PRIOG, self.tr('Prio 7 Typ'), defaultValue = '', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.EXCLUDETYPA, self.tr('Exclude Typ 1'), defaultValue = 'nichts', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.EXCLUDETYPB, self.tr('Exclude Typ 2'), defaultValue = '', optional = 1))
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.OPERATION, self.tr('Remove ... number of intersections'), ['even','odd'],0,'even'))
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUTLINES, self.tr('Output Lines'), QgsProcessing.TypeVectorLine))
-
-    def processAlgorithm(self, parameters, context, feedback):
-        # Get Parameters
-        possibility_layer = self.parameterAsSource(parameters, self.POSSIBILITY_LYR, context)
-        possibility_idfield = self.parameterAsFields(parameters, self.POSSIBILITY_IDFIELD, context)
-        possibility_typfield = self.parameterAsFields(parameters, self.POSSIBILITY_TYPFIELD, context)
-        stop_layer = self.parameterAsSource(parameters, self.STOP_LYR, context)
-        stop_idfield = self.parameterAsFields(parameters, self.STOP_IDFIELD, context)
-        stop_typfield = self.parameterAsFields(parameters, self.STOP_TYPFIELD, context)
-        lines_layer = self.parameterAsSource(parameters, self.LINES_LYR, context)
-        maxdistance = self.parameterAsDouble(parameters, self.MAXDISTANCE, context)
-        prio1 = self.parameterAsString(parameters, self.PRIOA, context)
-        prio2 = self.parameterAsString(parameters, self.PRIOB, context)
-        prio3 = self.parameterAsString(parameters, self.PRIOC, context)
-        prio4 = self.parameterAsString(parameters, self.PRIOD, context)
-        prio5 = self.parameterAsString(parameters, self.PRIOE, context)
-        prio6 = self.parameterAsString(parameters, self.PRIOF, context)
-        prio7 = self.parameterAsString(parameters, self.PRIOG, context)
-        excl1 = self.parameterAsString(parameters, self.EXCLUDETYPA, context)
-        excl2 = self.parameterAsString(parameters, self.EXCLUDETYPB, context)
-        operation = self.parameterAsString(parameters, self.OPERATION, context)
-        operationlist = [' == ',' != ']
-        expressionoperator = str(operationlist[int(operation[0])])        
-
-        #if possibility_idfield == stop_idfield:
-        #    iface.messageBar().pushMessage("Error!", "ID Felder haben die gleichen Namen", level=Qgis.Critical, duration=9)
-        #if possibility_typfield == stop_typfield:
-        #    iface.messageBar().pushMessage("Error!", "Typ Felder haben die gleichen Namen", level=Qgis.Critical, duration=9)
-        
-        fields = QgsFields()
-        fields.append(QgsField("possibility_id", QVariant.Int))
-        fields.append(QgsField("possibility_typ", QVariant.String))
-        fields.append(QgsField("possibility_priority", QVariant.Int))
-        fields.append(QgsField("stop_id", QVariant.Int))
-        fields.append(QgsField("stop_typ", QVariant.String))          
-        fields.append(QgsField("line_length", QVariant.Double, len=20, prec=5))
-        fields.append(QgsField("n_intersections", QVariant.Int))
-
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUTLINES, context,
-                                               fields, lines_layer.wkbType(),
-                                               lines_layer.sourceCrs())
-        print(lines_layer.sourceCrs().authid())
-        #Memorylayer_VL = QgsVectorLayer(str('LineString'), "tmp_lines", "memory")        
-        Memorylayer_VL = QgsVectorLayer(str('LineString?crs=')+str(lines_layer.sourceCrs().authid()), "tmp_lines", "memory")
-        Memorylayer_PR = Memorylayer_VL.dataProvider()
-        Memorylayer_VL.startEditing()
-        Memorylayer_PR.addAttributes([QgsField("possid", QVariant.Int),QgsField("posstyp", QVariant.String),QgsField("possprio", QVariant.Int),QgsField("stopid", QVariant.Int),QgsField("stoptyp", QVariant.String),QgsField("line_length", QVariant.Double, len=20, prec=5),QgsField("n_intersections", QVariant.Int)])
-        Memorylayer_VL.updateFields()
-        #crs = Memorylayer_VL.crs()
-        #crs.createFromId(25832)
-        #Memorylayer_VL.setCrs(crs)
-        
-        
-        # iterate over stop features
-        for stop_feat in stop_layer.getFeatures():
-            point1 = QgsPoint(stop_feat.geometry().asPoint())
-            for source_feat in possibility_layer.getFeatures():
-                point2 = QgsPoint(source_feat.geometry().asPoint())
-                temp_feat = QgsFeature(fields)
-                temp_feat.setGeometry(QgsGeometry.fromPolyline([point1, point2])) 
-                temp_feat["stop_id"] = stop_feat[stop_idfield[0]] 
-                temp_feat["stop_typ"] = stop_feat[stop_typfield[0]] 
-                temp_feat["possibility_id"] = source_feat[possibility_idfield[0]] 
-                temp_feat["possibility_typ"] = source_feat[possibility_typfield[0]] 
-                temp_feat["possibility_priority"] = 0
-                temp_feat["line_length"] = temp_feat.geometry().length() 
-                temp_feat["n_intersections"] = 0
-                #temp_feat.setAttributes([source_feat[possibility_idfield[0]],source_feat[possibility_typfield[0]],stop_feat[stop_idfield[0]],stop_feat[stop_typfield[0]],temp_feat.geometry().length(),-1])
-                #temp_feat.setAttributes([temp_feat.geometry().length(),-1])
-                Memorylayer_PR.addFeature(temp_feat)
-                Memorylayer_VL.updateFields()
-        Memorylayer_VL.commitChanges()
-        
-        # remove lines which are too long
-        print('Fields: ' + str(Memorylayer_VL.fields().count()))
-        print('Vorher: ' + str(Memorylayer_VL.featureCount()))
-        dfeats = [] # Create empty list of features to delete later
-        for tmp_line_feat in Memorylayer_VL.getFeatures():
-            #print(str(tmp_line_feat.attributes()[0]) + ' ' + str(tmp_line_feat.attributes()[1])+ ' '+ str(tmp_line_feat.attributes()[2])+ ' '+ str(tmp_line_feat.attributes()[3])+ ' '+ str(tmp_line_feat.attributes()[4])+ ' '+ str(tmp_line_feat.attributes()[5])+ ' ')
-            if tmp_line_feat.geometry().length() > maxdistance:
-                dfeats.append(tmp_line_feat.id())
-            if tmp_line_feat.geometry().length() < 1:
-                dfeats.append(tmp_line_feat.id())
-        Memorylayer_PR.deleteFeatures(dfeats)
-        Memorylayer_VL.commitChanges()
-        print('Nachher: ' + str(Memorylayer_VL.featureCount()))
-        
-        # remove excludetyps
-        dfeats10 = []
-        for tmp_line_feat in Memorylayer_VL.getFeatures():
-            if tmp_line_feat.attributes()[1] == excl1:
-                dfeats10.append(tmp_line_feat.id())
-            elif tmp_line_feat.attributes()[1] == excl2:
-                dfeats10.append(tmp_line_feat.id())
-            else:
-                None
-        Memorylayer_PR.deleteFeatures(dfeats10)
-        Memorylayer_VL.commitChanges()
-        
-        # count intersections
-        for tmp_line_feat in Memorylayer_VL.getFeatures():
-            counter = 0
-            for streets in lines_layer.getFeatures():                
-                if tmp_line_feat.geometry().intersects(streets.geometry()):
-                    counter = counter + 1
-                attr = {6:counter}
-                Memorylayer_PR.changeAttributeValues({ tmp_line_feat.id() : attr })
-        Memorylayer_VL.commitChanges()  
-        
-        # remove unwanted number of intersections
-        dfeats2 = []
-        if expressionoperator == ' == ': #take this loop to remove even number of intersections                    
-            for tmp_line_feat in Memorylayer_VL.getFeatures():
-                if (tmp_line_feat.attributes()[6] % 2) == 0:
-                    dfeats2.append(tmp_line_feat.id())
-        if expressionoperator == ' != ': #take this loop to remove uneven number of intersections 
-            for tmp_line_feat in Memorylayer_VL.getFeatures():
-                if (tmp_line_feat.attributes()[6] % 2) != 0: 
-                    dfeats2.append(tmp_line_feat.id())
-        Memorylayer_PR.deleteFeatures(dfeats2)
-        Memorylayer_VL.commitChanges()
-        
-        # add priority numbers
-        for tmp_line_feat in Memorylayer_VL.getFeatures():
-            if tmp_line_feat.attributes()[1] == prio1:
-                attr = {2:1}
-            elif tmp_line_feat.attributes()[1] == prio2:
-                attr = {2:2}
-            elif tmp_line_feat.attributes()[1] == prio3:
-                attr = {2:3}
-            elif tmp_line_feat.attributes()[1] == prio4:
-                attr = {2:4}
-            elif tmp_line_feat.attributes()[1] == prio5:
-                attr = {2:5}
-            elif tmp_line_feat.attributes()[1] == prio6:
-                attr = {2:6}
-            elif tmp_line_feat.attributes()[1] == prio7:
-                attr = {2:7}
-            else:
-                attr = {2:9}
-            Memorylayer_PR.changeAttributeValues({ tmp_line_feat.id() : attr })    
-        Memorylayer_VL.commitChanges()
-        
-        # check for priorities and remove unwanted
-        dfeats3 = []
-        vals = {}
-        for tmp_line_feat in Memorylayer_VL.getFeatures(): # populate dict
-            if tmp_line_feat.attributes()[3] not in vals:
-                vals[tmp_line_feat.attributes()[3]] = [tmp_line_feat[2]]
-            else:
-                vals[tmp_line_feat.attributes()[3]].append(tmp_line_feat[2])
-        for key, value in vals.items(): # find minimum priority
-            vals[key] = min(value)
-        for tmp_line_feat in Memorylayer_VL.getFeatures(): # delete lower prios
-            k = tmp_line_feat[3]
-            if tmp_line_feat[2] != vals[k]:
-                dfeats3.append(tmp_line_feat.id())
-            else:
-                None
-        Memorylayer_PR.deleteFeatures(dfeats3) 
-        Memorylayer_VL.commitChanges()        
-        
-        # in case there are several prios of same type for one stop, lets keep the nearest
-        dfeats4 = []
-        vals2 = {}
-        for tmp_line_feat in Memorylayer_VL.getFeatures(): # populate dict
-            if tmp_line_feat.attributes()[3] not in vals2:
-                vals2[tmp_line_feat.attributes()[3]] = [tmp_line_feat[5]]
-            else:
-                vals2[tmp_line_feat.attributes()[3]].append(tmp_line_feat[5])
-        for key, value in vals2.items(): # find minimum priority
-            vals2[key] = min(value)
-        for tmp_line_feat in Memorylayer_VL.getFeatures(): # delete farther distances
-            l = tmp_line_feat[3]
-            if tmp_line_feat[5] != vals2[l]:
-                dfeats4.append(tmp_line_feat.id())
-            else:
-                None
-        Memorylayer_PR.deleteFeatures(dfeats4)
-        Memorylayer_VL.commitChanges()
-        
-        # create output
-        for tmp_line_feat in Memorylayer_VL.getFeatures():
-            new_feat = QgsFeature(fields)
-            new_feat.setGeometry(tmp_line_feat.geometry()) 
-            new_feat["stop_id"] = tmp_line_feat.attributes()[3]   
-            new_feat["stop_typ"] = tmp_line_feat.attributes()[4]           
-            new_feat["possibility_id"] = tmp_line_feat.attributes()[0]
-            new_feat["possibility_typ"] = tmp_line_feat.attributes()[1]
-            new_feat["possibility_priority"] = tmp_line_feat.attributes()[2]
-            new_feat["line_length"] = tmp_line_feat.attributes()[5] 
-            new_feat["n_intersections"] = tmp_line_feat.attributes()[6]
-            sink.addFeature(new_feat, QgsFeatureSink.FastInsert)    
-        
-        
-        return {self.OUTPUTLINES: dest_id}
-
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return NumberOfIntersectionsBetweenPoints()
-
-    def name(self):
-        return 'NumberOfIntersectionsBetweenPoints'
-
-    def displayName(self):
-        return self.tr('Number Of Intersections Between Points')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (Qgis, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsVectorLayer, QgsProject, QgsRectangle, QgsSpatialIndex, QgsWkbTypes,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterNumber, QgsProcessingParameterString, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum)
+import multiprocessing, os, queue, sys, time, traceback
+import numpy as np
+
+def run_blocks_in_workers(search_block, blocks, n_workers, feedback):
+    # Yields search_block(block) for every block in the order of blocks, computed by n_workers forked processes.
+    # Forking shares everything search_block refers to (spatial index, attribute columns) read-only with the workers, nothing is pickled except the block numbers and the results.
+    # The workers take the next block from a shared queue, so a slow block only holds up one worker, and at most 2 * n_workers blocks are handed
+    # out ahead of the block yielded next, which limits the results waiting in memory. Ends early on cancel and raises if a worker fails or dies
+    # (e.g. killed by the system). Closing the generator early terminates all workers.
+    ctx = multiprocessing.get_context('fork')
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    def work():
+        try:
+            for block_nr in iter(tasks.get, None):
+                results.put((block_nr, search_block(blocks[block_nr]), None))
+        except Exception:
+            results.put((-1, None, traceback.format_exc())) # hand the error over to the main process instead of leaving it waiting
+    workers = [ctx.Process(target=work, daemon=True) for worker_nr in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    n_handed_out = 0
+    finished = {} # results arriving before their turn
+    try:
+        for block_nr in range(len(blocks)):
+            while n_handed_out < min(len(blocks), block_nr + 2 * n_workers):
+                tasks.put(n_handed_out)
+                n_handed_out += 1
+            while block_nr not in finished:
+                try:
+                    finished_nr, result, error = results.get(timeout=0.1)
+                except queue.Empty:
+                    if feedback.isCanceled():
+                        return
+                    for worker in workers:
+                        if worker.exitcode is not None: # workers only end when they are terminated
+                            raise QgsProcessingException('Worker process ended unexpectedly (exit code {}).'.format(worker.exitcode))
+                    continue
+                if error is not None:
+                    raise QgsProcessingException('Worker process failed:\n' + error)
+                finished[finished_nr] = result
+            yield finished.pop(block_nr)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+def street_segments(lines_layer, feedback):
+    # Explodes the streets into straight segments. Returns the start and end coordinates of the segments, the number of the
+    # street of every segment and whether a segment continues the previous segment of the same part (shares its start vertex).
+    x1, y1, x2, y2, street_numbers, continues = [], [], [], [], [], []
+    street_number = 0
+    for street_feat in lines_layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        if feedback.isCanceled():
+            break
+        if not street_feat.hasGeometry():
+            continue
+        street_geom = street_feat.geometry()
+        if QgsWkbTypes.isCurvedType(street_geom.wkbType()):
+            street_geom = QgsGeometry(street_geom.constGet().segmentize())
+        parts = street_geom.asMultiPolyline() if street_geom.isMultipart() else [street_geom.asPolyline()]
+        for part in parts:
+            for vertex_nr in range(len(part) - 1):
+                x1.append(part[vertex_nr].x())
+                y1.append(part[vertex_nr].y())
+                x2.append(part[vertex_nr + 1].x())
+                y2.append(part[vertex_nr + 1].y())
+                street_numbers.append(street_number)
+                continues.append(vertex_nr > 0)
+        street_number += 1
+    return np.array(x1, dtype=float), np.array(y1, dtype=float), np.array(x2, dtype=float), np.array(y2, dtype=float), np.array(street_numbers, dtype=int), np.array(continues, dtype=bool)
+
+class SegmentGrid:
+    # Uniform grid over the street segments, every segment is registered in the cells along its path: it is split into pieces
+    # of at most one cell length, each piece is registered in the (at most 2 x 2) cells its bounding box overlaps. So a long
+    # diagonal segment (e.g. a ferry line) takes a number of cells proportional to its length, not to the area of its bounding box.
+    def __init__(self, x1, y1, x2, y2, cell_size):
+        self.cell_size = cell_size
+        n_pieces = np.maximum(1, np.ceil(np.hypot(x2 - x1, y2 - y1) / cell_size)).astype(int)
+        segment_nrs = np.repeat(np.arange(len(x1)), n_pieces) # segment of every piece
+        piece_nrs = np.arange(len(segment_nrs)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces) # number of the piece within its segment
+        start = piece_nrs / n_pieces[segment_nrs]
+        end = (piece_nrs + 1) / n_pieces[segment_nrs]
+        last = piece_nrs + 1 == n_pieces[segment_nrs] # the last piece ends exactly at the end of the segment
+        px1 = x1[segment_nrs] + (x2 - x1)[segment_nrs] * start
+        py1 = y1[segment_nrs] + (y2 - y1)[segment_nrs] * start
+        px2 = np.where(last, x2[segment_nrs], x1[segment_nrs] + (x2 - x1)[segment_nrs] * end)
+        py2 = np.where(last, y2[segment_nrs], y1[segment_nrs] + (y2 - y1)[segment_nrs] * end)
+        col_min, col_max = self.cell(np.minimum(px1, px2)), self.cell(np.maximum(px1, px2))
+        row_min, row_max = self.cell(np.minimum(py1, py2)), self.cell(np.maximum(py1, py2))
+        cells = {}
+        for segment_nr, piece_col_min, piece_col_max, piece_row_min, piece_row_max in zip(segment_nrs.tolist(), col_min.tolist(), col_max.tolist(), row_min.tolist(), row_max.tolist()):
+            for col in range(piece_col_min, piece_col_max + 1):
+                for row in range(piece_row_min, piece_row_max + 1):
+                    cells.setdefault((col, row), []).append(segment_nr)
+        self.cells = {key: np.unique(cell_segment_nrs) for key, cell_segment_nrs in cells.items()} # consecutive pieces share cells
+
+    def cell(self, values):
+        return np.floor(np.asarray(values) / self.cell_size).astype(int)
+
+    def segments_in(self, xmin, ymin, xmax, ymax):
+        # numbers of all segments registered in the cells overlapping the rectangle, sorted and without duplicates
+        found = [self.cells[(col, row)]
+                 for col in range(int(self.cell(xmin)), int(self.cell(xmax)) + 1)
+                 for row in range(int(self.cell(ymin)), int(self.cell(ymax)) + 1) if (col, row) in self.cells]
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=int)
+
+def count_intersections(ax, ay, bx, by, cx, cy, dx, dy, street_numbers, continues, count_crossings, max_pairs=1000000):
+    # Number of intersections of every connector a-b with the segments c-d, tested for all pairs at once (in blocks of at most
+    # max_pairs pairs). Touching and overlapping count as intersecting like QgsGeometry.intersects(). Counts the distinct
+    # streets (street_numbers must be sorted) or, with count_crossings, the crossing points, where a crossing at the vertex
+    # shared by two segments of a street part is counted once.
+    counts = np.zeros(len(ax), dtype=int)
+    if not len(ax) or not len(cx):
+        return counts
+    street_starts = np.flatnonzero(np.r_[True, street_numbers[1:] != street_numbers[:-1]])
+    block = max(1, max_pairs // len(cx))
+    for start in range(0, len(ax), block):
+        a_x, a_y, b_x, b_y = (values[start:start + block, None] for values in (ax, ay, bx, by))
+        d1 = np.sign((dx - cx) * (a_y - cy) - (dy - cy) * (a_x - cx)) # side of a relative to c-d
+        d2 = np.sign((dx - cx) * (b_y - cy) - (dy - cy) * (b_x - cx)) # side of b relative to c-d
+        d3 = np.sign((b_x - a_x) * (cy - a_y) - (b_y - a_y) * (cx - a_x)) # side of c relative to a-b
+        d4 = np.sign((b_x - a_x) * (dy - a_y) - (b_y - a_y) * (dx - a_x)) # side of d relative to a-b
+        hits = (d1 * d2 <= 0) & (d3 * d4 <= 0)
+        collinear = (d1 == 0) & (d2 == 0) & (d3 == 0) & (d4 == 0) # on one line, they only intersect if their extents overlap
+        overlap = ((np.maximum(np.minimum(a_x, b_x), np.minimum(cx, dx)) <= np.minimum(np.maximum(a_x, b_x), np.maximum(cx, dx))) &
+                   (np.maximum(np.minimum(a_y, b_y), np.minimum(cy, dy)) <= np.minimum(np.maximum(a_y, b_y), np.maximum(cy, dy))))
+        hits &= ~collinear | overlap
+        if count_crossings:
+            start_on_connector = (d3 == 0) & (np.minimum(a_x, b_x) <= cx) & (cx <= np.maximum(a_x, b_x)) & (np.minimum(a_y, b_y) <= cy) & (cy <= np.maximum(a_y, b_y))
+            counts[start:start + block] = (hits & ~(continues & start_on_connector)).sum(axis=1)
+        else:
+            counts[start:start + block] = np.logical_or.reduceat(hits, street_starts, axis=1).sum(axis=1)
+    return counts
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class NumberOfIntersectionsBetweenPoints(QgsProcessingAlgorithm):
+    POSSIBILITY_LYR = 'POSSIBILITY_LYR'
+    POSSIBILITY_IDFIELD = 'POSSIBILITY_IDFIELD'
+    POSSIBILITY_TYPFIELD = 'POSSIBILITY_TYPFIELD'
+    POSSIBILITY_POLYGONIDFIELD = 'POSSIBILITY_POLYGONIDFIELD'
+    STOP_LYR = 'STOP_LYR'
+    STOP_IDFIELD = 'STOP_IDFIELD'
+    STOP_TYPFIELD = 'STOP_TYPFIELD'
+    STOP_POLYGONIDFIELD = 'STOP_POLYGONIDFIELD'
+    LINES_LYR = 'LINES_LYR'
+    MAXDISTANCE = 'MAXDISTANCE'
+    EXCLUDETYPA = 'EXCLUDETYPA'
+    EXCLUDETYPB = 'EXCLUDETYPB'
+    PRIOA = 'PRIOA'
+    PRIOB = 'PRIOB'
+    PRIOC = 'PRIOC'
+    PRIOD = 'PRIOD'
+    PRIOE = 'PRIOE'
+    PRIOF = 'PRIOF'
+    PRIOG = 'PRIOG'
+    OPERATION = 'OPERATION'
+    COUNT_MODE = 'COUNT_MODE'
+    WORKERS = 'WORKERS'
+    OUTPUTLINES = 'OUTPUTLINES'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.STOP_LYR, self.tr('Source'), [QgsProcessing.TypeVectorPoint],'Stops'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.STOP_IDFIELD, self.tr('Unique ID Field of Source Layer (Number)'),'stopid','STOP_LYR',0))      
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.STOP_TYPFIELD, self.tr('VHT Typ Field of Source Layer (String)'),'stoptyp','STOP_LYR',1))  
+        #self.addParameter(
+        #    QgsProcessingParameterField(
+        #        self.STOP_POLYGONIDFIELD, self.tr('Polygon ID Field of Source Layer (Any, but same as Matching Polygon ID Field)'),'polygonid','STOP_LYR'))  
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.POSSIBILITY_LYR, self.tr('Possibilities'), [QgsProcessing.TypeVectorPoint],'possibilities'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.POSSIBILITY_IDFIELD, self.tr('Unique Possibility ID Field (Number, should have a different name than Source ID field)'),'possibilityid','POSSIBILITY_LYR',0))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.POSSIBILITY_TYPFIELD, self.tr('VHT Typ Field of Possibilities (String, should have a different name than Source Typ field'),'posstyp','POSSIBILITY_LYR',1))
+        #self.addParameter(
+        #    QgsProcessingParameterField(
+        #        self.POSSIBILITY_POLYGONIDFIELD, self.tr('Polygon ID Field of Possibilities Layer (Any, but same as Source Polygon ID Field)'),'polygonid','POSSIBILITY_LYR'))  
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.LINES_LYR, self.tr('Intersection Lines'), [QgsProcessing.TypeVectorLine],'LinesTest'))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MAXDISTANCE, self.tr('Maxium Distance'), defaultValue = 125))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PRIOA, self.tr('Prio 1 Typ'), defaultValue = 'Einfahrt', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PRIOB, self.tr('Prio 2 Typ'), defaultValue = 'Kreuzung', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PRIOC, self.tr('Prio 3 Typ'), defaultValue = '', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PRIOD, self.tr('Prio 4 Typ'), defaultValue = '', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PRIOE, self.tr('Prio 5 Typ'), defaultValue = '', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PRIOF, self.tr('Prio 6 Typ'), defaultValue = '', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PRIOG, self.tr('Prio 7 Typ'), defaultValue = '', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.EXCLUDETYPA, self.tr('Exclude Typ 1'), defaultValue = 'nichts', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.EXCLUDETYPB, self.tr('Exclude Typ 2'), defaultValue = '', optional = 1))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OPERATION, self.tr('Remove ... number of intersections'), ['even','odd'],0,'even'))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COUNT_MODE, self.tr('Count intersections as'), ['Number of intersected lines','Number of crossing points'], defaultValue = 0))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of parallel worker processes (1 = no parallelization, 0 = use all CPU cores)'), type = 0, defaultValue = 1, minValue = 0))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUTLINES, self.tr('Output Lines'), QgsProcessing.TypeVectorLine))
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Get Parameters
+        possibility_layer = self.parameterAsSource(parameters, self.POSSIBILITY_LYR, context)
+        possibility_idfield = self.parameterAsFields(parameters, self.POSSIBILITY_IDFIELD, context)
+        possibility_typfield = self.parameterAsFields(parameters, self.POSSIBILITY_TYPFIELD, context)
+        stop_layer = self.parameterAsSource(parameters, self.STOP_LYR, context)
+        stop_idfield = self.parameterAsFields(parameters, self.STOP_IDFIELD, context)
+        stop_typfield = self.parameterAsFields(parameters, self.STOP_TYPFIELD, context)
+        lines_layer = self.parameterAsSource(parameters, self.LINES_LYR, context)
+        maxdistance = self.parameterAsDouble(parameters, self.MAXDISTANCE, context)
+        prio1 = self.parameterAsString(parameters, self.PRIOA, context)
+        prio2 = self.parameterAsString(parameters, self.PRIOB, context)
+        prio3 = self.parameterAsString(parameters, self.PRIOC, context)
+        prio4 = self.parameterAsString(parameters, self.PRIOD, context)
+        prio5 = self.parameterAsString(parameters, self.PRIOE, context)
+        prio6 = self.parameterAsString(parameters, self.PRIOF, context)
+        prio7 = self.parameterAsString(parameters, self.PRIOG, context)
+        excl1 = self.parameterAsString(parameters, self.EXCLUDETYPA, context)
+        excl2 = self.parameterAsString(parameters, self.EXCLUDETYPB, context)
+        operation = self.parameterAsString(parameters, self.OPERATION, context)
+        operationlist = [' == ',' != ']
+        expressionoperator = str(operationlist[int(operation[0])])        
+        count_crossings = self.parameterAsEnum(parameters, self.COUNT_MODE, context) == 1
+        n_workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        if n_workers == 0:
+            n_workers = os.cpu_count() or 1
+        if n_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            feedback.pushInfo(self.tr('Parallel processing needs the fork start method, which is not available on this platform. Continuing with one process.'))
+            n_workers = 1
+        blocksize = 200 # number of stops handed to a worker at once
+
+        #if possibility_idfield == stop_idfield:
+        #    iface.messageBar().pushMessage("Error!", "ID Felder haben die gleichen Namen", level=Qgis.Critical, duration=9)
+        #if possibility_typfield == stop_typfield:
+        #    iface.messageBar().pushMessage("Error!", "Typ Felder haben die gleichen Namen", level=Qgis.Critical, duration=9)
+        
+        fields = QgsFields()
+        fields.append(QgsField("possibility_id", QVariant.Int))
+        fields.append(QgsField("possibility_typ", QVariant.String))
+        fields.append(QgsField("possibility_priority", QVariant.Int))
+        fields.append(QgsField("stop_id", QVariant.Int))
+        fields.append(QgsField("stop_typ", QVariant.String))          
+        fields.append(QgsField("line_length", QVariant.Double, len=20, prec=5))
+        fields.append(QgsField("n_intersections", QVariant.Int))
+
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUTLINES, context,
+                                               fields, lines_layer.wkbType(),
+                                               lines_layer.sourceCrs())
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+        
+            prios = [prio1, prio2, prio3, prio4, prio5, prio6, prio7]
+            remove_even = expressionoperator == ' == ' # remove even or uneven number of intersections
+        
+            # read the possibilities once without the excludetyps, the priority only depends on the typ of the possibility
+            possibilities = []
+            possibility_index = QgsSpatialIndex() # the position in possibilities is used as id
+            for source_feat in possibility_layer.getFeatures():
+                possibility_typ = source_feat[possibility_typfield[0]]
+                if possibility_typ == excl1 or possibility_typ == excl2: # remove excludetyps
+                    continue
+                priority = prios.index(possibility_typ) + 1 if possibility_typ in prios else 9 # first matching prio typ, 9 if none matches
+                point = source_feat.geometry().asPoint()
+                possibility_index.addFeature(len(possibilities), QgsRectangle(point.x(), point.y(), point.x(), point.y()))
+                possibilities.append((QgsPoint(point), source_feat[possibility_idfield[0]], possibility_typ, priority))
+        
+            # explode the streets into straight segments once and put them into a grid with cells of the size of the maximum distance,
+            # the intersections of all lines of a stop are then counted at once against the segments of the cells around the stop
+            segment_x1, segment_y1, segment_x2, segment_y2, street_numbers, continues = street_segments(lines_layer, feedback)
+            street_grid = SegmentGrid(segment_x1, segment_y1, segment_x2, segment_y2, max(maxdistance, 1.0))
+            possibility_x = np.array([possibility[0].x() for possibility in possibilities], dtype=float)
+            possibility_y = np.array([possibility[0].y() for possibility in possibilities], dtype=float)
+            possibility_priorities = np.array([possibility[3] for possibility in possibilities], dtype=int)
+        
+            stops = [] # (id, typ, point) of every stop, read before the work is distributed to the workers
+            for stop_feat in stop_layer.getFeatures():
+                stops.append((stop_feat[stop_idfield[0]], stop_feat[stop_typfield[0]], stop_feat.geometry().asPoint()))
+        
+            def best_lines(stop_nr):
+                # Every line of the stop runs through all filters at once, only the best lines are kept: the lowest priority number and of these
+                # the shortest lines (several if they have the same length). Returns (priority, line_length) and [(possibility number, number of
+                # intersections)] of the kept lines, None if no line is left.
+                stop_point = stops[stop_nr][2]
+                # only lines to possibilities within the maximum distance are built
+                search_rect = QgsRectangle(stop_point.x() - maxdistance, stop_point.y() - maxdistance, stop_point.x() + maxdistance, stop_point.y() + maxdistance)
+                possibility_nrs = np.array(sorted(possibility_index.intersects(search_rect)), dtype=int)
+                line_dx = possibility_x[possibility_nrs] - stop_point.x()
+                line_dy = possibility_y[possibility_nrs] - stop_point.y()
+                line_lengths = np.sqrt(line_dx * line_dx + line_dy * line_dy)
+                keep = (line_lengths <= maxdistance) & (line_lengths >= 1) # remove lines which are too long or too short
+                possibility_nrs, line_lengths = possibility_nrs[keep], line_lengths[keep]
+            
+                # count intersections
+                segment_nrs = street_grid.segments_in(search_rect.xMinimum(), search_rect.yMinimum(), search_rect.xMaximum(), search_rect.yMaximum())
+                n_intersections = count_intersections(np.full(len(possibility_nrs), stop_point.x()), np.full(len(possibility_nrs), stop_point.y()),
+                                                      possibility_x[possibility_nrs], possibility_y[possibility_nrs],
+                                                      segment_x1[segment_nrs], segment_y1[segment_nrs], segment_x2[segment_nrs], segment_y2[segment_nrs],
+                                                      street_numbers[segment_nrs], continues[segment_nrs], count_crossings)
+                keep = (n_intersections % 2 == 0) != remove_even # remove unwanted number of intersections
+                if not keep.any():
+                    return None
+                possibility_nrs, line_lengths, n_intersections = possibility_nrs[keep], line_lengths[keep], n_intersections[keep]
+            
+                # keep the lowest priority and of these the nearest
+                priorities = possibility_priorities[possibility_nrs]
+                best_priority = priorities.min()
+                best_length = line_lengths[priorities == best_priority].min()
+                keep = (priorities == best_priority) & (line_lengths == best_length)
+                return (int(best_priority), float(best_length)), [(int(possibility_nr), int(n)) for possibility_nr, n in zip(possibility_nrs[keep], n_intersections[keep])]
+        
+            def search_block(block): # returns the best lines of every stop of the block
+                return [best_lines(stop_nr) for stop_nr in block]
+        
+            blocks = [range(start, min(start + blocksize, len(stops))) for start in range(0, len(stops), blocksize)]
+            if n_workers > 1:
+                block_results = run_blocks_in_workers(search_block, blocks, n_workers, feedback)
+            else:
+                block_results = (search_block(block) for block in blocks)
+        
+            # several stops can have the same id, of all their lines only the best are kept
+            winners = {} # stop id: [(priority, line_length) of the best lines, [(stop number, possibility number, number of intersections) of these lines]]
+            total = 100.0 / len(stops) if stops else 0
+            for block, results in zip(blocks, block_results): # in the order of the stops
+                if feedback.isCanceled():
+                    break
+                for stop_nr, lines in zip(block, results):
+                    if lines is None:
+                        continue
+                    key, kept = lines
+                    stop_id = stops[stop_nr][0]
+                    best = winners.get(stop_id)
+                    if best is not None and key > best[0]:
+                        continue
+                    kept = [(stop_nr, possibility_nr, n) for possibility_nr, n in kept]
+                    if best is None or key < best[0]:
+                        winners[stop_id] = [key, kept]
+                    else:
+                        best[1].extend(kept)
+                feedback.setProgress(int(block[-1] * total))
+            block_results.close() # stops the worker processes if the algorithm has been canceled
+        
+            # create output in the order of the stops and possibilities
+            for stop_nr, possibility_nr, n, key in sorted((line + (key,) for key, lines in winners.values() for line in lines), key = lambda line: line[:2]):
+                stop_id, stop_typ, stop_point = stops[stop_nr]
+                point2, possibility_id, possibility_typ, priority = possibilities[possibility_nr]
+                new_feat = QgsFeature(fields)
+                new_feat.setGeometry(QgsGeometry.fromPolyline([QgsPoint(stop_point), point2]))
+                new_feat.setAttributes([possibility_id, possibility_typ, priority, stop_id, stop_typ, key[1], n])
+                writer.addFeature(new_feat)
+        finally:
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+        
+        return {self.OUTPUTLINES: dest_id}
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return NumberOfIntersectionsBetweenPoints()
+
+    def name(self):
+        return 'NumberOfIntersectionsBetweenPoints'
+
+    def displayName(self):
+        return self.tr('Number Of Intersections Between Points')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
         return self.tr('...')
\ No newline at end of file
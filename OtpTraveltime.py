@@ -1,404 +1,829 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-# Version 1.0
-# Date: 2021-03-04
-# Tested with: QGIS 3.4.15 and QGIS 3.18.0 (recommend 3.18, as at least 3.4 crashes sometimes without any reason or error message, but works on the same data and same settings perfectly when trying another time)
-
-from PyQt5.QtCore import QCoreApplication, QVariant, QDate, QTime, QDateTime, Qt
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsDateTimeFieldFormatter,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
-from osgeo import ogr
-from datetime import *
-import os.path
-import os
-import urllib.request
-import urllib
-import json
-
-class OtpTraveltime(QgsProcessingAlgorithm):
-    
-    SERVER_URL = 'SERVER_URL'
-    SOURCE_LYR = 'SOURCE_LYR'
-    STARTLAT_FIELD = 'STARTLAT_FIELD'
-    STARTLON_FIELD = 'STARTLON_FIELD'
-    ENDLAT_FIELD = 'ENDLAT_FIELD'
-    ENDLON_FIELD = 'ENDLON_FIELD'
-    DATE_FIELD = 'DATE_FIELD'
-    TIME_FIELD = 'TIME_FIELD'
-    MODE = 'MODE'
-    OPTIMIZE = 'OPTIMIZE'
-    ADDITIONAL_PARAMS = 'ADDITIONAL_PARAMS'
-    ITERINARIES = 'ITERINARIES'
-    OUTPUT = 'OUTPUT'
-
-    def initAlgorithm(self, config=None):
-
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.SERVER_URL, self.tr('URL to OTP-Server including port and path to router ending with an /'),'http://localhost:8080/otp/routers/default/'))
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.SOURCE_LYR, self.tr('Sourcelayer'), [QgsProcessing.TypeMapLayer], defaultValue='otp_testdata'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.STARTLAT_FIELD, self.tr('Field containing Latitude of Startpoint'),'Start_Lat','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.STARTLON_FIELD, self.tr('Field containing Longitude of Startpoint'),'Start_Lon','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.ENDLAT_FIELD, self.tr('Field containing Latitude of Endpoint'),'End_Lat','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.ENDLON_FIELD, self.tr('Field containing Longitude of Endpoint'),'End_Lon','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.DATE_FIELD, self.tr('Field containing Date of Tripstart (or Tripend)'),'Start_date','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.TIME_FIELD, self.tr('Field containing Time of Tripstart (or Tripend)'),'Start_time','SOURCE_LYR'))
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.MODE, self.tr('Travelmode for Routes'),
-                ['WALK','CAR','BICYCLE','TRANSIT','WALK,TRANSIT','WALK,BICYCLE'],defaultValue=5))
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.OPTIMIZE, self.tr('Preferred Route Optimization'),
-                ['QUICK','TRANSFERS','SAFE','FLAT','GREENWAYS','TRIANGLE'],defaultValue=0))
-        self.addParameter(
-            QgsProcessingParameterString(
-                self.ADDITIONAL_PARAMS, self.tr('Additional Parameters as String, beginning with an & Sign'),'&maxTransfers=6&maxWalkDistance=10000&maxOffroadDistance=500',optional=True))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.ITERINARIES, self.tr('Number of Iterinaries'),type=0,defaultValue=1,minValue=1))
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT, self.tr('OTP Traveltime'))) # Output
-                
-
-        
-    def processAlgorithm(self, parameters, context, feedback):
-        # Get Parameters and assign to variable to work with
-        server_url = self.parameterAsString(parameters, self.SERVER_URL, context)
-        source_layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
-        startlat_field = self.parameterAsString(parameters, self.STARTLAT_FIELD, context)
-        startlon_field = self.parameterAsString(parameters, self.STARTLON_FIELD, context)
-        endlat_field = self.parameterAsString(parameters, self.ENDLAT_FIELD, context)
-        endlon_field = self.parameterAsString(parameters, self.ENDLON_FIELD, context)
-        date_field = self.parameterAsString(parameters, self.DATE_FIELD, context)
-        time_field = self.parameterAsString(parameters, self.TIME_FIELD, context)
-        travelmode = self.parameterAsString(parameters, self.MODE, context)
-        modelist = ['WALK','CAR','BICYCLE','TRANSIT','WALK,TRANSIT','WALK,BICYCLE']
-        travelmode = str(modelist[int(travelmode[0])])
-        traveloptimize = self.parameterAsString(parameters, self.OPTIMIZE, context)
-        optimizelist = ['QUICK','TRANSFERS','SAFE','FLAT','GREENWAYS','TRIANGLE']
-        traveloptimize = str(optimizelist[int(traveloptimize[0])])
-        
-        additional_params = self.parameterAsString(parameters, self.ADDITIONAL_PARAMS, context)
-        iterinaries = self.parameterAsInt(parameters, self.ITERINARIES, context)
-        
-        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
-        
-        fields = source_layer.fields() # get all fields of the sourcelayer
-        n_source_fields = source_layer.fields().count()
-        
-        fieldlist = [ # Master for attributes and varnames
-            QgsField("Route_RouteID", QVariant.Int),
-            QgsField("Route_RelationID", QVariant.Int),
-            QgsField("Route_From", QVariant.String), # !
-            QgsField("Route_To", QVariant.String), # !
-            QgsField("Route_Error", QVariant.String),
-            QgsField("Route_ErrorID", QVariant.Int),
-            QgsField("Route_ErrorDescription", QVariant.String),
-            QgsField("Route_URL", QVariant.String),
-            QgsField("Route_From_Lat", QVariant.Double, len=4, prec=8),
-            QgsField("Route_From_Lon", QVariant.Double, len=4, prec=8),
-            QgsField("Route_From_StopId", QVariant.String),
-            QgsField("Route_From_StopCode", QVariant.String),
-            QgsField("Route_From_Name", QVariant.String),
-            QgsField("Route_From_StartTime", QVariant.DateTime),
-            QgsField("Route_To_Lat", QVariant.Double, len=4, prec=8),
-            QgsField("Route_To_Lon", QVariant.Double, len=4, prec=8),
-            QgsField("Route_To_StopId", QVariant.String),
-            QgsField("Route_To_StopCode", QVariant.String),
-            QgsField("Route_To_Name", QVariant.String),
-            QgsField("Route_To_EndTime", QVariant.DateTime),
-            QgsField("Route_Total_Mode", QVariant.String),
-            QgsField("Route_Total_Duration", QVariant.Int),
-            QgsField("Route_Total_Transfers", QVariant.Int),
-            ]
-        for field in fieldlist:
-            fields.append(field) # add fields from the list
-        # Fieldindex as dictionary to avoid a mess
-        fieldindexcounter = 0 # start with index 0
-        fieldindexdict = {} # empty dictionary
-        for field in fields: # iterate through field list we just created above
-            x = str(field.name()).lower() # convert to lowercase, string
-            fieldindexdict[fieldindexcounter] = x # assign index as key and fieldname as value
-            if '_url' in x:
-                fieldindex_position_of_last_alwaysneededfield = fieldindexcounter
-            fieldindexcounter += 1
-        len_fieldindexdict = len(fieldindexdict)
-        
-        
-        # Counter
-        route_routeid = 0
-        route_relationid = 0
-        route_from = ''
-        route_to = ''
-        notavailablestring = None #'not available'
-        notavailableint = None #0
-        notavailableothers = None
-        
-        # some general settings
-        route_headers = {"accept":"application/json"} # this plugin only works for json responses
-        
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               fields, source_layer.wkbType(),
-                                               source_layer.sourceCrs())
-                                               
-        for current, source_feature in enumerate(source_layer.getFeatures()): # iterate over source
-        
-            route_relationid += 1
-            
-            # Making Script compatible with earlier versions than QGIS 3.18: If date or time field is a string, do not convert it to a string...
-            use_date = ''
-            use_time = ''
-            try:
-                use_date = str(source_feature[date_field].toString('yyyy-MM-dd'))
-            except:
-                use_date = str(source_feature[date_field])
-            try:
-                use_time = str(source_feature[time_field].toString('HH:mm:ss'))
-            except:
-                use_time = str(source_feature[time_field])
-            
-            # Create URL for current feature
-            route_url = (str(server_url) + "plan?" + # Add Plan request to server url
-                "fromPlace=" + str(source_feature[startlat_field]) + "," + str(source_feature[startlon_field]) +
-                "&toPlace=" + str(source_feature[endlat_field]) + "," + str(source_feature[endlon_field]) +
-                "&mode=" + travelmode +
-                "&date=" + use_date +
-                "&time=" + use_time +
-                "&numItineraries=" + str(iterinaries) +
-                "&optimize=" + traveloptimize +
-                additional_params # Additional Parameters entered as OTP-Readable string -> User responsibility
-            )
-            
-            #print(route_url)
-            
-            # Reset Error Indicators
-            route_error = 'Success'
-            route_error_bool = False
-            route_errorid = None
-            route_errordescription = None
-            route_errormessage = None
-            route_errornopath = None
-
-            try: # Try to request route
-                route_request = urllib.request.Request(route_url, headers=route_headers)
-                try: # Try to receive response
-                    route_response = urllib.request.urlopen(route_request)
-                    try: # Try to read response data
-                        response_data = route_response.read()
-                        encoding = route_response.info().get_content_charset('utf-8')
-                        route_data = json.loads(response_data.decode(encoding))
-                        try: # Check if response says Error
-                            route_error = 'Error: No Route'
-                            route_error_bool = True
-                            route_errorid = route_data['error']['id']
-                            route_errordescription = route_data['error']['msg']
-                            try: # not every error delivers this
-                                route_errormessage = route_data['error']['message']
-                            except:
-                                pass
-                            try: # not every error delivers this
-                                route_errornopath = route_data['error']['noPath']
-                            except:
-                                pass
-                        except:
-                            route_error = 'Success'
-                            route_error_bool = False
-                    except:
-                        route_error = 'Error: Cannot read response data'
-                        route_error_bool = True
-                except:
-                    route_error = 'Error: No response received'
-                    route_error_bool = True
-            except:
-                route_error = 'Error: Requesting the route failed'
-                route_error_bool = True
-            
-            #print(route_error)
-            try:
-                if not route_data['plan']['itineraries']: # check if response is empty
-                    route_error = 'Error: Empty response route'
-                    route_error_bool = True
-            except:
-                pass
-                
-            #print(route_data)
-            # Reading response
-            if route_error_bool == False:
-                # Get general informations. Note that not all are available in all responses: use try/except
-                try:
-                    route_from_lat = route_data['plan']['from']['lat']
-                    route_from_lon = route_data['plan']['from']['lon']
-                except:
-                    route_from_lat = notavailableint
-                    route_from_lon = notavailableint
-                try:
-                    route_from_stopid = route_data['plan']['from']['stopId']
-                except:
-                    route_from_stopid = notavailablestring
-                try:
-                    route_from_stopcode = route_data['plan']['from']['stopCode']
-                except:
-                    route_from_stopcode = notavailablestring
-                try:
-                    route_from_name = route_data['plan']['from']['name']
-                except:
-                    route_from_name = notavailablestring
-                try:
-                    route_to_lat = route_data['plan']['to']['lat']
-                    route_to_lon = route_data['plan']['to']['lon']
-                except:
-                    route_to_lat = notavailableint
-                    route_to_lon = notavailableint
-                try:
-                    route_to_stopid = route_data['plan']['to']['stopId']
-                except:
-                    route_to_stopid = notavailablestring
-                try:
-                    route_to_stopcode = route_data['plan']['to']['stopCode']
-                except:
-                    route_to_stopcode = notavailablestring
-                try:
-                    route_to_name = route_data['plan']['to']['name']
-                except:
-                    route_to_name = notavailablestring
-                
-                # loop through iterinaries    
-                for iter in route_data['plan']['itineraries']: 
-                    route_routeid += 1
-                    new_feature = QgsFeature(fields)
-                    try:
-                        route_from_starttime = iter['startTime']
-                        route_from_starttime = datetime.fromtimestamp(int(route_from_starttime)/1000)
-                        route_from_starttime = QDateTime.fromString(str(route_from_starttime),'yyyy-MM-dd hh:mm:ss')
-                    except:
-                        route_from_starttime = notavailableothers
-                    try:
-                        route_to_endtime = iter['endTime']
-                        route_to_endtime = datetime.fromtimestamp(int(route_to_endtime)/1000)
-                        route_to_endtime = QDateTime.fromString(str(route_to_endtime),'yyyy-MM-dd hh:mm:ss')
-                    except:
-                        route_to_endtime = notavailableothers
-                    try:
-                        route_total_duration = iter['duration']
-                    except:
-                        route_total_duration = notavailableint
-                    route_total_distance = 0 # set to 0 on start of each new route, well take the sum of all legs of a route
-                    route_total_mode = travelmode
-                    try:
-                        route_total_transittime = iter['transitTime']
-                    except:
-                        route_total_transittime = notavailableint
-                    try:
-                        route_total_waitingtime = iter['waitingTime']
-                    except:
-                        route_total_waitingtime = notavailableint
-                    try:
-                        route_total_walktime = iter['walkTime']
-                    except:
-                        route_total_walktime = notavailableint
-                    try:
-                        route_total_walkdistance = iter['walkDistance']
-                    except:
-                        route_total_walkdistance = notavailableint
-                    try:
-                        route_total_transfers = iter['transfers']
-                    except:
-                        route_total_transfers = notavailableint
-                    
-                    new_feature.setGeometry(source_feature.geometry())
-                    # Adding the attributes to resultlayer
-                    for key, value in fieldindexdict.items(): # keys contain the fieldindex, values the variablename which is the same as the fieldname, just in lowercase
-                        fieldindex = key
-                        if key < n_source_fields: # Copy source attributes from source layer
-                            fieldvalue = source_feature[fieldindex] # source_feature = sourcelayer-feature, new_feature = new feature
-                        else: # Get the leg attributes from variables
-                            fieldvalue = locals()[value] # variables are named exactly as the fieldnames, just lowercase, we adjusted that before
-                        new_feature.setAttribute(fieldindex,fieldvalue)
-                    sink.addFeature(new_feature, QgsFeatureSink.FastInsert) # add feature to the output
-                    # END OF LOOP iterinaries
-                    
-            # END OF if route_error_bool == False
-            else: # Create error-dummyfeature if no route has been returned
-                route_routeid += 1
-                new_feature = QgsFeature(fields)
-                try:
-                    route_errorid = route_data['error']['id']
-                except:
-                    route_errorid = notavailableint
-                try:
-                    route_errordescription = route_data['error']['msg']
-                except:
-                    route_errordescription = notavailablestring
-                try:
-                    route_errormessage = route_data['error']['message']
-                except:
-                    route_errormessage = notavailablestring
-                try:
-                    route_errornopath = route_data['error']['noPath']
-                except:
-                    route_errornopath = notavailablestring
-                
-                new_feature.setGeometry(source_feature.geometry())
-                # Adding the attributes to resultlayer
-                for key, value in fieldindexdict.items(): # keys contain the fieldindex, values the variablename which is the same as the fieldname, just in lowercase
-                    fieldindex = key
-                    if fieldindex < n_source_fields: # copy attributes from source layer
-                        fieldvalue = source_feature[fieldindex]
-                        new_feature[fieldindex] = fieldvalue
-                    elif fieldindex <= fieldindex_position_of_last_alwaysneededfield: # Only fill the first fields on error
-                        fieldvalue = locals()[value]
-                        new_feature[fieldindex] = fieldvalue
-                    else: # Leave the others empty as there is no data available
-                        fieldvalue = None
-                        new_feature[fieldindex] = fieldvalue
-                        
-                sink.addFeature(new_feature, QgsFeatureSink.FastInsert) # add feature to the output
-                # END OF errorroutecreation
-                
-            
-            if feedback.isCanceled(): # Cancel algorithm if button is pressed
-                break
-            
-            feedback.setProgress(int(current * total)) # Set Progress in Progressbar
-
-        return {self.OUTPUT: dest_id} # Return result of algorithm
-
-
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return OtpTraveltime()
-
-    def name(self):
-        return 'OtpTraveltime'
-
-    def displayName(self):
-        return self.tr('OpenTripPlanner Traveltime')
-
-    def group(self):
-        return self.tr('OpenTripPlanner')
-
-    def groupId(self):
-        return 'otp'
-
-    def shortHelpString(self):
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+# Version 1.0
+# Date: 2021-03-04
+# Tested with: QGIS 3.4.15 and QGIS 3.18.0 (recommend 3.18, as at least 3.4 crashes sometimes without any reason or error message, but works on the same data and same settings perfectly when trying another time)
+
+from PyQt5.QtCore import QCoreApplication, QVariant, QDate, QTime, QDateTime, Qt
+from qgis.core import (QgsApplication, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsDateTimeFieldFormatter,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+from osgeo import ogr
+from datetime import *
+import os.path
+import os
+import urllib.request
+import urllib
+import json
+import itertools
+import time
+import collections
+import concurrent.futures
+import base64
+import email.message
+import gzip
+import hashlib
+import http.client
+import sqlite3
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import zlib
+
+RESPONSE_CACHE_MAX_BYTES = 1024 ** 3 # the least recently used responses are removed when all of them together get larger
+RESPONSE_CACHE_BATCH_SIZE = 500 # new responses and access times are written to the cache file in one transaction when this many are collected
+HTTP_TIMEOUT = 60 # seconds a request waits for the server to answer, also bounds how long a canceled run waits for the running requests
+
+class OtpResponseCache:
+    # Responses of the OTP server in a SQLite file in the QGIS profile, shared by OtpRoutes and OtpTraveltime. The key is the
+    # canonical form of the request url: query parameters sorted, coordinates of fromPlace/toPlace rounded to 6 decimals. The data is
+    # stored zlib compressed, entries older than max_age seconds are removed and the least recently used ones when the cache gets larger
+    # than max_bytes. Every thread uses its own connection to the file. New responses and the access times of hits are collected in memory
+    # and written in one transaction per batch and at close().
+    def __init__(self, max_age, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        cache_dir = os.path.join(QgsApplication.qgisSettingsDirPath(), 'cache', 'otp_responses')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'responses.sqlite')
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.all_connections = []
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.errors = 0
+        self.new_responses = {} # key: (created, accessed, size, content_type, compressed data), not yet written
+        self.accessed = {} # key: time of the last hit, not yet written
+        connection = self.connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, content_type TEXT, data BLOB)')
+        connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        if connection.execute('PRAGMA user_version').fetchone()[0] < 1: # earlier versions stored error pages and server errors as well
+            connection.execute('DELETE FROM responses')
+            connection.execute('PRAGMA user_version = 1')
+        connection.execute('DELETE FROM responses WHERE created < ?', (time.time() - max_age,)) # expired
+        connection.commit()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL') # readers do not wait for the writer
+            connection.execute('PRAGMA synchronous=NORMAL') # a lost batch only means the responses are requested again
+            with self.lock:
+                self.all_connections.append(connection)
+        return connection
+
+    def key(self, url):
+        parts = urllib.parse.urlsplit(url)
+        params = []
+        for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True):
+            if name in ('fromPlace', 'toPlace'):
+                try:
+                    value = ','.join('%.6f' % float(coordinate) for coordinate in value.split(','))
+                except ValueError: # not a coordinate pair, e.g. a stop id
+                    pass
+            params.append((name, value))
+        canonical = urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urllib.parse.urlencode(sorted(params)), ''))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, url):
+        # Returns the cached response of the url, None if there is none
+        key = self.key(url)
+        with self.lock:
+            row = self.new_responses.get(key)
+        if row is not None:
+            row = row[3:]
+        else:
+            row = self.connection().execute('SELECT content_type, data FROM responses WHERE key = ? AND created >= ?', (key, time.time() - self.max_age)).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.accessed[key] = time.time()
+        if row is None:
+            return None
+        return OtpCachedResponse(row[0], zlib.decompress(row[1]))
+
+    def put(self, url, content_type, data):
+        # Adds the response of the url, writes the collected ones if there are enough for a batch. Raises sqlite3.Error if they can not be written.
+        compressed = zlib.compress(data)
+        now = time.time()
+        with self.lock:
+            self.new_responses[self.key(url)] = (now, now, len(compressed), content_type, compressed)
+            batch_full = len(self.new_responses) + len(self.accessed) >= RESPONSE_CACHE_BATCH_SIZE
+        if batch_full:
+            self.flush()
+
+    def flush(self):
+        # Writes the collected responses and access times in one transaction, they are dropped if that fails
+        with self.lock:
+            new_responses, self.new_responses = self.new_responses, {}
+            accessed, self.accessed = self.accessed, {}
+        if not new_responses and not accessed:
+            return
+        connection = self.connection()
+        with connection: # commits, or rolls back if writing fails
+            connection.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', [(key,) + row for key, row in new_responses.items()])
+            connection.executemany('UPDATE responses SET accessed = ? WHERE key = ?', [(accessed_time, key) for key, accessed_time in accessed.items()])
+        with self.lock:
+            self.stored += len(new_responses)
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def close(self):
+        # Writes the collected responses, removes the least recently used responses beyond the size limit and closes all connections
+        try:
+            self.flush()
+        except sqlite3.Error:
+            self.add_error()
+        connection = self.connection()
+        size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if size > self.max_bytes:
+            removed = []
+            for key, entry_size in connection.execute('SELECT key, size FROM responses ORDER BY accessed'):
+                if size <= self.max_bytes:
+                    break
+                removed.append((key,))
+                size -= entry_size
+            connection.executemany('DELETE FROM responses WHERE key = ?', removed)
+            connection.commit()
+        with self.lock:
+            for connection in self.all_connections:
+                connection.close()
+            self.all_connections = []
+
+class OtpCachedResponse:
+    # Response from the cache with the same read() and info() as OtpHttpResponse
+    def __init__(self, content_type, data):
+        self.headers = email.message.Message()
+        if content_type:
+            self.headers['Content-Type'] = content_type
+        self.data = data
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.data
+
+class OtpHttpClient:
+    # Keeps one persistent (keep-alive) connection per host and thread, so a pool of n threads uses at most n connections per host.
+    # Asks for gzip compressed responses and decompresses them. Proxies are taken from the system settings like urllib does.
+    # With a cache, responses found there are not requested. Received responses are added to it by request_route once they are checked.
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.all_connections = [] # of all threads, to close them at the end
+
+    def request(self, url, headers):
+        # Checks the url and prepares the request, raises ValueError if the url can not be requested
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('unknown url type: ' + url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        return url, key, path, dict(headers, **{'Accept-Encoding': 'gzip'})
+
+    def connection(self, key):
+        # Returns the connection of the current thread to the host, whether requests name the absolute url (plain http through a proxy),
+        # the headers for the proxy and whether the connection has been used before
+        connections = self.local.__dict__.setdefault('connections', {})
+        if key in connections:
+            return connections[key] + (True,)
+        scheme, host, port = key
+        proxy = urllib.request.getproxies().get(scheme)
+        if proxy and urllib.request.proxy_bypass(host):
+            proxy = None
+        absolute_url = False
+        proxy_headers = {}
+        if proxy:
+            proxy_parts = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+            if proxy_parts.username:
+                credentials = urllib.parse.unquote(proxy_parts.username) + ':' + urllib.parse.unquote(proxy_parts.password or '')
+                proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+            proxy_port = proxy_parts.port or (443 if proxy_parts.scheme == 'https' else 80)
+            if scheme == 'https': # tunnel through the proxy
+                connection = http.client.HTTPSConnection(proxy_parts.hostname, proxy_port, timeout = HTTP_TIMEOUT)
+                connection.set_tunnel(host, port, headers = proxy_headers)
+                proxy_headers = {} # only needed to open the tunnel
+            else: # the proxy gets the absolute url
+                connection = http.client.HTTPConnection(proxy_parts.hostname, proxy_port, timeout = HTTP_TIMEOUT)
+                absolute_url = True
+        elif scheme == 'https':
+            connection = http.client.HTTPSConnection(host, port, timeout = HTTP_TIMEOUT)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout = HTTP_TIMEOUT)
+        connections[key] = (connection, absolute_url, proxy_headers)
+        with self.lock:
+            self.all_connections.append(connection)
+        return connection, absolute_url, proxy_headers, False
+
+    def drop(self, key):
+        # Closes the connection of the current thread to the host, the next request opens a new one
+        connection = self.local.__dict__.get('connections', {}).pop(key, (None,))[0]
+        if connection is not None:
+            connection.close()
+
+    def send(self, request, redirects=5, original_url=None):
+        # Sends a GET request and returns the response, raises urllib.error.HTTPError for error status codes like urlopen.
+        # The response of a redirected request is cached under the original url.
+        url, key, path, headers = request
+        if self.cache is not None and original_url is None:
+            cached_response = self.cache.get(url)
+            if cached_response is not None:
+                return cached_response
+        for attempt in range(2):
+            connection, absolute_url, proxy_headers, reused = self.connection(key)
+            try:
+                connection.request('GET', url if absolute_url else path, headers = dict(headers, **proxy_headers))
+                response = connection.getresponse()
+                break
+            except (ConnectionError, http.client.BadStatusLine):
+                self.drop(key)
+                if not reused or attempt: # a connection used before may have been closed by the server meanwhile, try once with a new one
+                    raise
+            except Exception:
+                self.drop(key)
+                raise
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location') and redirects:
+            response.read()
+            return self.send(self.request(urllib.parse.urljoin(url, response.getheader('Location')), headers), redirects - 1, original_url or url)
+        if response.status >= 400:
+            response.read() # keeps the connection usable
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, None)
+        return OtpHttpResponse(self, key, response, original_url or url)
+
+    def close(self):
+        with self.lock:
+            for connection in self.all_connections:
+                connection.close()
+            self.all_connections = []
+
+class OtpHttpResponse:
+    # Response of OtpHttpClient.send(), read() returns the decompressed data
+    def __init__(self, client, key, response, url):
+        self.client = client
+        self.key = key
+        self.response = response
+        self.url = url
+
+    def info(self):
+        return self.response.msg
+
+    def read(self):
+        try:
+            data = self.response.read()
+        except Exception:
+            self.client.drop(self.key) # the rest of the response would be read as the next response
+            raise
+        if (self.response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            data = gzip.decompress(data)
+        return data
+
+def request_route(otp_client, route_url, route_headers):
+    # Sends the request of one route and reads the response, runs in a worker thread. Returns the error indicators,
+    # whether a response could be read and the response data.
+    route_error = 'Success'
+    route_error_bool = False
+    route_errorid = None
+    route_errordescription = None
+    route_errormessage = None
+    route_errornopath = None
+    route_data_read = False
+    route_data = None
+
+    try: # Try to request route
+        route_request = otp_client.request(route_url, route_headers)
+        try: # Try to receive response
+            route_response = otp_client.send(route_request)
+            try: # Try to read response data
+                response_data = route_response.read()
+                encoding = route_response.info().get_content_charset('utf-8')
+                route_data = json.loads(response_data.decode(encoding))
+                route_data_read = True
+                try: # Check if response says Error
+                    route_error = 'Error: No Route'
+                    route_error_bool = True
+                    route_errorid = route_data['error']['id']
+                    route_errordescription = route_data['error']['msg']
+                    try: # not every error delivers this
+                        route_errormessage = route_data['error']['message']
+                    except:
+                        pass
+                    try: # not every error delivers this
+                        route_errornopath = route_data['error']['noPath']
+                    except:
+                        pass
+                except:
+                    route_error = 'Success'
+                    route_error_bool = False
+            except:
+                route_error = 'Error: Cannot read response data'
+                route_error_bool = True
+        except:
+            route_error = 'Error: No response received'
+            route_error_bool = True
+    except:
+        route_error = 'Error: Requesting the route failed'
+        route_error_bool = True
+    if route_data_read and otp_client.cache is not None and isinstance(route_response, OtpHttpResponse) and isinstance(route_data, dict):
+        route_data_error = route_data.get('error')
+        if route_data_error is None or (isinstance(route_data_error, dict) and route_data_error.get('noPath') is True): # only routes and the deterministic 'no path' errors, never server errors
+            try:
+                otp_client.cache.put(route_response.url, route_response.info().get('Content-Type'), response_data)
+            except sqlite3.Error: # the route is used anyway, it is only not cached
+                otp_client.cache.add_error()
+    return route_error, route_error_bool, route_errorid, route_errordescription, route_errormessage, route_errornopath, route_data_read, route_data
+
+def responses_in_order(requests, send, n_threads, feedback):
+    # Yields (item, send(*args)) for every (item, args) of requests, in the order of requests. Up to n_threads requests run at the
+    # same time in a thread pool and at most twice as many are submitted ahead. On cancel (or when the generator is closed)
+    # no further requests are submitted, the waiting ones are dropped and the running ones are finished before it returns,
+    # so the connections and the cache they use can be closed afterwards.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads)
+    pending = collections.deque() # (item, future) in the order of requests
+    requests = iter(requests)
+    try:
+        while True:
+            while len(pending) < 2 * n_threads and not feedback.isCanceled():
+                request = next(requests, None)
+                if request is None:
+                    break
+                item, args = request
+                pending.append((item, executor.submit(send, *args)))
+            if not pending:
+                return
+            item, future = pending[0]
+            while True: # wait for the oldest request, but look for cancel in between
+                try:
+                    result = future.result(timeout=0.1)
+                    break
+                except concurrent.futures.TimeoutError:
+                    if feedback.isCanceled():
+                        return
+            pending.popleft()
+            yield item, result
+    finally:
+        for item, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+class RowBuilder:
+    # Output layout computed once: the attributes of an output feature are the concatenation of lists of values
+    # (e.g. source attributes + joined attributes + computed values) set at once, missing values at the end stay NULL.
+    def __init__(self, fields):
+        self.fields = fields
+        self.n_fields = fields.count()
+
+    def feature(self, geometry, *parts):
+        row = list(itertools.chain.from_iterable(parts))
+        if len(row) < self.n_fields:
+            row.extend([None] * (self.n_fields - len(row)))
+        feature = QgsFeature(self.fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes(row)
+        return feature
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class OtpTraveltime(QgsProcessingAlgorithm):
+    
+    SERVER_URL = 'SERVER_URL'
+    SOURCE_LYR = 'SOURCE_LYR'
+    STARTLAT_FIELD = 'STARTLAT_FIELD'
+    STARTLON_FIELD = 'STARTLON_FIELD'
+    ENDLAT_FIELD = 'ENDLAT_FIELD'
+    ENDLON_FIELD = 'ENDLON_FIELD'
+    DATE_FIELD = 'DATE_FIELD'
+    TIME_FIELD = 'TIME_FIELD'
+    MODE = 'MODE'
+    OPTIMIZE = 'OPTIMIZE'
+    ADDITIONAL_PARAMS = 'ADDITIONAL_PARAMS'
+    ITERINARIES = 'ITERINARIES'
+    REQUESTS = 'REQUESTS'
+    CACHE_DAYS = 'CACHE_DAYS'
+    OUTPUT = 'OUTPUT'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.SERVER_URL, self.tr('URL to OTP-Server including port and path to router ending with an /'),'http://localhost:8080/otp/routers/default/'))
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.SOURCE_LYR, self.tr('Sourcelayer'), [QgsProcessing.TypeMapLayer], defaultValue='otp_testdata'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.STARTLAT_FIELD, self.tr('Field containing Latitude of Startpoint'),'Start_Lat','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.STARTLON_FIELD, self.tr('Field containing Longitude of Startpoint'),'Start_Lon','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.ENDLAT_FIELD, self.tr('Field containing Latitude of Endpoint'),'End_Lat','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.ENDLON_FIELD, self.tr('Field containing Longitude of Endpoint'),'End_Lon','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.DATE_FIELD, self.tr('Field containing Date of Tripstart (or Tripend)'),'Start_date','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.TIME_FIELD, self.tr('Field containing Time of Tripstart (or Tripend)'),'Start_time','SOURCE_LYR'))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.MODE, self.tr('Travelmode for Routes'),
+                ['WALK','CAR','BICYCLE','TRANSIT','WALK,TRANSIT','WALK,BICYCLE'],defaultValue=5))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OPTIMIZE, self.tr('Preferred Route Optimization'),
+                ['QUICK','TRANSFERS','SAFE','FLAT','GREENWAYS','TRIANGLE'],defaultValue=0))
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.ADDITIONAL_PARAMS, self.tr('Additional Parameters as String, beginning with an & Sign'),'&maxTransfers=6&maxWalkDistance=10000&maxOffroadDistance=500',optional=True))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.ITERINARIES, self.tr('Number of Iterinaries'),type=0,defaultValue=1,minValue=1))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.REQUESTS, self.tr('Number of requests sent to the server at the same time'),type=0,defaultValue=1,minValue=1))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CACHE_DAYS, self.tr('Reuse responses of the same requests from a cache in the QGIS profile if they are not older than ... days (0 = no cache)'),type=1,defaultValue=0,minValue=0))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('OTP Traveltime'))) # Output
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+                
+
+        
+    def processAlgorithm(self, parameters, context, feedback):
+        # Get Parameters and assign to variable to work with
+        server_url = self.parameterAsString(parameters, self.SERVER_URL, context)
+        source_layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
+        startlat_field = self.parameterAsString(parameters, self.STARTLAT_FIELD, context)
+        startlon_field = self.parameterAsString(parameters, self.STARTLON_FIELD, context)
+        endlat_field = self.parameterAsString(parameters, self.ENDLAT_FIELD, context)
+        endlon_field = self.parameterAsString(parameters, self.ENDLON_FIELD, context)
+        date_field = self.parameterAsString(parameters, self.DATE_FIELD, context)
+        time_field = self.parameterAsString(parameters, self.TIME_FIELD, context)
+        travelmode = self.parameterAsString(parameters, self.MODE, context)
+        modelist = ['WALK','CAR','BICYCLE','TRANSIT','WALK,TRANSIT','WALK,BICYCLE']
+        travelmode = str(modelist[int(travelmode[0])])
+        traveloptimize = self.parameterAsString(parameters, self.OPTIMIZE, context)
+        optimizelist = ['QUICK','TRANSFERS','SAFE','FLAT','GREENWAYS','TRIANGLE']
+        traveloptimize = str(optimizelist[int(traveloptimize[0])])
+        
+        additional_params = self.parameterAsString(parameters, self.ADDITIONAL_PARAMS, context)
+        iterinaries = self.parameterAsInt(parameters, self.ITERINARIES, context)
+        n_requests = self.parameterAsInt(parameters, self.REQUESTS, context)
+        cache_days = self.parameterAsDouble(parameters, self.CACHE_DAYS, context)
+        
+        total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
+        
+        fields = source_layer.fields() # get all fields of the sourcelayer
+        n_source_fields = source_layer.fields().count()
+        
+        fieldlist = [ # Master for attributes and varnames
+            QgsField("Route_RouteID", QVariant.Int),
+            QgsField("Route_RelationID", QVariant.Int),
+            QgsField("Route_From", QVariant.String), # !
+            QgsField("Route_To", QVariant.String), # !
+            QgsField("Route_Error", QVariant.String),
+            QgsField("Route_ErrorID", QVariant.Int),
+            QgsField("Route_ErrorDescription", QVariant.String),
+            QgsField("Route_URL", QVariant.String),
+            QgsField("Route_From_Lat", QVariant.Double, len=4, prec=8),
+            QgsField("Route_From_Lon", QVariant.Double, len=4, prec=8),
+            QgsField("Route_From_StopId", QVariant.String),
+            QgsField("Route_From_StopCode", QVariant.String),
+            QgsField("Route_From_Name", QVariant.String),
+            QgsField("Route_From_StartTime", QVariant.DateTime),
+            QgsField("Route_To_Lat", QVariant.Double, len=4, prec=8),
+            QgsField("Route_To_Lon", QVariant.Double, len=4, prec=8),
+            QgsField("Route_To_StopId", QVariant.String),
+            QgsField("Route_To_StopCode", QVariant.String),
+            QgsField("Route_To_Name", QVariant.String),
+            QgsField("Route_To_EndTime", QVariant.DateTime),
+            QgsField("Route_Total_Mode", QVariant.String),
+            QgsField("Route_Total_Duration", QVariant.Int),
+            QgsField("Route_Total_Transfers", QVariant.Int),
+            ]
+        for field in fieldlist:
+            fields.append(field) # add fields from the list
+        # Fieldindex as dictionary to avoid a mess
+        fieldindexcounter = 0 # start with index 0
+        fieldindexdict = {} # empty dictionary
+        for field in fields: # iterate through field list we just created above
+            x = str(field.name()).lower() # convert to lowercase, string
+            fieldindexdict[fieldindexcounter] = x # assign index as key and fieldname as value
+            if '_url' in x:
+                fieldindex_position_of_last_alwaysneededfield = fieldindexcounter
+            fieldindexcounter += 1
+        len_fieldindexdict = len(fieldindexdict)
+        route_field_names = [str(field.name()).lower() for field in fieldlist] # the variables holding the values of a feature, in the order of the fields
+        error_field_names = route_field_names[:fieldindex_position_of_last_alwaysneededfield - n_source_fields + 1] # on error only the first fields are filled
+        rows = RowBuilder(fields)
+        
+        
+        # Counter
+        route_routeid = 0
+        route_relationid = 0
+        route_from = ''
+        route_to = ''
+        notavailablestring = None #'not available'
+        notavailableint = None #0
+        notavailableothers = None
+        
+        # some general settings
+        route_headers = {"accept":"application/json"} # this plugin only works for json responses
+        
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               fields, source_layer.wkbType(),
+                                               source_layer.sourceCrs())
+        otp_cache = OtpResponseCache(cache_days * 86400) if cache_days > 0 else None
+        otp_client = OtpHttpClient(otp_cache) # keep-alive connections of the threads sending the requests
+        route_responses = None
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+                                               
+            # the requests are built in the order of the source features and sent by a pool of threads, the responses are read in the same order
+            def route_requests():
+                for current, source_feature in enumerate(source_layer.getFeatures()): # iterate over source
+                    # Making Script compatible with earlier versions than QGIS 3.18: If date or time field is a string, do not convert it to a string...
+                    use_date = ''
+                    use_time = ''
+                    try:
+                        use_date = str(source_feature[date_field].toString('yyyy-MM-dd'))
+                    except:
+                        use_date = str(source_feature[date_field])
+                    try:
+                        use_time = str(source_feature[time_field].toString('HH:mm:ss'))
+                    except:
+                        use_time = str(source_feature[time_field])
+            
+                    # Create URL for current feature
+                    route_url = (str(server_url) + "plan?" + # Add Plan request to server url
+                        "fromPlace=" + str(source_feature[startlat_field]) + "," + str(source_feature[startlon_field]) +
+                        "&toPlace=" + str(source_feature[endlat_field]) + "," + str(source_feature[endlon_field]) +
+                        "&mode=" + travelmode +
+                        "&date=" + use_date +
+                        "&time=" + use_time +
+                        "&numItineraries=" + str(iterinaries) +
+                        "&optimize=" + traveloptimize +
+                        additional_params # Additional Parameters entered as OTP-Readable string -> User responsibility
+                    )
+                    yield (current, source_feature, route_url), (otp_client, route_url, route_headers)
+        
+            route_responses = responses_in_order(route_requests(), request_route, max(n_requests, 1), feedback)
+            for (current, source_feature, route_url), route_response in route_responses: # iterate over source
+        
+                route_relationid += 1
+            
+                # Error Indicators of the request, route_data keeps the last response read
+                route_error, route_error_bool, route_errorid, route_errordescription, route_errormessage, route_errornopath, route_data_read, received_data = route_response
+                if route_data_read:
+                    route_data = received_data
+            
+                #print(route_error)
+                try:
+                    if not route_data['plan']['itineraries']: # check if response is empty
+                        route_error = 'Error: Empty response route'
+                        route_error_bool = True
+                except:
+                    pass
+                
+                #print(route_data)
+                # Reading response
+                if route_error_bool == False:
+                    # Get general informations. Note that not all are available in all responses: use try/except
+                    try:
+                        route_from_lat = route_data['plan']['from']['lat']
+                        route_from_lon = route_data['plan']['from']['lon']
+                    except:
+                        route_from_lat = notavailableint
+                        route_from_lon = notavailableint
+                    try:
+                        route_from_stopid = route_data['plan']['from']['stopId']
+                    except:
+                        route_from_stopid = notavailablestring
+                    try:
+                        route_from_stopcode = route_data['plan']['from']['stopCode']
+                    except:
+                        route_from_stopcode = notavailablestring
+                    try:
+                        route_from_name = route_data['plan']['from']['name']
+                    except:
+                        route_from_name = notavailablestring
+                    try:
+                        route_to_lat = route_data['plan']['to']['lat']
+                        route_to_lon = route_data['plan']['to']['lon']
+                    except:
+                        route_to_lat = notavailableint
+                        route_to_lon = notavailableint
+                    try:
+                        route_to_stopid = route_data['plan']['to']['stopId']
+                    except:
+                        route_to_stopid = notavailablestring
+                    try:
+                        route_to_stopcode = route_data['plan']['to']['stopCode']
+                    except:
+                        route_to_stopcode = notavailablestring
+                    try:
+                        route_to_name = route_data['plan']['to']['name']
+                    except:
+                        route_to_name = notavailablestring
+                
+                    # loop through iterinaries    
+                    for iter in route_data['plan']['itineraries']: 
+                        route_routeid += 1
+                        try:
+                            route_from_starttime = iter['startTime']
+                            route_from_starttime = datetime.fromtimestamp(int(route_from_starttime)/1000)
+                            route_from_starttime = QDateTime.fromString(str(route_from_starttime),'yyyy-MM-dd hh:mm:ss')
+                        except:
+                            route_from_starttime = notavailableothers
+                        try:
+                            route_to_endtime = iter['endTime']
+                            route_to_endtime = datetime.fromtimestamp(int(route_to_endtime)/1000)
+                            route_to_endtime = QDateTime.fromString(str(route_to_endtime),'yyyy-MM-dd hh:mm:ss')
+                        except:
+                            route_to_endtime = notavailableothers
+                        try:
+                            route_total_duration = iter['duration']
+                        except:
+                            route_total_duration = notavailableint
+                        route_total_distance = 0 # set to 0 on start of each new route, well take the sum of all legs of a route
+                        route_total_mode = travelmode
+                        try:
+                            route_total_transittime = iter['transitTime']
+                        except:
+                            route_total_transittime = notavailableint
+                        try:
+                            route_total_waitingtime = iter['waitingTime']
+                        except:
+                            route_total_waitingtime = notavailableint
+                        try:
+                            route_total_walktime = iter['walkTime']
+                        except:
+                            route_total_walktime = notavailableint
+                        try:
+                            route_total_walkdistance = iter['walkDistance']
+                        except:
+                            route_total_walkdistance = notavailableint
+                        try:
+                            route_total_transfers = iter['transfers']
+                        except:
+                            route_total_transfers = notavailableint
+                    
+                        # Adding the attributes to resultlayer: source attributes + the itinerary attributes from variables
+                        variables = locals() # variables are named exactly as the fieldnames, just lowercase, we adjusted that before
+                        writer.addFeature(rows.feature(source_feature.geometry(), source_feature.attributes(), [variables[name] for name in route_field_names]))
+                        # END OF LOOP iterinaries
+                    
+                # END OF if route_error_bool == False
+                else: # Create error-dummyfeature if no route has been returned
+                    route_routeid += 1
+                    try:
+                        route_errorid = route_data['error']['id']
+                    except:
+                        route_errorid = notavailableint
+                    try:
+                        route_errordescription = route_data['error']['msg']
+                    except:
+                        route_errordescription = notavailablestring
+                    try:
+                        route_errormessage = route_data['error']['message']
+                    except:
+                        route_errormessage = notavailablestring
+                    try:
+                        route_errornopath = route_data['error']['noPath']
+                    except:
+                        route_errornopath = notavailablestring
+                
+                    # Adding the attributes to resultlayer: source attributes + the variables named like the first fields, the others stay empty
+                    variables = locals() # variables are named exactly as the fieldnames, just lowercase, we adjusted that before
+                    writer.addFeature(rows.feature(source_feature.geometry(), source_feature.attributes(), [variables[name] for name in error_field_names]))
+                    # END OF errorroutecreation
+                
+            
+                if feedback.isCanceled(): # Cancel algorithm if button is pressed
+                    break
+            
+                feedback.setProgress(int(current * total)) # Set Progress in Progressbar
+        finally:
+            if route_responses is not None:
+                route_responses.close() # drops the waiting requests and waits for the running ones if the algorithm has been canceled or failed
+            otp_client.close() # only after all threads using its connections have finished
+            if otp_cache is not None:
+                otp_cache.close()
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+        if otp_cache is not None:
+            feedback.pushInfo(self.tr('Response cache: {} responses taken from the cache, {} requested from the server, {} added to the cache.').format(otp_cache.hits, otp_cache.misses, otp_cache.stored))
+            if otp_cache.errors:
+                feedback.pushInfo(self.tr('Response cache: {} times the responses could not be written to the cache file.').format(otp_cache.errors))
+
+        return {self.OUTPUT: dest_id} # Return result of algorithm
+
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return OtpTraveltime()
+
+    def name(self):
+        return 'OtpTraveltime'
+
+    def displayName(self):
+        return self.tr('OpenTripPlanner Traveltime')
+
+    def group(self):
+        return self.tr('OpenTripPlanner')
+
+    def groupId(self):
+        return 'otp'
+
+    def shortHelpString(self):
         return self.tr('This Tool requests routes from an OTP instance based on a layer and creates a new layer, duplicated from the source (geometry and attributes), and adds a few attributes like total duration and transfers')
\ No newline at end of file
@@ -1,165 +1,736 @@
-# Author: Mario Königbauer
-# License: GNU General Public License v3.0
-
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes, QgsStringUtils,
-                       QgsProcessingAlgorithm, QgsProcessingParameterField, QgsProcessingParameterVectorLayer, QgsProcessingOutputVectorLayer, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
-
-class SelectDuplicatesBySimilarity(QgsProcessingAlgorithm):
-    SOURCE_LYR = 'SOURCE_LYR'
-    SOURCE_FIELD = 'SOURCE_FIELD'
-    MAX_DISTANCE = 'MAX_DISTANCE'
-    ALGORITHM = 'ALGORITHM'
-    ANDORALG = 'ANDORALG'
-    THRESHOLD_LEVENSHTEIN = 'THRESHOLD_LEVENSHTEIN'
-    THRESHOLD_SUBSTRING = 'THRESHOLD_SUBSTRING'
-    THRESHOLD_HAMMING = 'THRESHOLD_HAMMING'
-    OPERATOR = 'OPERATOR'
-    OUTPUT = 'OUTPUT'
-
-    def initAlgorithm(self, config=None):
-        
-        self.addParameter(
-            QgsProcessingParameterVectorLayer(
-                self.SOURCE_LYR, self.tr('Source Layer'))) # Take any source layer
-        self.addParameter(
-            QgsProcessingParameterField(
-                self.SOURCE_FIELD, self.tr('Attribute Field to search for similarity'),'Name','SOURCE_LYR')) # Choose the Trigger field of the source layer, default if exists is 'Trigger'
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.MAX_DISTANCE, self.tr('Maximum Search Distance for Duplicates in Layer CRS units'),1,10000))
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.ALGORITHM, self.tr('Select the Algorithms you want to use to identify similar attributes.'),
-                    ['Exact Duplicates',
-                    'Soundex',
-                    'Levenshtein Distance',
-                    'Longest Common Substring',
-                    'Hamming Distance'],
-                    allowMultiple=True,defaultValue=[1]))
-        self.addParameter(
-            QgsProcessingParameterEnum(
-                self.ANDORALG, self.tr('Choose if all selected algorithms need to fulfill criteria or only at least one'),['All','Only at least one'],defaultValue=0))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.THRESHOLD_LEVENSHTEIN, self.tr('Choose a Threshold for Levenshtein < Threshold'),0,None,True,0))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.THRESHOLD_SUBSTRING, self.tr('Choose a Threshold for Longest Common Substring > (Length of Attributevalue - Threshold)'),0,None,True,0))
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                self.THRESHOLD_HAMMING, self.tr('Choose a Threshold for Hamming Distance > (Length of Attributevalue - Threshold)'),0,None,True,0))
-        self.addOutput(QgsProcessingOutputVectorLayer(self.OUTPUT, self.tr('Possible Duplicates')))
-
-    def processAlgorithm(self, parameters, context, feedback):
-        # Get Parameters and assign to variable to work with
-        layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
-        field = self.parameterAsString(parameters, self.SOURCE_FIELD, context)
-        maxdist = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
-        th_levenshtein = self.parameterAsInt(parameters, self.THRESHOLD_LEVENSHTEIN, context)
-        th_substring = self.parameterAsInt(parameters, self.THRESHOLD_SUBSTRING, context)
-        th_hamming = self.parameterAsInt(parameters, self.THRESHOLD_HAMMING, context)
-        alg = self.parameterAsEnums(parameters, self.ALGORITHM, context)
-        ao = self.parameterAsInt(parameters, self.ANDORALG, context)
-        op = self.parameterAsString(parameters, self.OPERATOR, context)
-        
-        total = 100.0 / layer.featureCount() if layer.featureCount() else 0 # Initialize progress for progressbar
-        
-        layer.removeSelection() # clear selection before every run
-        #totalfeatcount = layer.featureCount()
-        
-        for current, feat in enumerate(layer.getFeatures()): # iterate over source 
-            s = None # reset selection indicator
-            s0 = None
-            s1 = None
-            s2 = None
-            s3 = None
-            s4 = None
-            th_levenshtein_new = th_levenshtein
-            th_substring_new  = th_substring
-            th_hamming_new = th_hamming
-            if feat[field] is not None and len(str(feat[field])) > 0: # only compare if field is not empty
-                # recalc thresholds based on current attribute values
-                th_levenshtein_new = th_levenshtein_new
-                if th_levenshtein_new < 0: # set to 0 if it would be negative
-                    th_levenshtein_new = 0
-                th_substring_new = len(str(feat[field])) - th_substring
-                if th_substring_new < 0: # set to 0 if it would be negative
-                    th_substring_new = 0
-                th_hamming_new = len(str(feat[field])) - th_hamming
-                if th_hamming_new < 0: # set to 0 if it would be negative
-                    th_hamming_new = 0            
-                for lookupnr in range(1,feat.id(),1): # only compare to previous features, because we do not want to select the first feature of each duplicate group
-                    lookup = layer.getFeature(lookupnr) # get the lookup-feature
-                    if lookup[field] is not None and len(str(lookup[field])) > 0: # only compare if field is not empty
-                        if feat.geometry().centroid().distance(lookup.geometry().centroid()) <= maxdist: # only select if within given maxdistance
-                            if 0 in alg: # Exact Duplicates
-                                if feat[field] == lookup[field]:
-                                    s0 = 1
-                                else: s0 = 0
-                            if 1 in alg: # Soundex
-                                if QgsStringUtils.soundex(str(feat[field])) == QgsStringUtils.soundex(str(lookup[field])):
-                                    s1 = 1
-                                else: s1 = 0
-                            if 2 in alg: # Levenshtein
-                                if QgsStringUtils.levenshteinDistance(str(feat[field]),str(lookup[field])) < th_levenshtein_new:
-                                    s2 = 1
-                                else: s2 = 0
-                            if 3 in alg: # Longest Common Substring
-                                if len(QgsStringUtils.longestCommonSubstring(str(feat[field]),str(lookup[field]))) > th_substring_new:
-                                    s3 = 1
-                                else: s3 = 0
-                            if 4 in alg: # Hamming Distance:
-                                if QgsStringUtils.hammingDistance(str(feat[field]),str(lookup[field])) > th_hamming_new:
-                                    s4 = 1  
-                                else: s4 = 0
-                                
-                            if ao == 0: # All chosen algorithms need to match
-                                if 0 in (s0, s1, s2, s3, s4): # Dont select current feature if at least one used algorithm returned 0
-                                    s = 0
-                                else: # Select current feature if all algorithms returned 1 or None
-                                    s = 1
-                            elif ao == 1: # Only at least one algorithm needs to match
-                                if 1 in (s0, s1, s2, s3, s4): # Select current feature if at least one used algorithm returned 1
-                                    s = 1
-                                else: # Dont select current feature if no used algorithm returned 1
-                                    s = 0
-                                    
-                            if s == 1: # select the current feature if indicator is true
-                                layer.select(feat.id())
-                            
-                if feedback.isCanceled(): # Cancel algorithm if button is pressed
-                    break
-            feedback.setProgress(int(current * total)) # Set Progress in Progressbar
-
-        return {self.OUTPUT: parameters[self.SOURCE_LYR]} # Return result of algorithm
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return SelectDuplicatesBySimilarity()
-
-    def name(self):
-        return 'SelectDuplicatesBySimilarity'
-
-    def displayName(self):
-        return self.tr('Select possible duplicate features by similarity (attribute and distance)')
-
-    def group(self):
-        return self.tr('FROM GISSE')
-
-    def groupId(self):
-        return 'from_gisse'
-
-    def shortHelpString(self):
-        return self.tr(
-        'This Algorithm selects possible duplicate features by their similarity. The first feature (ordered by feature id) in each group is NOT beeing selected. '
-        'You can choose between the following algorithms, and can also combine them: \n'
-        '- Exact Match: Matches if the attribue values are exactly the same \n'
-        '- Soundex: Matches by sound, as pronounced in English if both results are equal \n '
-        '- Levenshtein Distance: Matches if by measuring the difference between two sequences is lower than the threshold\n '
-        '- Longest Common Substring: Matches if the longest string that is a substring of compared value and greater than the threshold \n'
-        '- Hamming Distance: Matches if between two strings of equal length the number of positions at which the corresponding symbols are greater than the threshold \n '
-        'You can also choose a maximum search distance in CRS units. If the layer is not a single-point layer, the centroids are taken for distance calculation.'
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (QgsProviderRegistry, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes, QgsStringUtils, QgsSpatialIndex, QgsRectangle, QgsPointXY,
+                       QgsApplication, QgsCoordinateTransform, QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterDefinition, QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterVectorLayer, QgsProcessingParameterBoolean, QgsProcessingOutputVectorLayer, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+import bisect, glob, hashlib, math, multiprocessing, os, pickle, queue, random, sqlite3, sys, time, traceback, zlib
+import numpy as np
+
+def run_blocks_in_workers(search_block, blocks, n_workers, feedback):
+    # Yields search_block(block) for every block in the order of blocks, computed by n_workers forked processes.
+    # Forking shares everything search_block refers to (spatial index, attribute columns) read-only with the workers, nothing is pickled except the block numbers and the results.
+    # The workers take the next block from a shared queue, so a slow block only holds up one worker, and at most 2 * n_workers blocks are handed
+    # out ahead of the block yielded next, which limits the results waiting in memory. Ends early on cancel and raises if a worker fails or dies
+    # (e.g. killed by the system). Closing the generator early terminates all workers.
+    ctx = multiprocessing.get_context('fork')
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    def work():
+        try:
+            for block_nr in iter(tasks.get, None):
+                results.put((block_nr, search_block(blocks[block_nr]), None))
+        except Exception:
+            results.put((-1, None, traceback.format_exc())) # hand the error over to the main process instead of leaving it waiting
+    workers = [ctx.Process(target=work, daemon=True) for worker_nr in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    n_handed_out = 0
+    finished = {} # results arriving before their turn
+    try:
+        for block_nr in range(len(blocks)):
+            while n_handed_out < min(len(blocks), block_nr + 2 * n_workers):
+                tasks.put(n_handed_out)
+                n_handed_out += 1
+            while block_nr not in finished:
+                try:
+                    finished_nr, result, error = results.get(timeout=0.1)
+                except queue.Empty:
+                    if feedback.isCanceled():
+                        return
+                    for worker in workers:
+                        if worker.exitcode is not None: # workers only end when they are terminated
+                            raise QgsProcessingException('Worker process ended unexpectedly (exit code {}).'.format(worker.exitcode))
+                    continue
+                if error is not None:
+                    raise QgsProcessingException('Worker process failed:\n' + error)
+                finished[finished_nr] = result
+            yield finished.pop(block_nr)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+def levenshtein_below(query, candidates, threshold):
+    # Returns for every candidate string whether its Levenshtein distance to query is below threshold.
+    # Myers' bit-parallel algorithm: one bitmask operation per character of the candidate instead of a full row of the matrix.
+    # The distance of a candidate can drop by at most one per remaining character, so it is abandoned as soon as the threshold can not be undercut anymore.
+    m = len(query)
+    peq = {}
+    for i, c in enumerate(query):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1) if m else 0
+    results = []
+    for text in candidates:
+        n = len(text)
+        if abs(n - m) >= threshold: # distance is at least the length difference
+            results.append(False)
+            continue
+        vp = mask # vertical deltas of the current column are all +1 at the beginning
+        vn = 0
+        score = m # distance between query and the part of the candidate processed so far
+        below = True
+        for j, c in enumerate(text):
+            eq = peq.get(c, 0)
+            xv = eq | vn
+            xh = ((((eq & vp) + vp) & mask) ^ vp) | eq
+            ph = vn | (~(xh | vp) & mask)
+            mh = vp & xh
+            if ph & last:
+                score += 1
+            elif mh & last:
+                score -= 1
+            if score - (n - j - 1) >= threshold: # even if all remaining characters matched, the threshold is reached
+                below = False
+                break
+            ph = ((ph << 1) | 1) & mask
+            mh = (mh << 1) & mask
+            vp = mh | (~(xv | ph) & mask)
+            vn = ph & xv
+        results.append(below)
+    return results
+
+def minhash_signatures(shingle_sets, n_hashes, seed=42):
+    # Returns an array with one row of n_hashes MinHash values for every set of shingles (strings).
+    # Every hash function is (a * x + b) mod p on the crc32 of the shingle; all shingles of all sets are hashed at once per hash function.
+    prime = 4294967291 # largest prime below 2^32, so a * x + b fits into uint64
+    rng = random.Random(seed) # fixed seed: signatures are reproducible between runs
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingles in shingle_sets for shingle in shingles], dtype=np.uint64)
+    offsets = np.cumsum([0] + [len(shingles) for shingles in shingle_sets[:-1]]) # start of every set in hashes, every set needs at least one shingle
+    signatures = np.empty((len(shingle_sets), n_hashes), dtype=np.uint32)
+    if len(shingle_sets) == 0:
+        return signatures
+    for i in range(n_hashes):
+        a = np.uint64(rng.randrange(1, prime))
+        b = np.uint64(rng.randrange(0, prime))
+        signatures[:, i] = np.minimum.reduceat((a * hashes + b) % np.uint64(prime), offsets)
+    return signatures
+
+class UnionFind:
+    # Disjoint sets of feature ids, the smallest id of every set is its representative
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, fid):
+        parent = self.parent
+        parent.setdefault(fid, fid)
+        while parent[fid] != fid:
+            parent[fid] = parent[parent[fid]] # path halving keeps the trees flat
+            fid = parent[fid]
+        return fid
+
+    def union(self, fid1, fid2):
+        root1 = self.find(fid1)
+        root2 = self.find(fid2)
+        if root1 != root2:
+            if root2 < root1:
+                root1, root2 = root2, root1
+            self.parent[root2] = root1
+
+class BufferedSink:
+    # Collects output features and hands them to the sink with one addFeatures call as soon as batch_size features
+    # or max_bytes (estimated from the WKB and the attribute values, 0 = no limit) are buffered. Call close() at the end.
+    def __init__(self, sink, feedback, batch_size=1000, max_bytes=0):
+        self.sink = sink
+        self.feedback = feedback
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.features = []
+        self.n_bytes = 0
+        self.n_written = 0
+        self.n_flushes = 0
+        self.flush_seconds = 0.0
+        self.slowest_flush = 0.0
+
+    def feature_size(self, feature):
+        size = 0
+        if feature.hasGeometry():
+            geometry = feature.geometry().constGet()
+            size = geometry.wkbSize() if hasattr(geometry, 'wkbSize') else 16 * geometry.nCoordinates() # QgsAbstractGeometry.wkbSize() is new in QGIS 3.16, before that 16 bytes per vertex
+        for value in feature.attributes():
+            size += len(value) if isinstance(value, (str, bytes)) else 8
+        return size
+
+    def addFeature(self, feature):
+        self.features.append(feature)
+        if self.max_bytes:
+            self.n_bytes += self.feature_size(feature)
+        if len(self.features) >= self.batch_size or (self.max_bytes and self.n_bytes >= self.max_bytes):
+            self.flush()
+
+    def addFeatures(self, features):
+        for feature in features:
+            self.addFeature(feature)
+
+    def flush(self):
+        if not self.features:
+            return
+        start = time.perf_counter()
+        if not self.sink.addFeatures(self.features, QgsFeatureSink.FastInsert):
+            error = self.sink.lastError() if hasattr(self.sink, 'lastError') else '' # QgsFeatureSink.lastError() is new in QGIS 3.16
+            raise QgsProcessingException(error or 'Could not write features to the output')
+        seconds = time.perf_counter() - start
+        self.feedback.pushDebugInfo('Wrote {} features in {:.3f} s'.format(len(self.features), seconds))
+        self.n_written += len(self.features)
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.slowest_flush = max(self.slowest_flush, seconds)
+        self.features = []
+        self.n_bytes = 0
+
+    def close(self):
+        # Writes the rest of the buffered features. When called while an exception is raised (from a finally block), an error while writing
+        # is only reported so it does not hide the original one. The summary is left out if the algorithm has been canceled or failed.
+        failing = sys.exc_info()[0] is not None
+        try:
+            self.flush()
+        except Exception as error:
+            if not failing:
+                raise
+            self.feedback.reportError('The buffered features could not be written: {}'.format(error))
+            return
+        if self.n_flushes and not failing and not self.feedback.isCanceled():
+            self.feedback.pushInfo('Wrote {} features to the output in {} batches: {:.3f} s in total, slowest batch {:.3f} s'.format(
+                self.n_written, self.n_flushes, self.flush_seconds, self.slowest_flush))
+
+class SelectDuplicatesBySimilarity(QgsProcessingAlgorithm):
+    SOURCE_LYR = 'SOURCE_LYR'
+    SOURCE_FIELD = 'SOURCE_FIELD'
+    MAX_DISTANCE = 'MAX_DISTANCE'
+    ALGORITHM = 'ALGORITHM'
+    ANDORALG = 'ANDORALG'
+    THRESHOLD_LEVENSHTEIN = 'THRESHOLD_LEVENSHTEIN'
+    THRESHOLD_SUBSTRING = 'THRESHOLD_SUBSTRING'
+    THRESHOLD_HAMMING = 'THRESHOLD_HAMMING'
+    CANDIDATES = 'CANDIDATES'
+    MINHASH_SHINGLE = 'MINHASH_SHINGLE'
+    MINHASH_BANDS = 'MINHASH_BANDS'
+    MINHASH_ROWS = 'MINHASH_ROWS'
+    OPERATOR = 'OPERATOR'
+    WORKERS = 'WORKERS'
+    REFERENCE_LYR = 'REFERENCE_LYR'
+    REFERENCE_FIELD = 'REFERENCE_FIELD'
+    REBUILD_REFERENCE_INDEX = 'REBUILD_REFERENCE_INDEX'
+    OUTPUT = 'OUTPUT'
+    CLUSTERS = 'CLUSTERS'
+    BATCH_SIZE = 'BATCH_SIZE'
+    BATCH_MEGABYTES = 'BATCH_MEGABYTES'
+
+    def initAlgorithm(self, config=None):
+        
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.SOURCE_LYR, self.tr('Source Layer'))) # Take any source layer
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.SOURCE_FIELD, self.tr('Attribute Field to search for similarity'),'Name','SOURCE_LYR')) # Choose the Trigger field of the source layer, default if exists is 'Trigger'
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MAX_DISTANCE, self.tr('Maximum Search Distance for Duplicates in Layer CRS units'),1,10000))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.ALGORITHM, self.tr('Select the Algorithms you want to use to identify similar attributes.'),
+                    ['Exact Duplicates',
+                    'Soundex',
+                    'Levenshtein Distance',
+                    'Longest Common Substring',
+                    'Hamming Distance'],
+                    allowMultiple=True,defaultValue=[1]))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.ANDORALG, self.tr('Choose if all selected algorithms need to fulfill criteria or only at least one'),['All','Only at least one'],defaultValue=0))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.THRESHOLD_LEVENSHTEIN, self.tr('Choose a Threshold for Levenshtein < Threshold'),0,None,True,0))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.THRESHOLD_SUBSTRING, self.tr('Choose a Threshold for Longest Common Substring > (Length of Attributevalue - Threshold)'),0,None,True,0))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.THRESHOLD_HAMMING, self.tr('Choose a Threshold for Hamming Distance > (Length of Attributevalue - Threshold)'),0,None,True,0))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.CANDIDATES, self.tr('Search candidates by'),['Spatial Index (compares all features within the search distance)','MinHash / LSH (approximate, compares only features with similar attribute values)'],defaultValue=0))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MINHASH_SHINGLE, self.tr('MinHash / LSH: Length of the character shingles'),defaultValue=3,minValue=1))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MINHASH_BANDS, self.tr('MinHash / LSH: Number of bands (more bands find more pairs)'),defaultValue=16,minValue=1))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MINHASH_ROWS, self.tr('MinHash / LSH: Number of rows per band (more rows find less, but more similar pairs)'),defaultValue=4,minValue=1))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of parallel worker processes (1 = no parallelization, 0 = use all CPU cores)'),defaultValue=1,minValue=0))
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.REFERENCE_LYR, self.tr('Already cleaned Reference Layer (if set, only new features of the Source Layer are compared to it and to each other)'),optional=True))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.REFERENCE_FIELD, self.tr('Attribute Field of the Reference Layer (if none is chosen, the field with the same name as in the Source Layer is used)'),parentLayerParameterName='REFERENCE_LYR',optional=True))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.REBUILD_REFERENCE_INDEX, self.tr('Rebuild the stored index of the Reference Layer (needed if existing reference features have been edited; added and deleted features and reused feature ids are detected)'),defaultValue=False))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.CLUSTERS, self.tr('Duplicate Clusters'), optional=True, createByDefault=False)) # Optional output of all features belonging to a group of duplicates
+        self.addOutput(QgsProcessingOutputVectorLayer(self.OUTPUT, self.tr('Possible Duplicates')))
+        batch_size_param = QgsProcessingParameterNumber(
+            self.BATCH_SIZE, self.tr('Number of features written to the output at once'), type = 0, defaultValue = 1000, minValue = 1)
+        batch_size_param.setFlags(batch_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size_param)
+        batch_megabytes_param = QgsProcessingParameterNumber(
+            self.BATCH_MEGABYTES, self.tr('Write the buffered features to the output at the latest when they reach this size in MB (0 = no limit)'), type = 1, defaultValue = 16, minValue = 0)
+        batch_megabytes_param.setFlags(batch_megabytes_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_megabytes_param)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Get Parameters and assign to variable to work with
+        layer = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
+        field = self.parameterAsString(parameters, self.SOURCE_FIELD, context)
+        maxdist = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
+        th_levenshtein = self.parameterAsInt(parameters, self.THRESHOLD_LEVENSHTEIN, context)
+        th_substring = self.parameterAsInt(parameters, self.THRESHOLD_SUBSTRING, context)
+        th_hamming = self.parameterAsInt(parameters, self.THRESHOLD_HAMMING, context)
+        alg = self.parameterAsEnums(parameters, self.ALGORITHM, context)
+        ao = self.parameterAsInt(parameters, self.ANDORALG, context)
+        candidatemethod = self.parameterAsInt(parameters, self.CANDIDATES, context)
+        shinglelength = self.parameterAsInt(parameters, self.MINHASH_SHINGLE, context)
+        bands = self.parameterAsInt(parameters, self.MINHASH_BANDS, context)
+        rows = self.parameterAsInt(parameters, self.MINHASH_ROWS, context)
+        op = self.parameterAsString(parameters, self.OPERATOR, context)
+        n_workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        if n_workers == 0:
+            n_workers = os.cpu_count() or 1
+        if n_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            feedback.pushInfo(self.tr('Parallel processing needs the fork start method, which is not available on this platform. Continuing with one process.'))
+            n_workers = 1
+        tilefeatures = 2000 # average number of features in a tile handed to a worker at once
+        reference_layer = self.parameterAsLayer(parameters, self.REFERENCE_LYR, context)
+        reference_field = self.parameterAsString(parameters, self.REFERENCE_FIELD, context)
+        if not reference_field:
+            reference_field = field
+        rebuild_reference_index = self.parameterAsBool(parameters, self.REBUILD_REFERENCE_INDEX, context)
+        if reference_layer is not None and (reference_layer.id() == layer.id() or (reference_layer.source() == layer.source() and reference_layer.subsetString() == layer.subsetString())):
+            raise QgsProcessingException(self.tr('The reference layer is the source layer itself, every feature would be a duplicate of itself. Choose the already cleaned layer as reference or no reference layer.'))
+        
+        total = 100.0 / layer.featureCount() if layer.featureCount() else 0 # Initialize progress for progressbar
+        
+        layer.removeSelection() # clear selection before every run
+        
+        # read the layer only once: keep the attribute value and the centroid of every feature and put the centroids into a spatial index
+        values = {}
+        centroids = {}
+        centroid_idx = QgsSpatialIndex()
+        for feat in layer.getFeatures():
+            if feat[field] is not None and len(str(feat[field])) > 0 and not feat.geometry().isNull(): # only compare if field and geometry are not empty
+                values[feat.id()] = feat[field]
+                centroid = feat.geometry().centroid().asPoint()
+                centroids[feat.id()] = centroid
+                centroid_idx.addFeature(feat.id(), QgsRectangle(centroid.x(), centroid.y(), centroid.x(), centroid.y()))
+            if feedback.isCanceled():
+                return {}
+        
+        # blocking keys, computed once per feature and used to reject pairs before any expensive comparison
+        qgram = 2 # length of the q-grams used for blocking
+        soundexes = {} # soundex code
+        lengths = {} # length as counted by QgsStringUtils (UTF-16 code units)
+        qgrams = {} # set of q-grams of the lowercased value, None if lowercasing changes the length (the filters would not be safe then)
+        lowered = {} # lowercased value for the bit-parallel levenshtein kernel
+        def add_keys(fid, value, soundex=None):
+            value = str(value)
+            lengths[fid] = len(value.encode('utf-16-le')) // 2
+            value_lower = value.lower() # QgsStringUtils compares case insensitive by default
+            if len(value_lower) == len(value) == lengths[fid]:
+                qgrams[fid] = frozenset(value_lower[i:i + qgram] for i in range(max(1, len(value_lower) - qgram + 1)))
+            else:
+                qgrams[fid] = None
+            if 1 in alg:
+                soundexes[fid] = soundex if soundex is not None else QgsStringUtils.soundex(value)
+            if qgrams[fid] is not None and max(value) < '\u0250': # latin characters only, their lowercase mapping is the same in Python and Qt
+                lowered[fid] = value_lower
+            else:
+                lowered[fid] = None # let QgsStringUtils compute the distance
+        
+        for fid, value in values.items():
+            add_keys(fid, value)
+        delta_fids = sorted(values) # the features of the source layer, all further features are loaded from the reference layer
+        
+        # MinHash / LSH: features whose signatures are equal in at least one band become candidates, the chosen algorithms verify them afterwards.
+        # Features with the same (lowercased) value are banded once as a value group, so many identical or empty values do not fill the buckets.
+        lsh_members = [] # value group: sorted fids with this value
+        lsh_group_of = {} # fid: value group
+        lsh_groups = {} # value group: value groups sharing a band with it (including itself)
+        lsh_skipped = set() # value groups in a bucket with too many distinct values, their features are searched in the spatial index
+        lshmaxbucketsize = 1000 # a band bucket with more distinct values is too unspecific to compare all of them with each other
+        if candidatemethod == 1:
+            value_groups = {}
+            for fid in sorted(values):
+                value_groups.setdefault(str(values[fid]).lower(), []).append(fid)
+            shingle_sets = []
+            for value_lower, fids in value_groups.items():
+                for fid in fids:
+                    lsh_group_of[fid] = len(lsh_members)
+                lsh_members.append(fids)
+                shingle_sets.append({value_lower[i:i + shinglelength] for i in range(max(1, len(value_lower) - shinglelength + 1))})
+            signatures = minhash_signatures(shingle_sets, bands * rows)
+            n_skippedbuckets = 0
+            for band in range(bands):
+                band_buckets = {}
+                for group, signature in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+                    band_buckets.setdefault(signature.tobytes(), []).append(group)
+                for bucket_groups in band_buckets.values():
+                    if len(bucket_groups) > lshmaxbucketsize:
+                        lsh_skipped.update(bucket_groups)
+                        n_skippedbuckets += 1
+                        continue
+                    for group in bucket_groups:
+                        lsh_groups.setdefault(group, set()).update(bucket_groups)
+                if feedback.isCanceled():
+                    return {}
+            n_candidatepairs = 0
+            for group, linked_groups in lsh_groups.items():
+                if group not in lsh_skipped:
+                    n_candidatepairs += len(lsh_members[group]) * (len(lsh_members[group]) - 1) // 2 + sum(len(lsh_members[group]) * len(lsh_members[linked]) for linked in linked_groups if linked < group)
+            feedback.pushInfo(self.tr('MinHash / LSH: {} candidate pairs found with {} bands of {} rows ({} comparisons without LSH).').format(n_candidatepairs, bands, rows, len(lsh_group_of) * (len(lsh_group_of) - 1) // 2))
+            if n_skippedbuckets:
+                feedback.pushInfo(self.tr('MinHash / LSH: {} band buckets contain more than {} distinct values, the candidates of their {} features are searched in the spatial index instead.').format(
+                    n_skippedbuckets, lshmaxbucketsize, sum(len(lsh_members[group]) for group in lsh_skipped)))
+            feedback.pushInfo(self.tr('MinHash / LSH: Pairs are found with a probability of 50% at a shingle similarity (Jaccard) of about {:.2f}.').format((1 / bands) ** (1 / rows)))
+            for jaccard in (0.3, 0.5, 0.7, 0.9): # probability that a pair with this similarity shares at least one band
+                feedback.pushInfo(self.tr('MinHash / LSH: Theoretical recall (S-curve of the bands, not measured) for pairs with a shingle similarity of {:.1f}: {:.1%}').format(jaccard, 1 - (1 - jaccard ** rows) ** bands))
+        
+        # if all algorithms need to match, exact duplicates and soundex allow to look up candidates in buckets of equal keys instead of the spatial index
+        buckets = None
+        if ao == 0 and (0 in alg or 1 in alg) and candidatemethod == 0:
+            bucketkeys = soundexes if 1 in alg else values
+            buckets = {}
+            try:
+                for fid in sorted(values):
+                    buckets.setdefault(bucketkeys[fid], []).append(fid)
+            except TypeError: # attribute type without hash, fall back to the spatial index only
+                buckets = None
+        maxbucketsize = 64 # use the bucket instead of the spatial index if it contains at most this many previous features
+        
+        # incremental mode: compare the source layer (new features) also to the stored index of the reference layer. Reference features get keys below all
+        # source feature ids, so they count as previous features: they are never selected and every source feature similar to one of them is.
+        reference_candidates = {} # fid: keys of nearby reference features
+        reference_fids = {} # key: fid in the reference layer
+        if reference_layer is not None and delta_fids:
+            index_path = self.update_reference_index(reference_layer, reference_field, layer.crs(), rebuild_reference_index, context, feedback)
+            if index_path is None:
+                return {}
+            connection = sqlite3.connect(index_path)
+            max_reference_fid = connection.execute('SELECT MAX(fid) FROM features').fetchone()[0] or 0
+            key_offset = min(delta_fids) - max_reference_fid - 1 # key = reference fid + key_offset
+            for fid in delta_fids:
+                rows = None
+                if buckets is not None and 1 in alg: # all algorithms need to match, so look up reference features with the same soundex
+                    rows = connection.execute('SELECT fid FROM features WHERE soundex = ? LIMIT ?', (soundexes[fid], maxbucketsize + 1)).fetchall()
+                    if len(rows) > maxbucketsize:
+                        rows = None
+                if rows is None:
+                    centroid = centroids[fid]
+                    rows = connection.execute('SELECT fid FROM features_rtree WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?',
+                                              (centroid.x() + maxdist, centroid.x() - maxdist, centroid.y() + maxdist, centroid.y() - maxdist)).fetchall()
+                reference_candidates[fid] = [reference_fid + key_offset for (reference_fid,) in rows]
+                to_load = [reference_fid for (reference_fid,) in rows if reference_fid + key_offset not in values]
+                if to_load:
+                    for reference_fid, x, y, value, soundex in connection.execute('SELECT fid, x, y, value, soundex FROM features WHERE fid IN ({})'.format(','.join('?' * len(to_load))), to_load):
+                        key = reference_fid + key_offset
+                        values[key] = pickle.loads(value)
+                        centroids[key] = QgsPointXY(x, y)
+                        reference_fids[key] = reference_fid
+                        add_keys(key, values[key], soundex)
+                if feedback.isCanceled():
+                    return {}
+            connection.close()
+            feedback.pushInfo(self.tr('{} features of the reference layer are near to or share keys with the new features.').format(len(reference_fids)))
+        
+        def algorithm_matches(a, fid, lookup_fid): # check a single algorithm, cheap filters first
+            if a == 0: # Exact Duplicates
+                return values[fid] == values[lookup_fid]
+            elif a == 1: # Soundex
+                return soundexes[fid] == soundexes[lookup_fid]
+            elif a == 2: # Levenshtein
+                th_levenshtein_new = th_levenshtein
+                if th_levenshtein_new <= 0: # distance can not be lower than 0
+                    return False
+                q1 = qgrams[fid]
+                q2 = qgrams[lookup_fid]
+                if q1 is not None and q2 is not None:
+                    if abs(lengths[fid] - lengths[lookup_fid]) >= th_levenshtein_new: # distance is at least the length difference
+                        return False
+                    # each edit destroys at most q q-grams, so strings within distance k share at least (number of q-grams - k * q) of them
+                    if len(q1 & q2) < max(len(q1), len(q2)) - (th_levenshtein_new - 1) * qgram:
+                        return False
+                if lowered[fid] is not None and lowered[lookup_fid] is not None: # only run the kernel on the candidates the filters and cheaper algorithms left over
+                    return levenshtein_below(lowered[fid], [lowered[lookup_fid]], th_levenshtein_new)[0]
+                return QgsStringUtils.levenshteinDistance(str(values[fid]),str(values[lookup_fid])) < th_levenshtein_new
+            elif a == 3: # Longest Common Substring
+                th_substring_new = len(str(values[fid])) - th_substring
+                if th_substring_new < 0: # set to 0 if it would be negative
+                    th_substring_new = 0
+                q1 = qgrams[fid]
+                q2 = qgrams[lookup_fid]
+                if q1 is not None and q2 is not None:
+                    if min(lengths[fid], lengths[lookup_fid]) <= th_substring_new: # the common substring can not be longer than the shorter value
+                        return False
+                    if th_substring_new + 1 >= qgram and q1.isdisjoint(q2): # a common substring of at least q characters means a common q-gram
+                        return False
+                return len(QgsStringUtils.longestCommonSubstring(str(values[fid]),str(values[lookup_fid]))) > th_substring_new
+            elif a == 4: # Hamming Distance
+                if lengths[fid] != lengths[lookup_fid]: # hamming distance is only defined for values of equal length
+                    return False
+                th_hamming_new = len(str(values[fid])) - th_hamming
+                if th_hamming_new < 0: # set to 0 if it would be negative
+                    th_hamming_new = 0
+                return QgsStringUtils.hammingDistance(str(values[fid]),str(values[lookup_fid])) > th_hamming_new
+        
+        algorder = [a for a in (0, 1, 4, 2, 3) if a in alg] # cheapest algorithms first
+        
+        def similarity(fid, lookup_fid): # compare the attribute values of two features by the chosen algorithms, returns None if they are no duplicates, else the share of chosen algorithms that matched
+            n_matched = 0
+            for a in algorder:
+                if algorithm_matches(a, fid, lookup_fid):
+                    n_matched += 1
+                    if ao == 1 and not all_pairs: # Only at least one algorithm needs to match and no score is needed
+                        return n_matched / len(algorder)
+                elif ao == 0: # All chosen algorithms need to match
+                    return None
+            if ao == 1 and n_matched == 0:
+                return None
+            return n_matched / len(algorder) if algorder else 1.0
+        
+        clusterfields = QgsFields()
+        clusterfields.append(QgsField('source_fid', QVariant.LongLong))
+        clusterfields.append(QgsField('cluster_id', QVariant.Int))
+        clusterfields.append(QgsField('representative_fid', QVariant.LongLong))
+        clusterfields.append(QgsField('best_score', QVariant.Double, len=20, prec=5))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.CLUSTERS, context,
+                                               clusterfields, layer.wkbType(),
+                                               layer.sourceCrs())
+        all_pairs = sink is not None # all similar pairs are needed to build the clusters, otherwise the first similar previous feature is enough
+        
+        def compare_tile(tile): # compares the features of a tile to their previous candidates, returns the number of compared pairs and the similar pairs as (fid, lookup_fid, score)
+            n_compared = 0
+            pairs = []
+            for fid in tile:
+                centroid = centroids[fid]
+                bucket = None
+                if candidatemethod == 1 and lsh_group_of[fid] not in lsh_skipped:
+                    bucket = sorted(lookup_fid for group in lsh_groups[lsh_group_of[fid]] for lookup_fid in lsh_members[group][:bisect.bisect_left(lsh_members[group], fid)])
+                    candidates = bucket
+                elif buckets is not None:
+                    bucket = buckets[bucketkeys[fid]]
+                    previous_in_bucket = bisect.bisect_left(bucket, fid)
+                    if previous_in_bucket <= maxbucketsize:
+                        candidates = bucket[:previous_in_bucket]
+                    else:
+                        bucket = None
+                if bucket is None:
+                    searchrect = QgsRectangle(centroid.x() - maxdist, centroid.y() - maxdist, centroid.x() + maxdist, centroid.y() + maxdist)
+                    candidates = centroid_idx.intersects(searchrect) # only look at features whose centroid is near the current one
+                # only compare to previous features, because we do not want to select the first feature of each duplicate group
+                # and only select if within given maxdistance
+                candidates = [lookup_fid for lookup_fid in candidates if lookup_fid < fid and centroid.distance(centroids[lookup_fid]) <= maxdist]
+                candidates += [lookup_fid for lookup_fid in reference_candidates.get(fid, ()) if centroid.distance(centroids[lookup_fid]) <= maxdist]
+                n_compared += len(candidates)
+                for lookup_fid in candidates:
+                    score = similarity(fid, lookup_fid)
+                    if score is not None:
+                        pairs.append((fid, lookup_fid, score))
+                        if not all_pairs:
+                            break
+            return n_compared, pairs
+        
+        # split the features into square tiles by their centroid. Every pair is compared in the tile of its later feature,
+        # its candidates reach up to the search distance into the neighboring tiles (halo), which the workers read from the shared index.
+        tiles = {}
+        if delta_fids:
+            xmin = min(centroids[fid].x() for fid in delta_fids)
+            ymin = min(centroids[fid].y() for fid in delta_fids)
+            area = max((max(centroids[fid].x() for fid in delta_fids) - xmin) * (max(centroids[fid].y() for fid in delta_fids) - ymin), 1e-12)
+            tilesize = max(maxdist, math.sqrt(area * tilefeatures / len(delta_fids)), 1e-12)
+            for fid in delta_fids:
+                tiles.setdefault((int((centroids[fid].x() - xmin) // tilesize), int((centroids[fid].y() - ymin) // tilesize)), []).append(fid)
+        tiles = [tiles[key] for key in sorted(tiles)]
+        
+        if n_workers > 1:
+            tile_results = run_blocks_in_workers(compare_tile, tiles, n_workers, feedback)
+        else:
+            tile_results = (compare_tile(tile) for tile in tiles)
+        
+        n_comparedpairs = 0
+        pairs = []
+        current = 0
+        for tile, (n_compared, tile_pairs) in zip(tiles, tile_results):
+            n_comparedpairs += n_compared
+            pairs.extend(tile_pairs)
+            current += len(tile)
+            if feedback.isCanceled(): # Cancel algorithm if button is pressed
+                break
+            feedback.setProgress(int(current * total)) # Set Progress in Progressbar
+        tile_results.close() # stops the worker processes if the algorithm has been canceled
+        
+        # merge the pairs of all tiles independent of their order, so the result does not depend on the number of workers
+        pairs.sort()
+        selected = sorted({fid for fid, lookup_fid, score in pairs}) # select every feature that is similar to a previous one
+        clusters = UnionFind()
+        best_scores = {}
+        if all_pairs:
+            for fid, lookup_fid, score in pairs:
+                clusters.union(fid, lookup_fid)
+                best_scores[fid] = max(score, best_scores.get(fid, score))
+                best_scores[lookup_fid] = max(score, best_scores.get(lookup_fid, score))
+        
+        layer.selectByIds(selected) # select all at once instead of one by one
+        feedback.pushInfo(self.tr('{} candidate pairs within the search distance have been compared, {} features have been selected.').format(n_comparedpairs, len(selected)))
+        
+        if not all_pairs:
+            return {self.OUTPUT: parameters[self.SOURCE_LYR]} # Return result of algorithm
+        
+        cluster_ids = {} # representative fid: cluster id, numbered in order of the representatives
+        for representative in sorted({clusters.find(fid) for fid in best_scores}):
+            cluster_ids[representative] = len(cluster_ids) + 1
+        writer = BufferedSink(sink, feedback, self.parameterAsInt(parameters, self.BATCH_SIZE, context),
+                              int(self.parameterAsDouble(parameters, self.BATCH_MEGABYTES, context) * 1024 * 1024)) # features are written to the output in batches
+        try:
+            for feat in layer.getFeatures(QgsFeatureRequest().setFilterFids([fid for fid in best_scores if fid not in reference_fids]).setNoAttributes()):
+                representative = clusters.find(feat.id())
+                new_feat = QgsFeature(clusterfields)
+                new_feat.setGeometry(feat.geometry())
+                new_feat.setAttributes([feat.id(), cluster_ids[representative], reference_fids.get(representative, representative), best_scores[feat.id()]])
+                writer.addFeature(new_feat)
+                if feedback.isCanceled():
+                    break
+        finally:
+            writer.close() # also writes the buffered features if the algorithm is canceled or fails
+        feedback.pushInfo(self.tr('{} features have been grouped into {} clusters.').format(len(best_scores), len(cluster_ids)))
+
+        return {self.OUTPUT: parameters[self.SOURCE_LYR], self.CLUSTERS: dest_id} # Return result of algorithm
+
+    def update_reference_index(self, reference_layer, reference_field, crs, rebuild, context, feedback):
+        # Keeps a SQLite file with centroid (in crs), value and soundex of every reference feature, plus an R*Tree on the centroids.
+        # Nothing is read if the fingerprint of the reference layer (feature count, field, modification stamps of its files) is the same as at the last run.
+        # Otherwise only the ids of the layer are read to remove the deleted features and only the added features are read. A sample of the other
+        # features is checked against the checksum of its stored geometry and value: if one differs, feature ids have been reused (e.g. after
+        # repacking a shapefile) and every feature is checked. Returns the path of the file.
+        index_dir = os.path.join(QgsApplication.qgisSettingsDirPath(), 'cache', 'SelectDuplicatesBySimilarity')
+        os.makedirs(index_dir, exist_ok=True)
+        identity = [reference_layer.source(), reference_layer.subsetString(), reference_field, crs.toWkt(), '2']
+        index_path = os.path.join(index_dir, hashlib.sha1('|'.join(identity).encode('utf-8')).hexdigest() + '.sqlite')
+        fingerprint = [reference_layer.source(), reference_field, str(reference_layer.featureCount())]
+        path = QgsProviderRegistry.instance().decodeUri(reference_layer.providerType(), reference_layer.source()).get('path')
+        if path and os.path.isfile(path):
+            for file_path in sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + '*')): # sidecar files too, e.g. the .dbf of a shapefile or the -wal of a geopackage
+                stat = os.stat(file_path)
+                fingerprint.append('{}:{}:{}'.format(os.path.basename(file_path), stat.st_mtime_ns, stat.st_size))
+        else:
+            fingerprint = None # changes of other sources (e.g. databases) can not be detected without reading them
+        connection = sqlite3.connect(index_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (identity TEXT, fingerprint TEXT)')
+        stored_meta = connection.execute('SELECT identity, fingerprint FROM meta').fetchone()
+        if rebuild or stored_meta is None or stored_meta[0] != '|'.join(identity):
+            connection.execute('DROP TABLE IF EXISTS features')
+            connection.execute('DROP TABLE IF EXISTS features_rtree')
+            connection.execute('DELETE FROM meta')
+            connection.execute('INSERT INTO meta VALUES (?, NULL)', ('|'.join(identity),))
+        elif fingerprint is not None and stored_meta[1] == '|'.join(fingerprint):
+            connection.close()
+            feedback.pushInfo(self.tr('Index of the reference layer is up to date.'))
+            return index_path
+        connection.execute('CREATE TABLE IF NOT EXISTS features (fid INTEGER PRIMARY KEY, x REAL, y REAL, value BLOB, soundex TEXT, checksum TEXT)') # value is NULL for features that can not be compared
+        connection.execute('CREATE INDEX IF NOT EXISTS features_soundex ON features (soundex)')
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS features_rtree USING rtree(fid, minx, maxx, miny, maxy)')
+        
+        stored_checksums = dict(connection.execute('SELECT fid, checksum FROM features'))
+        current_ids = set(reference_layer.allFeatureIds())
+        kept_ids = sorted(fid for fid in stored_checksums if fid in current_ids)
+        n_added = n_changed = 0
+        transform = None
+        if reference_layer.crs() != crs:
+            transform = QgsCoordinateTransform(reference_layer.crs(), crs, context.transformContext())
+        def feature_checksum(feat):
+            return hashlib.sha1(bytes(feat.geometry().asWkb()) + repr(feat[reference_field]).encode('utf-8')).hexdigest()
+        request = QgsFeatureRequest().setSubsetOfAttributes([reference_field], reference_layer.fields())
+        sample_ids = kept_ids[::max(1, len(kept_ids) // 100)] + kept_ids[-1:] # about 100 ids, always including the highest one, which a repack changes first
+        if sample_ids and any(feature_checksum(feat) != stored_checksums[feat.id()] for feat in reference_layer.getFeatures(QgsFeatureRequest(request).setFilterFids(sample_ids))):
+            feedback.pushInfo(self.tr('Feature ids of the reference layer have been reused, all features are checked.'))
+        elif stored_checksums: # otherwise the index is new and all features are read
+            request.setFilterFids([fid for fid in current_ids if fid not in stored_checksums])
+        for feat in reference_layer.getFeatures(request):
+            value = feat[reference_field]
+            checksum = feature_checksum(feat)
+            if stored_checksums.get(feat.id()) == checksum:
+                continue
+            if feat.id() in stored_checksums: # edited or reused feature id
+                connection.execute('DELETE FROM features WHERE fid = ?', (feat.id(),))
+                connection.execute('DELETE FROM features_rtree WHERE fid = ?', (feat.id(),))
+                n_changed += 1
+            else:
+                n_added += 1
+            if value is not None and len(str(value)) > 0 and not feat.geometry().isNull(): # only compare if field and geometry are not empty
+                geometry = feat.geometry().centroid()
+                if transform is not None:
+                    geometry.transform(transform)
+                centroid = geometry.asPoint()
+                try:
+                    value_blob = pickle.dumps(value)
+                except Exception: # attribute type that can not be stored, compare its string instead
+                    value_blob = pickle.dumps(str(value))
+                connection.execute('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?)', (feat.id(), centroid.x(), centroid.y(), value_blob, QgsStringUtils.soundex(str(value)), checksum))
+                connection.execute('INSERT INTO features_rtree VALUES (?, ?, ?, ?, ?)', (feat.id(), centroid.x(), centroid.x(), centroid.y(), centroid.y()))
+            else:
+                connection.execute('INSERT INTO features VALUES (?, NULL, NULL, NULL, NULL, ?)', (feat.id(), checksum))
+            if feedback.isCanceled():
+                connection.close() # uncommitted changes are discarded, the index stays valid
+                return None
+        deleted_ids = [(fid,) for fid in stored_checksums if fid not in current_ids]
+        connection.executemany('DELETE FROM features WHERE fid = ?', deleted_ids)
+        connection.executemany('DELETE FROM features_rtree WHERE fid = ?', deleted_ids)
+        connection.execute('UPDATE meta SET fingerprint = ?', (None if fingerprint is None else '|'.join(fingerprint),))
+        connection.commit()
+        connection.close()
+        feedback.pushInfo(self.tr('Index of the reference layer updated: {} features added, {} changed, {} deleted.').format(n_added, n_changed, len(deleted_ids)))
+        return index_path
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return SelectDuplicatesBySimilarity()
+
+    def name(self):
+        return 'SelectDuplicatesBySimilarity'
+
+    def displayName(self):
+        return self.tr('Select possible duplicate features by similarity (attribute and distance)')
+
+    def group(self):
+        return self.tr('FROM GISSE')
+
+    def groupId(self):
+        return 'from_gisse'
+
+    def shortHelpString(self):
+        return self.tr(
+        'This Algorithm selects possible duplicate features by their similarity. The first feature (ordered by feature id) in each group is NOT beeing selected. '
+        'You can choose between the following algorithms, and can also combine them: \n'
+        '- Exact Match: Matches if the attribue values are exactly the same \n'
+        '- Soundex: Matches by sound, as pronounced in English if both results are equal \n '
+        '- Levenshtein Distance: Matches if by measuring the difference between two sequences is lower than the threshold\n '
+        '- Longest Common Substring: Matches if the longest string that is a substring of compared value and greater than the threshold \n'
+        '- Hamming Distance: Matches if between two strings of equal length the number of positions at which the corresponding symbols are greater than the threshold \n '
+        'You can also choose a maximum search distance in CRS units. If the layer is not a single-point layer, the centroids are taken for distance calculation. '
+        'Only features whose centroids are within this distance (found by a spatial index) are compared at all, so a small distance speeds up the algorithm a lot. \n'
+        'For large layers with a large search distance you can search candidates by MinHash / LSH instead: only features sharing at least one band of their MinHash signatures (built from character shingles of the attribute value) are compared by the chosen algorithms. '
+        'This is approximate, very dissimilar values may be missed. The theoretical recall of the chosen bands and rows is reported in the log. \n'
+        'The comparison can be split up into tiles processed by several worker processes (not available on Windows), the result does not depend on the number of workers. \n'
+        'If an already cleaned reference layer is chosen, only the features of the source layer (e.g. the new features of a day) are compared to the reference layer and to each other. '
+        'Only source features are selected. The reference layer is kept in an index file in the QGIS profile. It is not read again while the reference layer files are unchanged, otherwise only the features added or deleted since the last run are updated in it (all of them if feature ids have been reused); features edited in place need a rebuild of the index. The reference layer must not be the source layer itself. \n'
+        'Optionally all features belonging to a group of duplicates can be written to a layer with the id of their cluster, the feature id of its first (not selected) feature and the best score (share of chosen algorithms that matched) of the feature.'
         )
\ No newline at end of file
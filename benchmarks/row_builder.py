@@ -0,0 +1,102 @@
+# Author: Mario Königbauer
+# License: GNU General Public License v3.0
+
+# Micro-benchmark of the RowBuilder of the algorithms, runs without QGIS: python benchmarks/row_builder.py
+# Compares building an output feature of the OTP algorithms field by field with locals()[name] (as before RowBuilder)
+# to one locals() snapshot per feature and a single setAttributes call. It always runs with minimal stand-ins for QgsFeature
+# and QgsFields, which measure only the Python side. If qgis.core can be imported (e.g. in the Python of a QGIS installation),
+# it runs with the real classes as well, where every setAttribute call additionally crosses into C++. The output names which is which.
+
+import ast, itertools, os, timeit
+
+try:
+    from qgis.core import QgsFeature, QgsField, QgsFields
+    from PyQt5.QtCore import QVariant
+except ImportError:
+    QgsFeature = None
+
+N_SOURCE_FIELDS = 10
+N_ROUTE_FIELDS = 50 # about the number of leg fields of OtpRoutes
+N_FEATURES = 20000
+
+class Fields: # stand-in for QgsFields
+    def __init__(self, n):
+        self.n = n
+
+    def count(self):
+        return self.n
+
+class Feature: # stand-in for QgsFeature
+    def __init__(self, fields):
+        self.attributes = [None] * fields.count()
+        self.geometry = None
+
+    def setGeometry(self, geometry):
+        self.geometry = geometry
+
+    def setAttribute(self, index, value):
+        self.attributes[index] = value
+
+    def setAttributes(self, values):
+        self.attributes = list(values)
+
+def qgis_fields(n): # real QgsFields with n integer fields
+    fields = QgsFields()
+    for nr in range(n):
+        fields.append(QgsField('field_{}'.format(nr), QVariant.Int))
+    return fields
+
+def attributes(feature):
+    return feature.attributes() if callable(feature.attributes) else feature.attributes
+
+def load_row_builder(feature_class):
+    # RowBuilder is taken from OtpRoutes.py itself, so the benchmark measures the code that is shipped
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'OtpRoutes.py')
+    with open(path, encoding='utf-8') as script:
+        tree = ast.parse(script.read())
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == 'RowBuilder']
+    namespace = {'itertools': itertools, 'QgsFeature': feature_class}
+    exec(compile(ast.Module(body=classes, type_ignores=[]), path, 'exec'), namespace)
+    return namespace['RowBuilder']
+
+def make_builders(fields, route_field_names, row_builder, feature_class):
+    # Both functions hold the route values in local variables named like the fields, like processAlgorithm of the OTP algorithms
+    assignments = ''.join('    {} = {}\n'.format(name, nr) for nr, name in enumerate(route_field_names))
+    fieldindexdict = {N_SOURCE_FIELDS + nr: name for nr, name in enumerate(route_field_names)}
+    source = (
+        'def by_field(source_attributes, geometry):\n' + assignments +
+        '    new_feature = Feature(fields)\n'
+        '    new_feature.setGeometry(geometry)\n'
+        '    for fieldindex in range(N_SOURCE_FIELDS):\n'
+        '        new_feature.setAttribute(fieldindex, source_attributes[fieldindex])\n'
+        '    for fieldindex, value in fieldindexdict.items():\n'
+        '        new_feature.setAttribute(fieldindex, locals()[value])\n'
+        '    return new_feature\n'
+        'def by_row(source_attributes, geometry):\n' + assignments +
+        '    variables = locals()\n'
+        '    return rows.feature(geometry, source_attributes, [variables[name] for name in route_field_names])\n')
+    namespace = {'Feature': feature_class, 'fields': fields, 'N_SOURCE_FIELDS': N_SOURCE_FIELDS, 'fieldindexdict': fieldindexdict,
+                 'rows': row_builder(fields), 'route_field_names': route_field_names}
+    exec(source, namespace)
+    return namespace['by_field'], namespace['by_row']
+
+def run(label, fields, feature_class):
+    route_field_names = ['route_field_{}'.format(nr) for nr in range(N_ROUTE_FIELDS)]
+    by_field, by_row = make_builders(fields, route_field_names, load_row_builder(feature_class), feature_class)
+    source_attributes = list(range(N_SOURCE_FIELDS))
+    if attributes(by_field(source_attributes, None)) != attributes(by_row(source_attributes, None)):
+        raise AssertionError('RowBuilder builds other attributes than the field by field assignment')
+    print(label)
+    for name, build in (('field by field with locals()[name]', by_field), ('RowBuilder', by_row)):
+        seconds = min(timeit.repeat(lambda: build(source_attributes, None), number=N_FEATURES, repeat=5))
+        print('  {:<36} {:8.1f} ms for {} features, {:6.2f} us per feature'.format(name, seconds * 1000, N_FEATURES, seconds / N_FEATURES * 1e6))
+
+def main():
+    run('Stand-ins for QgsFeature and QgsFields (Python side only):', Fields(N_SOURCE_FIELDS + N_ROUTE_FIELDS), Feature)
+    if QgsFeature is None:
+        print('qgis.core can not be imported, run this script with the Python of QGIS to measure with the real QgsFeature as well.')
+    else:
+        run('QgsFeature and QgsFields of qgis.core:', qgis_fields(N_SOURCE_FIELDS + N_ROUTE_FIELDS), QgsFeature)
+
+if __name__ == '__main__':
+    main()